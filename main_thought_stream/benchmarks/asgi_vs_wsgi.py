@@ -0,0 +1,89 @@
+"""
+Compare requests per second and latency of the sync read views under WSGI with the
+async read views under ASGI.
+
+Start both servers against the same local database first, for example:
+
+    gunicorn main_thought_stream.wsgi -w 4 -b 127.0.0.1:8000
+    uvicorn main_thought_stream.asgi:application --workers 4 --port 8001
+
+then run:
+
+    python benchmarks/asgi_vs_wsgi.py --post-id 1 --concurrency 64 --requests 5000
+
+Only the standard library is used, so the client itself does not need Django.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(url):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n\r\n'.encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    return int(status_line.split()[1])
+
+
+async def run(url, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                status = await fetch(url)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def report(label, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f'{label:<40} {len(latencies) / elapsed:>9.1f} req/s   p50 {p50:>7.1f} ms   '
+          f'p99 {p99:>7.1f} ms   errors {errors}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wsgi', default='http://127.0.0.1:8000', help='base URL of the WSGI server')
+    parser.add_argument('--asgi', default='http://127.0.0.1:8001', help='base URL of the ASGI server')
+    parser.add_argument('--post-id', type=int, default=1, help='post whose comment thread is requested')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    targets = [
+        ('WSGI  PostView', f'{args.wsgi}/post/'),
+        ('ASGI  AsyncPostView', f'{args.asgi}/post/async/'),
+        ('WSGI  PostCommentsView', f'{args.wsgi}/post/{args.post_id}/comments/'),
+        ('ASGI  AsyncPostCommentsView', f'{args.asgi}/post/{args.post_id}/comments/async/'),
+    ]
+    for label, url in targets:
+        # Warm up connections, caches and the database before measuring
+        asyncio.run(run(url, args.concurrency, args.concurrency * 2))
+        report(label, *asyncio.run(run(url, args.concurrency, args.requests)))
+
+
+if __name__ == '__main__':
+    main()
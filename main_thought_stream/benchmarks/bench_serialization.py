@@ -0,0 +1,98 @@
+"""
+pytest-benchmark suite for the list serialization paths: DRF serializers with
+JSONRenderer against the post.rows fast path with FastJSONRenderer, on the same
+rows. Every benchmark records rows serialized per second in its extra info.
+
+Runs against a throwaway test database seeded by the suite:
+
+    pytest benchmarks/bench_serialization.py --benchmark-columns=mean,ops,rounds
+    pytest benchmarks/bench_serialization.py --benchmark-autosave   # track over time
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_thought_stream.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment, teardown_test_environment  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+
+from post.fieldsets import post_values  # noqa: E402
+from post.models import Comment, Post  # noqa: E402
+from post.renderers import FastJSONRenderer  # noqa: E402
+from post.rows import comment_representations, post_representations  # noqa: E402
+from post.serializers import FlatCommentSerializer, PostSerializer  # noqa: E402
+
+ROWS = 1000
+
+
+@pytest.fixture(scope='module', autouse=True)
+def database():
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    author = User.objects.create_user(username='benchmark')
+    posts = Post.objects.bulk_create([
+        Post(title=f'Post {i}', content='Lorem ipsum dolor sit amet. ' * 20, image='media/post.jpg', author=author,
+             image_variants={'webp': {'320': f'media/variants/{i}/post-320.webp'}})
+        for i in range(ROWS)
+    ])
+    Comment.objects.bulk_create([
+        Comment(post=posts[0], user=author, content=f'Comment {i}', path=str(i).zfill(10)) for i in range(ROWS)
+    ])
+    yield
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+    teardown_test_environment()
+
+
+@pytest.fixture
+def request_():
+    return APIRequestFactory().get('/post/')
+
+
+def record_rate(benchmark):
+    benchmark.extra_info['rows'] = ROWS
+    benchmark.extra_info['rows_per_second'] = round(ROWS / benchmark.stats.stats.mean)
+
+
+@pytest.mark.parametrize('fields', [None, ['id', 'title', 'excerpt']], ids=['full', 'excerpt'])
+def test_posts_drf_serializer(benchmark, request_, fields):
+    posts = list(Post.objects.select_related('author').order_by('-created_at', '-id'))
+
+    def serialize():
+        return JSONRenderer().render(PostSerializer(posts, many=True, fields=fields, context={'request': request_}).data)
+
+    benchmark(serialize)
+    record_rate(benchmark)
+
+
+@pytest.mark.parametrize('fields', [None, ['id', 'title', 'excerpt']], ids=['full', 'excerpt'])
+def test_posts_fast_path(benchmark, request_, fields):
+    rows = list(post_values(fields).order_by('-created_at', '-id'))
+
+    def serialize():
+        return FastJSONRenderer().render(post_representations(rows, fields, request_))
+
+    benchmark(serialize)
+    record_rate(benchmark)
+
+
+def test_comments_drf_serializer(benchmark):
+    comments = list(Comment.objects.order_by('created_at', 'id'))
+    benchmark(lambda: JSONRenderer().render(FlatCommentSerializer(comments, many=True).data))
+    record_rate(benchmark)
+
+
+def test_comments_fast_path(benchmark):
+    # Includes the query: the fast path reads with values_list() as part of serializing
+    queryset = Comment.objects.order_by('created_at', 'id')
+    benchmark(lambda: FastJSONRenderer().render(comment_representations(queryset)))
+    record_rate(benchmark)
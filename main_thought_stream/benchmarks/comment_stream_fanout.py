@@ -0,0 +1,96 @@
+"""
+Load test for the live comment stream: thousands of idle SSE subscribers on one
+post, measuring memory per connection and how long a broadcast takes to reach all
+of them.
+
+Every subscriber runs CommentStreamView's real event generator on one event loop,
+as an ASGI worker would; events are published from another thread, like the sync
+write views do. No database or server is needed:
+
+    python benchmarks/comment_stream_fanout.py --subscribers 5000 --broadcasts 20
+"""
+import argparse
+import asyncio
+import gc
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_thought_stream.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from post.async_views import CommentStreamView  # noqa: E402
+from post.broker import InProcessBroker, comments_channel  # noqa: E402
+
+CHANNEL = comments_channel(1)
+
+
+async def subscriber(broker, view, received):
+    stream = view.stream(broker.subscribe(CHANNEL))
+    await anext(stream)  # retry: header
+    async for frame in stream:
+        if frame.startswith('event:'):
+            sent_at = float(frame.split('data: ', 1)[1])
+            received.append(time.perf_counter() - sent_at)
+
+
+async def run(subscribers, broadcasts, max_pending):
+    broker = InProcessBroker(max_pending=max_pending)
+    view = CommentStreamView()
+    view.heartbeat_interval = 3600
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    received = []
+    tasks = [asyncio.create_task(subscriber(broker, view, received)) for _ in range(subscribers)]
+    while broker.subscriber_count(CHANNEL) < subscribers:
+        await asyncio.sleep(0.01)
+    gc.collect()
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / subscribers
+    tracemalloc.stop()
+
+    completion = []
+    for _ in range(broadcasts):
+        received.clear()
+        sent_at = time.perf_counter()
+        publisher = threading.Thread(
+            target=broker.publish, args=(CHANNEL, {'type': 'comment.created', 'data': repr(sent_at)}),
+        )
+        publisher.start()
+        while len(received) < subscribers:
+            await asyncio.sleep(0.001)
+        publisher.join()
+        completion.append(max(received))
+        latencies = sorted(received)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f'subscribers                  {subscribers}')
+    print(f'memory per connection        {per_connection / 1024:.2f} KiB (Python heap, excluding sockets)')
+    print(f'last broadcast p50 / p99     {statistics.median(latencies) * 1000:.2f} / '
+          f'{latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms')
+    print(f'time to reach everyone       median {statistics.median(completion) * 1000:.2f} ms, '
+          f'worst {max(completion) * 1000:.2f} ms over {broadcasts} broadcasts')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, default=5000)
+    parser.add_argument('--broadcasts', type=int, default=20)
+    parser.add_argument('--max-pending', type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(args.subscribers, args.broadcasts, args.max_pending))
+
+
+if __name__ == '__main__':
+    main()
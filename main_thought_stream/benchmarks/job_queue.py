@@ -0,0 +1,143 @@
+"""
+What moving post-write side effects into jobs.queue buys a request, and what the
+database broker's workers sustain.
+
+First PostCreationView is timed with an uploaded image, once running the image
+variants and timeline fan-out inline, as if they were part of the request, and
+once enqueuing them on the local and on the database broker. Then a batch of
+no-op jobs is stored and drained by `run_jobs --burst` at each concurrency given.
+
+Runs against a throwaway test database (created and destroyed by the script, never
+the configured one), with throttles off and media written to a temp directory:
+
+    python benchmarks/job_queue.py --posts 30 --jobs 2000 --concurrency 1 4
+"""
+import argparse
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_thought_stream.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from PIL import Image  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from jobs import queue  # noqa: E402
+from jobs.models import Job  # noqa: E402
+from post import images, timeline  # noqa: E402
+
+
+@queue.task
+def noop(value):
+    pass
+
+
+def make_image(width=1600, height=1200):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (90, 140, 200)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def create_posts(client, count, image):
+    latencies = []
+    for i in range(count):
+        upload = SimpleUploadedFile('photo.jpg', image, content_type='image/jpeg')
+        started = time.perf_counter()
+        response = client.post(reverse('post-create'), {'title': f'Post {i}', 'content': 'content', 'image': upload},
+                               format='multipart')
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 201, response.content
+    return statistics.median(latencies) * 1000
+
+
+def request_latency(posts):
+    user = User.objects.create_user(username='jobs-benchmark')
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+    image = make_image()
+
+    def run_inline(task):
+        # Stands in for Task.enqueue_many, doing the work in the request instead
+        return lambda calls: [task(*args) for args, _ in calls]
+
+    with mock.patch.object(images.generate_variants, 'enqueue_many', run_inline(images.generate_variants)), \
+            mock.patch.object(timeline.fan_out, 'enqueue_many', run_inline(timeline.fan_out)):
+        work_inline = create_posts(client, posts, image)
+    local = queue.LocalBroker(queue.option('CONCURRENCY'))
+    with mock.patch.object(queue, 'broker', local):
+        on_local = create_posts(client, posts, image)
+        local.executor.shutdown(wait=True)
+    with mock.patch.object(queue, 'broker', queue.DatabaseBroker()):
+        on_database = create_posts(client, posts, image)
+
+    print(f'POST /post/create/ with a 1600x1200 image, median of {posts}:')
+    print(f'  variants and fan-out inline:  {work_inline:8.1f} ms')
+    print(f'  enqueued on the local broker: {on_local:8.1f} ms')
+    print(f'  enqueued in the database:     {on_database:8.1f} ms')
+
+
+def worker_throughput(jobs, concurrency):
+    broker = queue.DatabaseBroker()
+    Job.objects.all().delete()
+    started = time.perf_counter()
+    for i in range(jobs):
+        # One INSERT per job, as each request's on_commit push does
+        broker.push([Job(name=noop.name, args=[i])])
+    enqueued = time.perf_counter() - started
+
+    with mock.patch.object(queue, 'broker', broker):
+        started = time.perf_counter()
+        call_command('run_jobs', '--burst', '--concurrency', str(concurrency), stdout=io.StringIO())
+        drained = time.perf_counter() - started
+    assert Job.objects.filter(status=Job.DONE).count() == jobs
+    print(f'{jobs} no-op jobs, concurrency {concurrency}: push {enqueued / jobs * 1e6:.0f} us/job, '
+          f'worker {jobs / drained:.0f} jobs/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    media_root = tempfile.mkdtemp()
+    overrides = {
+        'REST_FRAMEWORK': {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {}},
+        'INSTRUMENTATION': {**getattr(settings, 'INSTRUMENTATION', {}), 'LOG_REQUESTS': False},
+        'ALLOWED_HOSTS': ['*'],
+        'MEDIA_ROOT': media_root,
+    }
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with override_settings(**overrides):
+            request_latency(args.posts)
+            for concurrency in args.concurrency:
+                worker_throughput(args.jobs, concurrency)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
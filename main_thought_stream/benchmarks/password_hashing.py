@@ -0,0 +1,116 @@
+"""
+Logins per second per core under each password hasher, at the costs configured in
+PASSWORD_HASHING, and how long the event loop stalls while async logins hash.
+
+For every installed hasher (argon2 needs argon2-cffi, bcrypt needs bcrypt) this
+measures password checks on one thread, then on the user.hashers pool with one
+thread per core. It then runs a burst of concurrent logins on an event loop,
+hashing inline as Django's acheck_password() does and on the pool as AsyncLoginView
+does, while a heartbeat task records the longest delay it sees. No database is
+needed:
+
+    python benchmarks/password_hashing.py --seconds 3 --burst 32
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_thought_stream.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.hashers import get_hasher, make_password, verify_password  # noqa: E402
+
+from user import hashers  # noqa: E402
+
+PASSWORD = 'Secret123!'
+ALGORITHMS = ['pbkdf2_sha256', 'argon2', 'bcrypt_sha256']
+
+
+def serial_rate(encoded, seconds):
+    count, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        verify_password(PASSWORD, encoded)
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def pool_rate(encoded, seconds):
+    workers = hashers.executor._max_workers
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        count = 0
+        while time.perf_counter() < deadline:
+            verify_password(PASSWORD, encoded)
+            count += 1
+        return count
+
+    started = time.perf_counter()
+    futures = [hashers.executor.submit(worker) for _ in range(workers)]
+    total = sum(future.result() for future in futures)
+    return total / (time.perf_counter() - started)
+
+
+async def loop_stall(encoded, burst, offload):
+    """
+    Longest heartbeat delay, in ms, while `burst` logins run on the loop.
+    """
+    worst = 0.0
+    running = True
+
+    async def heartbeat():
+        nonlocal worst
+        while running:
+            expected = time.perf_counter() + 0.005
+            await asyncio.sleep(0.005)
+            worst = max(worst, time.perf_counter() - expected)
+
+    async def login():
+        if offload:
+            await hashers.averify_password(PASSWORD, encoded)
+        else:
+            verify_password(PASSWORD, encoded)
+            await asyncio.sleep(0)
+
+    beat = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0.02)
+    await asyncio.gather(*(login() for _ in range(burst)))
+    running = False
+    await beat
+    return worst * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--burst', type=int, default=32)
+    args = parser.parse_args()
+
+    cores = os.cpu_count()
+    print(f'{cores} cores, hashing pool of {hashers.executor._max_workers} threads')
+    for algorithm in ALGORITHMS:
+        try:
+            encoded = make_password(PASSWORD, hasher=algorithm)
+        except ValueError as exc:
+            print(f'{algorithm}: skipped, {exc}')
+            continue
+        serial = serial_rate(encoded, args.seconds)
+        pooled = pool_rate(encoded, args.seconds)
+        inline_stall = asyncio.run(loop_stall(encoded, args.burst, offload=False))
+        pool_stall = asyncio.run(loop_stall(encoded, args.burst, offload=True))
+        params = {key: value for key, value in get_hasher(algorithm).decode(encoded).items()
+                  if key not in ('hash', 'salt', 'checksum', 'params')}
+        print(', '.join(f'{key}={value}' for key, value in params.items()))
+        print(f'  one thread: {serial:8.1f} logins/s ({1000 / serial:.1f} ms each)')
+        print(f'  pool:       {pooled:8.1f} logins/s, {pooled / cores:.1f} per core')
+        print(f'  event loop stall over {args.burst} logins: inline {inline_stall:.1f} ms, pool {pool_stall:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
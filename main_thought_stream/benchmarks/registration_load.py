@@ -0,0 +1,129 @@
+"""
+Load test for registration: throughput with concurrent clients registering
+distinct users, then races where two clients claim the same username at once.
+Every race has to end in one 201 and one 400 naming the username, never a 500.
+
+Runs RegisterView through the full middleware stack against a throwaway test
+database (created and destroyed by the script, never the configured one), with
+throttles off. Password hashing dominates registration; --fast-hasher swaps in a
+cheap hasher to expose the database work:
+
+    python benchmarks/registration_load.py --clients 8 --registrations 400 --races 50
+    python benchmarks/registration_load.py --fast-hasher
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_thought_stream.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+PASSWORD = 'Secret123!'
+
+
+def register(client, username, email):
+    started = time.perf_counter()
+    response = client.post(reverse('register'), {'username': username, 'email': email, 'password': PASSWORD},
+                           format='json')
+    return response, time.perf_counter() - started
+
+
+def run_clients(clients, work):
+    """
+    Run work(client_index) on `clients` threads started together.
+    """
+    barrier = threading.Barrier(clients)
+    results = [None] * clients
+
+    def client_thread(index):
+        try:
+            barrier.wait()
+            results[index] = work(index)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=client_thread, args=(index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def throughput(clients, registrations):
+    per_client = registrations // clients
+
+    def work(index):
+        client = APIClient(raise_request_exception=False)
+        return [register(client, f'load{index}x{i}', f'load{index}x{i}@example.com') for i in range(per_client)]
+
+    started = time.perf_counter()
+    results = [result for batch in run_clients(clients, work) for result in batch]
+    elapsed = time.perf_counter() - started
+    latencies = sorted(duration for _, duration in results)
+    statuses = Counter(response.status_code for response, _ in results)
+    print(f'{len(results)} registrations from {clients} clients in {elapsed:.2f}s: '
+          f'{len(results) / elapsed:.1f}/s, statuses {dict(statuses)}')
+    print(f'  latency p50 {statistics.median(latencies) * 1000:.1f} ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms')
+
+
+def races(rounds):
+    outcomes = Counter()
+    for round_ in range(rounds):
+        def work(index):
+            client = APIClient(raise_request_exception=False)
+            return register(client, f'race{round_}', f'race{round_}x{index}@example.com')[0]
+
+        responses = sorted(run_clients(2, work), key=lambda response: response.status_code)
+        codes = [response.status_code for response in responses]
+        if codes == [201, 400] and 'username' in responses[1].data:
+            outcomes['one winner, field error'] += 1
+        else:
+            outcomes[f'unexpected {codes}'] += 1
+    print(f'{rounds} races for one username: {dict(outcomes)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--registrations', type=int, default=200)
+    parser.add_argument('--races', type=int, default=20)
+    parser.add_argument('--fast-hasher', action='store_true', help='Hash passwords with MD5 to isolate DB work.')
+    args = parser.parse_args()
+
+    overrides = {
+        'REST_FRAMEWORK': {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {}},
+        'INSTRUMENTATION': {**getattr(settings, 'INSTRUMENTATION', {}), 'LOG_REQUESTS': False},
+        'ALLOWED_HOSTS': ['*'],
+    }
+    if args.fast_hasher:
+        overrides['PASSWORD_HASHERS'] = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with override_settings(**overrides):
+            throughput(args.clients, args.registrations)
+            races(args.races)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
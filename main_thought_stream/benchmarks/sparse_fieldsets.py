@@ -0,0 +1,95 @@
+"""
+Payload size, bytes read from the database and time per feed page, for the full
+post representation against sparse fieldsets such as ?fields=id,title,excerpt.
+
+Seeds a throwaway test database (created and destroyed by the script, never the
+configured one) with long posts, then requests the first feed page through the real
+view:
+
+    python benchmarks/sparse_fieldsets.py --posts 500 --content-size 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_thought_stream.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from post.cache import response_cache  # noqa: E402
+from post.models import Post  # noqa: E402
+
+VARIANTS = [None, 'id,title,author,excerpt,created_at', 'id,title,excerpt']
+
+
+def seed(posts, content_size):
+    author = User.objects.create_user(username='benchmark')
+    paragraph = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+    content = (paragraph * (content_size // len(paragraph) + 1))[:content_size]
+    Post.objects.bulk_create(
+        [Post(title=f'Post {i}', content=content, image='media/post.jpg', author=author) for i in range(posts)],
+        batch_size=500,
+    )
+
+
+def database_bytes(queries):
+    """
+    Size of the values the captured queries return, re-run on a plain cursor.
+    """
+    total = 0
+    with connection.cursor() as cursor:
+        for query in queries:
+            cursor.execute(query['sql'])
+            for row in cursor.fetchall():
+                total += sum(len(str(value).encode()) for value in row if value is not None)
+    return total
+
+
+def measure(client, fields, rounds, page_size):
+    params = {'page_size': page_size}
+    if fields:
+        params['fields'] = fields
+    timings = []
+    for _ in range(rounds):
+        response_cache().clear()
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(reverse('post-list'), params)
+        timings.append(time.perf_counter() - started)
+    assert response.status_code == 200, response.content
+    return len(response.content), database_bytes(context.captured_queries), min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--content-size', type=int, default=20000, help='characters of content per post')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        seed(args.posts, args.content_size)
+        client = APIClient()
+        print(f'{"fields":<40} {"payload":>12} {"db bytes":>12} {"best time":>10}')
+        for fields in VARIANTS:
+            payload, db_bytes, best = measure(client, fields, args.rounds, args.page_size)
+            print(f'{fields or "(all)":<40} {payload:>12,} {db_bytes:>12,} {best * 1000:>8.2f}ms')
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
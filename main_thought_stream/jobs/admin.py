@@ -0,0 +1,16 @@
+from django.contrib import admin
+from django.utils import timezone
+
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'attempts', 'run_at', 'finished_at']
+    list_filter = ['status', 'name']
+    search_fields = ['key']
+    actions = ['run_again']
+
+    @admin.action(description="Run the selected jobs again")
+    def run_again(self, request, queryset):
+        queryset.update(status=Job.QUEUED, attempts=0, run_at=timezone.now(), locked_until=None, finished_at=None)
@@ -0,0 +1,77 @@
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from jobs import queue
+
+# Seconds between deletions of old finished jobs
+PRUNE_INTERVAL = 600
+
+
+class Command(BaseCommand):
+    help = "Run the jobs stored by the database broker until stopped with SIGINT or SIGTERM."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=queue.option('CONCURRENCY'),
+                            help="Jobs run at once, each on its own thread.")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait before looking again when no job is due.")
+        parser.add_argument('--burst', action='store_true', help="Exit once no job is due.")
+
+    def handle(self, *args, **options):
+        if not isinstance(queue.broker, queue.DatabaseBroker):
+            raise CommandError("JOBS['BROKER'] is not 'database'; local jobs run in the process that enqueues them.")
+        concurrency = max(options['concurrency'], 1)
+        poll_interval = options['poll_interval']
+
+        self.stopping = False
+        handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+        # One job at a time runs on this thread, with no pool
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='jobs') if concurrency > 1 else None
+        running = set()
+        claimed = 0
+        next_prune = 0
+        try:
+            while not self.stopping:
+                close_old_connections()
+                if time.monotonic() >= next_prune:
+                    queue.broker.prune()
+                    next_prune = time.monotonic() + PRUNE_INTERVAL
+
+                jobs = queue.broker.claim(concurrency - len(running))
+                claimed += len(jobs)
+                for job in jobs:
+                    if pool is None:
+                        self.work(job)
+                    else:
+                        running.add(pool.submit(self.work_on_thread, job))
+
+                if running:
+                    _, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                elif not jobs:
+                    if options['burst']:
+                        break
+                    time.sleep(poll_interval)
+        finally:
+            # Jobs already started are finished, not abandoned to their lease
+            if pool is not None:
+                pool.shutdown(wait=True)
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write(self.style.SUCCESS(f"Ran {claimed} jobs."))
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def work(self, job):
+        queue.broker.finish(job, queue.run(job))
+
+    def work_on_thread(self, job):
+        close_old_connections()
+        try:
+            self.work(job)
+        finally:
+            close_old_connections()
@@ -0,0 +1,45 @@
+from django.db import models
+from django.utils import timezone
+
+
+class Job(models.Model):
+    """
+    A call of a jobs.queue task waiting for, or taken by, a `run_jobs` worker. Only
+    the database broker stores jobs; the local one keeps them in memory.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    # Dotted path of the task function
+    name = models.CharField(max_length=255)
+    args = models.JSONField(default=list)
+    # Idempotency key: at most one job per key exists until done jobs are pruned; a
+    # failed job gives its key up at once, so the work can be enqueued again
+    key = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    # Earliest time the next attempt may start
+    run_at = models.DateTimeField(default=timezone.now)
+    # A running job whose worker has not finished it by then is assumed lost and run again
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name}({', '.join(map(repr, self.args))})"
+
+    class Meta:
+        indexes = [
+            # Due jobs in order, scanned by workers claiming work
+            models.Index(fields=['run_at', 'id'], condition=models.Q(status='queued'), name='job_due_idx'),
+            # Leases of running jobs, checked for workers that died
+            models.Index(fields=['locked_until'], condition=models.Q(status='running'), name='job_lease_idx'),
+            models.Index(fields=['finished_at'], condition=models.Q(status='done'), name='job_finished_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['key'], condition=~models.Q(status='failed'), name='job_key_unique'),
+        ]
@@ -0,0 +1,260 @@
+"""
+A small task queue for the work a write leaves behind, such as image variants,
+timeline fan-out and file cleanup.
+
+Functions decorated with @task are queued with task.enqueue(*args, key=...), which
+hands the job to the broker once the current transaction commits: the request does
+not wait for the work, and a write that rolls back starts none. Arguments must be
+JSON serializable, since the database broker stores them.
+
+JOBS['BROKER'] picks the broker:
+- 'local' runs jobs on a thread pool of the process that enqueued them. Nothing is
+  stored, so jobs still pending when that process exits are lost.
+- 'database' stores them as jobs.Job rows for `manage.py run_jobs` workers.
+
+A failed attempt is retried after an exponential backoff, up to the task's
+max_attempts. Jobs run at least once, and a retry repeats whatever the failed
+attempt had already done, so tasks must be idempotent. Enqueuing with the key of a
+job that is pending, or done within the last JOBS['KEEP_FINISHED'] seconds, does
+nothing; the key of a job that failed for good is free again at once.
+"""
+import functools
+import json
+import logging
+import random
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BROKER': 'local',
+    'CONCURRENCY': 4,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF': 2,
+    'MAX_BACKOFF': 600,
+    'LEASE': 300,
+    'KEEP_FINISHED': 86400,
+}
+
+
+def option(name):
+    return getattr(settings, 'JOBS', {}).get(name, DEFAULTS[name])
+
+
+# Task name: Task, filled in as the modules defining tasks are imported
+registry = {}
+
+
+class Task:
+    def __init__(self, func, max_attempts=None, backoff=None):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = f'{func.__module__}.{func.__qualname__}'
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def __call__(self, *args):
+        return self.func(*args)
+
+    def enqueue(self, *args, key=None, delay=None):
+        self.enqueue_many([(args, key)], delay=delay)
+
+    def enqueue_many(self, calls, delay=None):
+        """
+        Enqueue a job per (args, key) pair, handed to the broker in one go. They run
+        no sooner than `delay` seconds from now.
+        """
+        run_at = timezone.now() + timedelta(seconds=delay or 0)
+        # Round-tripped so tasks get the same JSON types from either broker, and
+        # unserializable arguments fail here rather than in the broker
+        jobs = [
+            Job(name=self.name, args=json.loads(json.dumps(list(args))), key=key, run_at=run_at)
+            for args, key in calls
+        ]
+        if jobs:
+            transaction.on_commit(lambda: broker.push(jobs), robust=True)
+
+    def retry_delay(self, attempts):
+        """
+        Seconds to wait before retrying after `attempts` failed attempts, doubling
+        each time with jitter so jobs that failed together spread out; None once
+        they are used up.
+        """
+        if attempts >= (self.max_attempts or option('MAX_ATTEMPTS')):
+            return None
+        delay = min((self.backoff or option('BACKOFF')) * 2 ** (attempts - 1), option('MAX_BACKOFF'))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def task(func=None, *, max_attempts=None, backoff=None):
+    """
+    Make `func` a task. max_attempts and backoff override JOBS['MAX_ATTEMPTS'] and
+    JOBS['BACKOFF'] for it.
+    """
+    def decorate(func):
+        registered = Task(func, max_attempts=max_attempts, backoff=backoff)
+        registry[registered.name] = registered
+        return registered
+    return decorate(func) if func is not None else decorate
+
+
+def get_task(name):
+    if name not in registry:
+        # A worker may not have imported the module yet; doing so registers its tasks
+        try:
+            import_string(name)
+        except ImportError:
+            pass
+    try:
+        return registry[name]
+    except KeyError:
+        raise LookupError(f'No task is named {name}')
+
+
+def run(job):
+    """
+    Make one attempt at `job`. Returns the exception it failed with, or None.
+    """
+    try:
+        get_task(job.name)(*job.args)
+    except Exception as exc:
+        logger.exception('Attempt %s at job %s failed', job.attempts, job)
+        return exc
+    return None
+
+
+def retry_delay(job):
+    try:
+        return get_task(job.name).retry_delay(job.attempts)
+    except LookupError:
+        return None
+
+
+class LocalBroker:
+    def __init__(self, concurrency):
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='jobs')
+        self.lock = threading.Lock()
+        # Idempotency key: monotonic time its job was enqueued, oldest first
+        self.keys = OrderedDict()
+
+    def push(self, jobs):
+        for job in jobs:
+            if job.key is None or self.add_key(job.key):
+                self.submit(job, (job.run_at - timezone.now()).total_seconds())
+
+    def add_key(self, key):
+        now = time.monotonic()
+        with self.lock:
+            expired = now - option('KEEP_FINISHED')
+            while self.keys and next(iter(self.keys.values())) < expired:
+                self.keys.popitem(last=False)
+            if key in self.keys:
+                return False
+            self.keys[key] = now
+            return True
+
+    def submit(self, job, delay=None):
+        if delay and delay > 0:
+            timer = threading.Timer(delay, self.submit, (job,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.executor.submit(self.work, job)
+
+    def work(self, job):
+        job.attempts += 1
+        close_old_connections()
+        try:
+            error = run(job)
+        finally:
+            close_old_connections()
+        if error is not None:
+            delay = retry_delay(job)
+            if delay is not None:
+                self.submit(job, delay)
+            elif job.key is not None:
+                with self.lock:
+                    self.keys.pop(job.key, None)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+
+class DatabaseBroker:
+    def push(self, jobs):
+        # Jobs whose key is taken by a job that has not failed are dropped
+        Job.objects.bulk_create(jobs, ignore_conflicts=True)
+
+    def claim(self, limit):
+        """
+        Take up to `limit` due jobs, and running jobs whose lease ran out, counting
+        an attempt at each. On PostgreSQL concurrent workers skip the rows others
+        have locked; elsewhere the conditional update lets only one of them win.
+        """
+        if limit <= 0:
+            return []
+        now = timezone.now()
+        claimable = Q(status=Job.QUEUED, run_at__lte=now) | Q(status=Job.RUNNING, locked_until__lt=now)
+        claimed = []
+        with transaction.atomic():
+            candidates = (
+                Job.objects.select_for_update(skip_locked=True).filter(claimable)
+                .order_by('run_at', 'id').values_list('id', flat=True)[:limit]
+            )
+            for pk in candidates:
+                if Job.objects.filter(claimable, pk=pk).update(
+                    status=Job.RUNNING,
+                    attempts=F('attempts') + 1,
+                    locked_until=now + timedelta(seconds=option('LEASE')),
+                ):
+                    claimed.append(pk)
+        return list(Job.objects.filter(pk__in=claimed).order_by('run_at', 'id'))
+
+    def finish(self, job, error):
+        """
+        Record how an attempt at a claimed job went: done, queued for a retry, or
+        failed for good.
+        """
+        now = timezone.now()
+        if error is None:
+            changes = {'status': Job.DONE, 'finished_at': now, 'last_error': ''}
+        else:
+            delay = retry_delay(job)
+            changes = {'last_error': ''.join(traceback.format_exception(error))}
+            if delay is None:
+                changes.update(status=Job.FAILED, finished_at=now)
+            else:
+                changes.update(status=Job.QUEUED, run_at=now + timedelta(seconds=delay))
+        # Matching the attempt leaves alone a job another worker took over after the lease ran out
+        Job.objects.filter(pk=job.pk, attempts=job.attempts).update(locked_until=None, **changes)
+
+    def prune(self):
+        """
+        Delete done jobs older than KEEP_FINISHED, freeing their keys. Failed jobs
+        are kept for inspection.
+        """
+        cutoff = timezone.now() - timedelta(seconds=option('KEEP_FINISHED'))
+        return Job.objects.filter(status=Job.DONE, finished_at__lt=cutoff).delete()[0]
+
+
+def create_broker():
+    if option('BROKER') == 'database':
+        return DatabaseBroker()
+    return LocalBroker(option('CONCURRENCY'))
+
+
+broker = create_broker()
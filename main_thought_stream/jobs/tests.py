@@ -0,0 +1,162 @@
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import queue
+from .models import Job
+from .queue import DatabaseBroker, LocalBroker, task
+
+calls = []
+
+
+@task
+def record(value):
+    calls.append(value)
+
+
+@task(max_attempts=2, backoff=10)
+def explode(message):
+    raise RuntimeError(message)
+
+
+class DatabaseBrokerTests(TestCase):
+    def setUp(self):
+        calls.clear()
+        patcher = mock.patch.object(queue, 'broker', DatabaseBroker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_jobs(self):
+        out = StringIO()
+        # The worker's connection is the test's, inside its transaction
+        with mock.patch('jobs.management.commands.run_jobs.close_old_connections'):
+            call_command('run_jobs', '--burst', '--concurrency', '1', stdout=out)
+        return out.getvalue()
+
+    def test_jobs_are_stored_on_commit_and_run_by_the_worker(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            record.enqueue({'id': 1})
+        self.assertFalse(Job.objects.exists())
+        callbacks[0]()
+        job = Job.objects.get()
+        self.assertEqual((job.name, job.args, job.status), ('jobs.tests.record', [{'id': 1}], Job.QUEUED))
+
+        self.assertIn('Ran 1 jobs.', self.run_jobs())
+        self.assertEqual(calls, [{'id': 1}])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 1))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_arguments_must_be_json(self):
+        with self.assertRaises(TypeError):
+            record.enqueue(object())
+
+    def test_same_key_is_enqueued_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record.enqueue(1, key='once')
+            record.enqueue_many([((2,), 'once'), ((3,), None)])
+        self.assertEqual(sorted(Job.objects.values_list('args', flat=True)), [[1], [3]])
+
+    def test_failed_attempts_back_off_then_fail(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            explode.enqueue('boom')
+        started = timezone.now()
+        self.run_jobs()
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('RuntimeError: boom', job.last_error)
+        self.assertTrue(started + timedelta(seconds=5) <= job.run_at <= timezone.now() + timedelta(seconds=10))
+
+        # Not due yet
+        self.assertIn('Ran 0 jobs.', self.run_jobs())
+        Job.objects.update(run_at=timezone.now())
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_failed_jobs_free_their_key(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            explode.enqueue('boom', key='variants')
+        Job.objects.update(status=Job.FAILED, attempts=2, finished_at=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            explode.enqueue('again', key='variants')
+            explode.enqueue('twice', key='variants')
+        self.assertEqual(
+            sorted(Job.objects.values_list('status', 'args')), [(Job.FAILED, ['boom']), (Job.QUEUED, ['again'])],
+        )
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        with override_settings(JOBS={'MAX_ATTEMPTS': 20, 'BACKOFF': 1, 'MAX_BACKOFF': 8}):
+            delays = [record.retry_delay(attempts) for attempts in range(1, 6)]
+            self.assertIsNone(record.retry_delay(20))
+        for delay, full in zip(delays, [1, 2, 4, 8, 8]):
+            self.assertTrue(full / 2 <= delay <= full)
+
+    def test_jobs_of_dead_workers_are_run_again(self):
+        job = Job.objects.create(name='jobs.tests.record', args=[1], status=Job.RUNNING, attempts=1,
+                                 locked_until=timezone.now() - timedelta(seconds=1))
+        Job.objects.create(name='jobs.tests.record', args=[2], status=Job.RUNNING, attempts=1,
+                           locked_until=timezone.now() + timedelta(minutes=5))
+        self.run_jobs()
+        self.assertEqual(calls, [1])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 2))
+
+    def test_late_results_of_a_taken_over_job_are_ignored(self):
+        job = Job.objects.create(name='jobs.tests.record', args=[1])
+        stale, = queue.broker.claim(1)
+        Job.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        current, = queue.broker.claim(1)
+        queue.broker.finish(stale, RuntimeError('lost'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.RUNNING, 2))
+        queue.broker.finish(current, None)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+
+    def test_unknown_tasks_fail_without_retries(self):
+        job = Job.objects.create(name='jobs.queue.option', args=['BROKER'])
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('No task is named jobs.queue.option', job.last_error)
+
+    def test_old_finished_jobs_are_pruned(self):
+        old = timezone.now() - timedelta(days=2)
+        Job.objects.create(name='jobs.tests.record', key='old', status=Job.DONE, finished_at=old)
+        Job.objects.create(name='jobs.tests.record', key='failed', status=Job.FAILED, finished_at=old)
+        Job.objects.create(name='jobs.tests.record', key='recent', status=Job.DONE, finished_at=timezone.now())
+        self.assertEqual(queue.broker.prune(), 1)
+        self.assertEqual(sorted(Job.objects.values_list('key', flat=True)), ['failed', 'recent'])
+
+    def test_worker_needs_the_database_broker(self):
+        with mock.patch.object(queue, 'broker', LocalBroker(1)):
+            with self.assertRaises(CommandError):
+                call_command('run_jobs', '--burst')
+
+
+class LocalBrokerTests(TestCase):
+    def test_jobs_run_on_threads_and_are_retried(self):
+        attempts = []
+        done = threading.Event()
+
+        @task(max_attempts=3, backoff=0.01)
+        def flaky(value):
+            attempts.append(value)
+            if len(attempts) < 3:
+                raise RuntimeError('not yet')
+            done.set()
+
+        broker = LocalBroker(2)
+        self.addCleanup(broker.executor.shutdown)
+        with mock.patch.object(queue, 'broker', broker), self.captureOnCommitCallbacks(execute=True):
+            flaky.enqueue('value', key='flaky')
+            flaky.enqueue('again', key='flaky')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(attempts, ['value'] * 3)
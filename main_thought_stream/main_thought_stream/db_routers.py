@@ -0,0 +1,115 @@
+"""
+Read replicas for the public read views.
+
+Views that opt in with ReplicaReadMixin run their queries on one of the
+DATABASE_REPLICAS aliases, picked at random per request; everything else,
+including every write, stays on the primary. Replicas lag behind the primary, so
+after a successful write ReadYourWritesMiddleware sets a cookie that keeps that
+client's reads on the primary for READ_YOUR_WRITES_SECONDS.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_COOKIE = 'read_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Replica alias the current request reads from, if any
+current_replica = ContextVar('current_replica', default=None)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def pinned_to_primary(request):
+    """
+    Whether the client wrote recently enough that replicas may not have its write yet.
+    """
+    return PIN_COOKIE in request.COOKIES
+
+
+@contextmanager
+def reading_from_replica(request):
+    """
+    Route the reads made inside the block to a replica, unless there is none or
+    the client is pinned to the primary.
+    """
+    aliases = replicas()
+    if not aliases or pinned_to_primary(request):
+        yield None
+        return
+    token = current_replica.set(random.choice(aliases))
+    try:
+        yield current_replica.get()
+    finally:
+        current_replica.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return current_replica.get()
+
+    def db_for_write(self, model, **hints):
+        # Explicit, or Django would save an object back to the replica it came from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Read from a replica for the whole of a GET request, for sync (DRF) and async
+    views alike.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return super().dispatch(request, *args, **kwargs)
+        if self.view_is_async:
+            return self.adispatch(request, *args, **kwargs)
+        with reading_from_replica(request):
+            return super().dispatch(request, *args, **kwargs)
+
+    async def adispatch(self, request, *args, **kwargs):
+        with reading_from_replica(request):
+            return await super().dispatch(request, *args, **kwargs)
+
+
+class ReadYourWritesMiddleware:
+    """
+    Pin clients to the primary for READ_YOUR_WRITES_SECONDS after each successful
+    write request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.pin(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.pin(request, await self.get_response(request))
+
+    def pin(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400 and replicas():
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=getattr(settings, 'READ_YOUR_WRITES_SECONDS', 5),
+                httponly=True, samesite='Lax',
+            )
+        return response
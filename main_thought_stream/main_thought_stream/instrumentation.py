@@ -0,0 +1,367 @@
+"""
+Per-request performance instrumentation.
+
+InstrumentationMiddleware records, for every request, the wall time, the number and
+total time of database queries, the time spent serializing the response (building
+list representations in post.rows and rendering JSON) and the response size. Each
+request gets a Server-Timing header and one structured log record on the
+'main_thought_stream.requests' logger; per-endpoint histograms are served in the
+Prometheus text format by metrics_view.
+
+With INSTRUMENTATION['DETECT_N_PLUS_ONE'] on, queries are also grouped by SQL shape
+and any shape run N_PLUS_ONE_THRESHOLD times or more in one request is logged as a
+probable N+1.
+
+/metrics/ requires INSTRUMENTATION['METRICS_TOKEN'] as a bearer token when it is set,
+and otherwise only answers requests made directly from loopback or private addresses,
+unless INSTRUMENTATION['METRICS_PUBLIC'] is on.
+
+Metrics live in process memory, so with several worker processes each one exposes
+its own series. Other modules can add values of their own with registry.register().
+"""
+import hmac
+import ipaddress
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+logger = logging.getLogger('main_thought_stream.requests')
+
+DEFAULTS = {
+    'SERVER_TIMING': True,
+    'LOG_REQUESTS': False,
+    'DETECT_N_PLUS_ONE': False,
+    'N_PLUS_ONE_THRESHOLD': 5,
+    # When set, /metrics/ requires "Authorization: Bearer <token>"
+    'METRICS_TOKEN': None,
+    # Without a token, /metrics/ only answers loopback and private addresses unless this is on
+    'METRICS_PUBLIC': False,
+}
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Collapses IN lists of any length so they count as one shape
+IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+
+current_metrics = ContextVar('request_metrics', default=None)
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'INSTRUMENTATION', {})}
+
+
+class RequestMetrics:
+    def __init__(self, track_shapes=False):
+        self.started = time.perf_counter()
+        self.duration = None
+        self.query_count = 0
+        self.query_time = 0.0
+        self.timings = Counter()
+        self.shapes = Counter() if track_shapes else None
+
+    def add_query(self, sql, duration):
+        self.query_count += 1
+        self.query_time += duration
+        if self.shapes is not None:
+            self.shapes[IN_LIST_RE.sub('IN (...)', sql)] += 1
+
+    def add_time(self, name, duration):
+        self.timings[name] += duration
+
+    def repeated_queries(self, threshold):
+        if self.shapes is None:
+            return []
+        return [(sql, count) for sql, count in self.shapes.most_common() if count >= threshold]
+
+
+@contextmanager
+def measure(name):
+    """
+    Add the time spent in the block to the current request's `name` timing.
+    """
+    metrics = current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - started)
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - started)
+
+
+def install_query_recorder(connection, **kwargs):
+    # Connections are per thread, so this runs for every connection that is opened
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    if extra:
+        labels = f'{labels},{extra}' if labels else extra
+    return f'{{{labels}}}' if labels else ''
+
+
+class CounterMetric:
+    type = 'counter'
+
+    def __init__(self, name, help_text, labels):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.series = Counter()
+
+    def inc(self, values, amount=1):
+        self.series[values] += amount
+
+    def expose(self):
+        for values, total in sorted(self.series.items()):
+            yield f'{self.name}{format_labels(self.labels, values)} {total}'
+
+
+class HistogramMetric:
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, labels, buckets
+        # Label values -> [per-bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, values, amount):
+        series = self.series.setdefault(values, [0] * (len(self.buckets) + 1) + [0.0])
+        for index, bound in enumerate(self.buckets):
+            if amount <= bound:
+                series[index] += 1
+        series[-2] += 1
+        series[-1] += amount
+
+    def expose(self):
+        for values, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                labels = format_labels(self.labels, values, 'le="%s"' % bound)
+                yield f'{self.name}_bucket{labels} {count}'
+            yield f'{self.name}_sum{format_labels(self.labels, values)} {series[-1]}'
+            yield f'{self.name}_count{format_labels(self.labels, values)} {series[-2]}'
+
+
+class CallbackMetric:
+    """
+    One unlabelled value read from `func` whenever the metrics are exposed, for state
+    kept elsewhere such as a cache's counters.
+    """
+
+    def __init__(self, name, help_text, type, func):
+        self.name, self.help_text, self.type, self.func = name, help_text, type, func
+
+    def expose(self):
+        yield f'{self.name} {self.func()}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        endpoint = ('method', 'endpoint')
+        self.requests = CounterMetric('http_requests_total', 'Requests handled.', endpoint + ('status',))
+        self.duration = HistogramMetric(
+            'http_request_duration_seconds', 'Wall time per request.', endpoint, DURATION_BUCKETS)
+        self.db_duration = HistogramMetric(
+            'http_request_db_duration_seconds', 'Database time per request.', endpoint, DURATION_BUCKETS)
+        self.db_queries = HistogramMetric(
+            'http_request_db_queries', 'Database queries per request.', endpoint, QUERY_BUCKETS)
+        self.serialize_duration = HistogramMetric(
+            'http_request_serialize_duration_seconds', 'Serialization time per request.', endpoint, DURATION_BUCKETS)
+        self.response_size = HistogramMetric(
+            'http_response_size_bytes', 'Response body size.', endpoint, SIZE_BUCKETS)
+        self.n_plus_one = CounterMetric(
+            'http_request_n_plus_one_total', 'Requests that repeated one query shape past the threshold.', endpoint)
+        self.metrics = [
+            self.requests, self.duration, self.db_duration, self.db_queries, self.serialize_duration,
+            self.response_size, self.n_plus_one,
+        ]
+        # Registered by the modules owning the values; clear() leaves them alone
+        self.callbacks = []
+
+    def register(self, name, help_text, type, func):
+        with self.lock:
+            self.callbacks.append(CallbackMetric(name, help_text, type, func))
+
+    def observe(self, method, endpoint, status, metrics, size, flagged):
+        labels = (method, endpoint)
+        with self.lock:
+            self.requests.inc(labels + (str(status),))
+            self.duration.observe(labels, metrics.duration)
+            self.db_duration.observe(labels, metrics.query_time)
+            self.db_queries.observe(labels, metrics.query_count)
+            self.serialize_duration.observe(labels, metrics.timings['serialize'])
+            if size is not None:
+                self.response_size.observe(labels, size)
+            if flagged:
+                self.n_plus_one.inc(labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics + self.callbacks:
+                lines.append(f'# HELP {metric.name} {metric.help_text}')
+                lines.append(f'# TYPE {metric.name} {metric.type}')
+                lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            for metric in self.metrics:
+                metric.series.clear()
+
+
+registry = MetricsRegistry()
+
+
+def endpoint_name(request):
+    # URL names keep the label set small, unlike raw paths with ids in them
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+def server_timing(metrics):
+    entries = [
+        f'db;dur={metrics.query_time * 1000:.2f};desc="{metrics.query_count} queries"',
+        f'serialize;dur={metrics.timings["serialize"] * 1000:.2f}',
+        f'total;dur={metrics.duration * 1000:.2f}',
+    ]
+    return ', '.join(entries)
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        # Connections opened before this module was imported missed connection_created
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        options = config()
+        metrics = RequestMetrics(track_shapes=options['DETECT_N_PLUS_ONE'])
+        token = current_metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        self.finish(request, response, metrics, options)
+        return response
+
+    async def __acall__(self, request):
+        options = config()
+        metrics = RequestMetrics(track_shapes=options['DETECT_N_PLUS_ONE'])
+        token = current_metrics.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        self.finish(request, response, metrics, options)
+        return response
+
+    def finish(self, request, response, metrics, options):
+        metrics.duration = time.perf_counter() - metrics.started
+        size = None if response.streaming else len(response.content)
+        endpoint = endpoint_name(request)
+        repeated = metrics.repeated_queries(options['N_PLUS_ONE_THRESHOLD'])
+        registry.observe(request.method, endpoint, response.status_code, metrics, size, bool(repeated))
+
+        if options['SERVER_TIMING']:
+            response['Server-Timing'] = server_timing(metrics)
+        if options['LOG_REQUESTS']:
+            record = {
+                'method': request.method,
+                'path': request.path,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'duration_ms': round(metrics.duration * 1000, 2),
+                'db_queries': metrics.query_count,
+                'db_ms': round(metrics.query_time * 1000, 2),
+                'serialize_ms': round(metrics.timings['serialize'] * 1000, 2),
+                'response_bytes': size,
+            }
+            logger.info('%s %s %s', request.method, request.path, response.status_code, extra={'request': record})
+        for sql, count in repeated:
+            logger.warning('Possible N+1 on %s: %d queries shaped %s', endpoint, count, sql,
+                           extra={'request': {'endpoint': endpoint, 'repeated_query': sql, 'count': count}})
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record, with the fields passed as extra={'request': {...}}.
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'request', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def is_internal(request):
+    # Requests relayed by a proxy come from its internal address but carry X-Forwarded-For
+    if 'X-Forwarded-For' in request.headers:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+
+def metrics_view(request):
+    options = config()
+    token = options['METRICS_TOKEN']
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return HttpResponse(status=401)
+    elif not options['METRICS_PUBLIC'] and not is_internal(request):
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
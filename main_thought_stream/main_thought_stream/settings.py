@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'rest_framework.authtoken', 
     'user',
     'post',
+    'jobs',
     'corsheaders',
 ]
 
@@ -62,8 +63,18 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
 }
 
+# How CustomJWTAuthentication resolves the user of a token: 'database', 'cache' or 'claims'
+JWT_USER_RESOLUTION = 'cache'
+JWT_USER_CACHE = {
+    'MAX_SIZE': 1024,
+    'TTL': 60,  # seconds
+}
+
 MIDDLEWARE = [
+    # Outermost, so its timings cover every other middleware too
+    'main_thought_stream.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'main_thought_stream.db_routers.ReadYourWritesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -97,7 +108,52 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'post.authentication.CustomJWTAuthentication',
-    ]
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'post.renderers.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    # Reverse proxies in front of the app that append to X-Forwarded-For. With 0 the
+    # header is ignored and throttles count the socket address, so clients cannot
+    # pick their own address by sending the header
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
+    # Token-bucket rates for main_thought_stream.throttling, as "<throttle_scope>.<kind>"
+    'DEFAULT_THROTTLE_RATES': {
+        'login.ip': '20/min',
+        'login.username': '5/min',
+        'register.ip': '10/hour',
+        'post.ip': '60/min',
+        'post.user': '10/min',
+        'comment.ip': '120/min',
+        'comment.user': '30/min',
+    },
+}
+
+# Per-request timings, see main_thought_stream.instrumentation
+INSTRUMENTATION = {
+    'SERVER_TIMING': True,
+    # One JSON log line per request, e.g. LOG_REQUESTS=1; off by default as it is chatty
+    'LOG_REQUESTS': bool(os.environ.get('LOG_REQUESTS')),
+    # Log requests that run one SQL shape N_PLUS_ONE_THRESHOLD times or more
+    'DETECT_N_PLUS_ONE': DEBUG,
+    'N_PLUS_ONE_THRESHOLD': 5,
+    # Without a token /metrics/ only answers internal addresses, unless METRICS_PUBLIC is on
+    'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+    'METRICS_PUBLIC': False,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'main_thought_stream.instrumentation.JSONFormatter'},
+    },
+    'handlers': {
+        'requests': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'main_thought_stream.requests': {'handlers': ['requests'], 'level': 'INFO', 'propagate': False},
+    },
 }
 
 WSGI_APPLICATION = 'main_thought_stream.wsgi.application'
@@ -115,9 +171,95 @@ DATABASES = {
         'PASSWORD': '12345',                # PostgreSQL password for user 'ashu'
         'HOST': 'localhost',                        # Database host (use 'localhost' for local database)
         'PORT': '5432',                             # Default PostgreSQL port
+        # Keep connections open between requests, checking them before reuse. Not by
+        # default under ASGI (main_thought_stream.asgi): each request runs its queries
+        # in a context of its own, so kept connections are never reused and pile up
+        # until the database refuses more. Set DATABASE_POOL there to reuse them instead.
+        'CONN_MAX_AGE': int(os.environ.get(
+            'DATABASE_CONN_MAX_AGE', 0 if os.environ.get('DJANGO_SERVER_INTERFACE') == 'asgi' else 60,
+        )),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# With psycopg 3 and DATABASE_POOL set, use a connection pool per worker instead;
+# Django does not allow persistent connections together with a pool
+if os.environ.get('DATABASE_POOL'):
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {'pool': {'min_size': 2, 'max_size': 10}}
+
+# Read replicas of the primary, e.g. DATABASE_REPLICA_HOSTS=replica1.internal,replica2.internal.
+# Only views with main_thought_stream.db_routers.ReplicaReadMixin read from them.
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{_index}'] = {
+        **DATABASES['default'],
+        'HOST': _host.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{_index}')
+
+DATABASE_ROUTERS = ['main_thought_stream.db_routers.ReplicaRouter']
+
+# How long a client's reads stay on the primary after it writes, in seconds; should
+# exceed the usual replication lag
+READ_YOUR_WRITES_SECONDS = 5
+
+
+# Optional Redis server shared by all workers, e.g. redis://localhost:6379/0
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Local memory by default; set REDIS_URL to share cached responses between workers
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Cache used for the serialized responses of the public post and comment views
+RESPONSE_CACHE_ALIAS = 'default'
+RESPONSE_CACHE_TIMEOUT = 300  # seconds
+
+# Fan-out of live comment events: 'memory' reaches subscribers of the same process
+# only, 'redis' relays them between all ASGI workers
+COMMENT_STREAM_BROKER = 'redis' if REDIS_URL else 'memory'
+# Undelivered events after which a slow stream client is disconnected
+COMMENT_STREAM_MAX_PENDING = 100
+
+# Where throttle buckets are kept; 'redis' shares them between workers
+THROTTLE_STORE = 'redis' if REDIS_URL else 'memory'
+
+# Largest number of items accepted by the batch post and comment endpoints
+BULK_WRITE_MAX_ITEMS = 500
+
+# Background jobs run after writes commit, see jobs.queue. BROKER 'local' runs them
+# on threads of the process that enqueued them; 'database' stores them for
+# `manage.py run_jobs` workers, which survive restarts and scale separately
+JOBS = {
+    'BROKER': os.environ.get('JOBS_BROKER', 'local'),
+    # Threads of the local broker, and the default of run_jobs --concurrency
+    'CONCURRENCY': 4,
+    'MAX_ATTEMPTS': 5,
+    # Seconds before the first retry, doubling after each failed attempt up to MAX_BACKOFF
+    'BACKOFF': 2,
+    'MAX_BACKOFF': 600,
+    # Seconds a worker may hold a job before it is assumed dead and the job is rerun
+    'LEASE': 300,
+    # Seconds finished jobs, and so their idempotency keys, are kept
+    'KEEP_FINISHED': 86400,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -138,6 +280,37 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing
+# https://docs.djangoproject.com/en/5.0/topics/auth/passwords/
+# PASSWORD_HASHER picks the hasher for new passwords: 'pbkdf2', 'argon2' (needs
+# argon2-cffi) or 'bcrypt' (needs bcrypt). Passwords stored with another listed
+# hasher, or another cost, are rehashed with it at their next login.
+
+PASSWORD_HASHER = os.environ.get('PASSWORD_HASHER', 'pbkdf2')
+_PASSWORD_HASHERS = {
+    'pbkdf2': 'user.hashers.PBKDF2PasswordHasher',
+    'argon2': 'user.hashers.Argon2PasswordHasher',
+    'bcrypt': 'user.hashers.BCryptSHA256PasswordHasher',
+}
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[PASSWORD_HASHER]] + [
+    path for name, path in _PASSWORD_HASHERS.items() if name != PASSWORD_HASHER
+] + [
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+# Costs of user.hashers; None keeps Django's default. WORKERS sizes the pool async
+# logins hash on (None: one thread per core)
+PASSWORD_HASHING = {
+    'PBKDF2_ITERATIONS': None,
+    'ARGON2_TIME_COST': None,
+    'ARGON2_MEMORY_COST': None,
+    'ARGON2_PARALLELISM': None,
+    'BCRYPT_ROUNDS': None,
+    'WORKERS': None,
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
 
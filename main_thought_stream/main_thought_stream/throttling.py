@@ -0,0 +1,231 @@
+"""
+Token-bucket throttles for the write and authentication endpoints.
+
+Views name a throttle_scope and list the throttles they use; the rates come from
+REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] under "<scope>.<kind>", in DRF's
+"10/min" format, e.g. 'login.ip' and 'login.username'. A bucket holds up to that
+many tokens and refills at that rate, so a client may burst up to the whole
+allowance and is then held to the average. Scopes without a rate are not throttled.
+A view can charge more than one token for a request with get_throttle_cost(), e.g.
+one per item of a batch write.
+
+Buckets live in process memory, or in Redis (or anything speaking its protocol)
+when THROTTLE_STORE is 'redis', so that every worker shares them. Either way a
+request costs one bucket update: a dict under a lock, or one EVALSHA round trip.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Takes tokens from the bucket in KEYS[1] on Redis' own clock. ARGV: capacity,
+# tokens added per second, tokens to take. Returns whether they were taken and the
+# tokens left.
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * refill_rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / refill_rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+def parse_rate(rate):
+    """
+    (capacity, tokens per second) of a rate like '10/min'.
+    """
+    count, period = rate.split('/')
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period[0]]
+
+
+def retry_after(tokens, refill_rate, cost=1):
+    return (cost - tokens) / refill_rate
+
+
+class MemoryBucketStore:
+    """
+    Buckets in a bounded LRU. Dropping a bucket only hands its client a full one,
+    and the least recently used buckets are almost always full already.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate, cost=1):
+        """
+        Take `cost` tokens from the bucket. Returns (allowed, seconds until they are free).
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else retry_after(tokens, refill_rate, cost)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBucketStore:
+    """
+    Buckets in Redis hashes, updated atomically by TAKE_SCRIPT. Keys expire once the
+    bucket would be full again.
+    """
+
+    def __init__(self, url, prefix='throttle:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, capacity, refill_rate, cost=1):
+        allowed, tokens = self.script(keys=[self.prefix + key], args=[capacity, refill_rate, cost])
+        if allowed:
+            return True, 0
+        return False, retry_after(float(tokens), refill_rate, cost)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def create_bucket_store():
+    if getattr(settings, 'THROTTLE_STORE', 'memory') == 'redis':
+        return RedisBucketStore(settings.REDIS_URL)
+    return MemoryBucketStore(max_size=getattr(settings, 'THROTTLE_MEMORY_MAX_BUCKETS', 100000))
+
+
+bucket_store = create_bucket_store()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Base for the token-bucket throttles. Subclasses name their `kind` and say who a
+    request is counted against with get_ident_key(); None means it is not counted.
+    """
+    kind = None
+
+    def __init__(self):
+        self.wait_time = None
+
+    def get_ident_key(self, request, view):
+        raise NotImplementedError('TokenBucketThrottle requires get_ident_key()')
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(f'{scope}.{self.kind}') if scope else None
+        if rate is None:
+            return True
+        ident = self.get_ident_key(request, view)
+        if ident is None:
+            return True
+        capacity, refill_rate = parse_rate(rate)
+        cost = view.get_throttle_cost(request) if hasattr(view, 'get_throttle_cost') else 1
+        if cost > capacity:
+            # A rate of 0 closes the scope, and a request costing more than a full bucket never gets through
+            self.wait_time = None
+            return False
+        allowed, self.wait_time = bucket_store.take(f'{scope}:{self.kind}:{ident}', capacity, refill_rate, cost)
+        return allowed
+
+    def wait(self):
+        return math.ceil(self.wait_time) if self.wait_time else None
+
+
+class IPThrottle(TokenBucketThrottle):
+    """
+    Counts requests per client address; X-Forwarded-For is trusted as far as
+    REST_FRAMEWORK['NUM_PROXIES'] says.
+    """
+    kind = 'ip'
+
+    def get_ident_key(self, request, view):
+        return self.get_ident(request)
+
+
+class UserThrottle(TokenBucketThrottle):
+    """
+    Counts the requests of each authenticated user. Authenticates the request if
+    nothing has yet.
+    """
+    kind = 'user'
+
+    def get_ident_key(self, request, view):
+        return request.user.pk if request.user.is_authenticated else None
+
+
+class UsernameThrottle(TokenBucketThrottle):
+    """
+    Counts login attempts per username, however many addresses they come from.
+    Views outside DRF put the parsed body in request.data themselves.
+    """
+    kind = 'username'
+
+    def get_ident_key(self, request, view):
+        data = getattr(request, 'data', None)
+        username = data.get('username') if hasattr(data, 'get') else None
+        if not isinstance(username, str) or not username:
+            return None
+        return username.lower()
+
+
+def first_rejection(throttles, request, view):
+    """
+    The first of `throttles` that rejects the request, or None. Later throttles are
+    not consulted, so they spend no tokens.
+    """
+    for throttle in throttles:
+        if not throttle.allow_request(request, view):
+            return throttle
+    return None
+
+
+class ThrottleFirstMixin:
+    """
+    Check throttles before authentication rather than after it, as APIView does, and
+    stop at the first one that rejects the request. Rejecting a client by address
+    then costs no password hash (BasicAuthentication) or token check, and per-user
+    throttles only authenticate requests that got past the others.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        self.check_throttles(request)
+        self.throttles_checked = True
+        super().initial(request, *args, **kwargs)
+
+    def check_throttles(self, request):
+        if getattr(self, 'throttles_checked', False):
+            return
+        throttle = first_rejection(self.get_throttles(), request, self)
+        if throttle is not None:
+            self.throttled(request, throttle.wait())
@@ -3,10 +3,13 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from .instrumentation import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),  # Admin panel route
     path('user/', include('user.urls')),
-    path('post/',include('post.urls'))
+    path('post/',include('post.urls')),
+    path('metrics/', metrics_view, name='metrics'),  # Prometheus scrape endpoint
 ]
 
 if settings.DEBUG:
@@ -0,0 +1,85 @@
+"""
+Async-native read views for deployments served through main_thought_stream.asgi.
+
+DRF's APIView is sync only, so under ASGI every request to PostView or
+PostCommentsView is handed to a worker thread that then blocks on the database.
+These views produce the same JSON with Django's async ORM instead and never leave
+the event loop.
+"""
+import asyncio
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework.exceptions import APIException
+
+from main_thought_stream.db_routers import ReplicaReadMixin
+
+from .broker import broker, comments_channel
+from .comment_tree import aload_comment_tree
+from .fieldsets import parse_fields, post_values
+from .pagination import FeedCursorPagination
+from .renderers import FastJSONRenderer
+from .rows import post_representations
+from .views import non_negative_int_param
+
+def json_response(data, status=200):
+    # Same bytes as DRF's JSONRenderer
+    return HttpResponse(FastJSONRenderer().render(data), content_type='application/json', status=status)
+
+
+def error_response(exc):
+    return json_response(exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}, status=exc.status_code)
+
+
+class AsyncPostView(ReplicaReadMixin, View):
+    async def get(self, request):
+        paginator = FeedCursorPagination()
+        try:
+            fields = parse_fields(request.GET)
+            rows = await paginator.apaginate_queryset(post_values(fields), request)
+        except APIException as exc:
+            return error_response(exc)
+        data = post_representations(rows, fields, request)
+        return json_response(paginator.get_paginated_data(data))
+
+
+class AsyncPostCommentsView(ReplicaReadMixin, View):
+    async def get(self, request, post_id):
+        try:
+            max_depth = non_negative_int_param(request.GET, 'max_depth')
+            reply_limit = non_negative_int_param(request.GET, 'reply_limit')
+        except APIException as exc:
+            return error_response(exc)
+        tree = await aload_comment_tree(post_id, max_depth=max_depth, reply_limit=reply_limit)
+        return json_response(tree)
+
+
+class CommentStreamView(View):
+    """
+    Server-Sent Events stream of comment.created, comment.updated and
+    comment.deleted events for one post, so clients stop polling the whole thread.
+    Needs ASGI: under WSGI every open stream would hold a worker thread.
+    """
+    heartbeat_interval = 15
+
+    async def get(self, request, post_id):
+        subscription = broker.subscribe(comments_channel(post_id))
+        response = StreamingHttpResponse(self.stream(subscription), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop reverse proxies from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream(self, subscription):
+        try:
+            yield 'retry: 3000\n\n'
+            while not subscription.overflowed:
+                try:
+                    event = await subscription.get(timeout=self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    # Keeps idle connections from being closed by proxies
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {event['data']}\n\n"
+        finally:
+            subscription.close()
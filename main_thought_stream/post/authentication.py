@@ -1,11 +1,91 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
 from django.contrib.auth.models import User  # Assuming you're using the default User model
 from rest_framework import status
 
+from main_thought_stream.instrumentation import registry
+
+
+class UserCache:
+    """
+    Bounded, thread-safe LRU of users keyed by id. Entries expire `ttl` seconds after
+    they were stored, and are dropped early when the user is saved or deleted.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+        # Hand out a copy so one request cannot leak attribute changes into another
+        return copy.copy(entry[0])
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._entries[user_id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+_cache_settings = getattr(settings, 'JWT_USER_CACHE', {})
+user_cache = UserCache(
+    max_size=_cache_settings.get('MAX_SIZE', 1024),
+    ttl=_cache_settings.get('TTL', 60),
+)
+registry.register('jwt_user_cache_hits_total', 'Users served from the JWT user cache.', 'counter',
+                  lambda: user_cache.stats()['hits'])
+registry.register('jwt_user_cache_misses_total', 'JWT user cache lookups that went to the database.', 'counter',
+                  lambda: user_cache.stats()['misses'])
+registry.register('jwt_user_cache_entries', 'Users held in the JWT user cache.', 'gauge',
+                  lambda: user_cache.stats()['size'])
+
+
 class CustomJWTAuthentication(BaseAuthentication):
+    """
+    Bearer JWT authentication. How the token's user is resolved depends on the
+    JWT_USER_RESOLUTION setting:
+
+    - 'database': look the user up on every request
+    - 'cache': serve users from the in-process user_cache, falling back to the database
+    - 'claims': build a TokenUser from the token alone, without touching the database.
+      Deleted or deactivated users keep access until their token expires.
+    """
     Bearer_Prefix = 'Bearer'
 
     def authenticate(self, request):
@@ -35,11 +115,26 @@ class CustomJWTAuthentication(BaseAuthentication):
         if user_id is None:
             raise AuthenticationFailed('Token does not contain a valid user ID.')
 
+        user = self.get_user(access_token, user_id)
+        request.user = user
+        
+        return (user, None)
+
+    def get_user(self, access_token, user_id):
+        mode = getattr(settings, 'JWT_USER_RESOLUTION', 'cache')
+        if mode == 'claims':
+            return TokenUser(access_token)
+
+        if mode == 'cache':
+            user = user_cache.get(user_id)
+            if user is not None:
+                return user
+
         try:
             user = User.objects.get(id=user_id)
         except User.DoesNotExist:
             raise AuthenticationFailed('User not found.')
 
-        request.user = user
-        
-        return (user, None)
+        if mode == 'cache':
+            user_cache.set(user_id, user)
+        return user
@@ -0,0 +1,181 @@
+"""
+Fan-out of comment events to the clients streaming a post's thread.
+
+Subscribers are asyncio queues living on the ASGI event loop; publishers are the sync
+write views running on worker threads, so every hand-over goes through
+loop.call_soon_threadsafe. The in-process broker only reaches subscribers of the
+same process; RedisBroker relays events between processes over Redis pub/sub, with
+one Redis subscription per process rather than per client.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework.utils.encoders import JSONEncoder
+
+logger = logging.getLogger(__name__)
+
+
+def comments_channel(post_id):
+    return f'post:{post_id}:comments'
+
+
+class Subscription:
+    """
+    A client's view of one channel. Events beyond `max_pending` undelivered ones
+    mean the client is not keeping up; it is then closed instead of buffering
+    without bound.
+    """
+
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.broker.unsubscribe(self)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        """
+        Subscribe from inside the event loop that will consume the events.
+        """
+        subscription = Subscription(self, channel, self.max_pending)
+        with self.lock:
+            self.subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.channel]
+
+    def subscriber_count(self, channel):
+        with self.lock:
+            return len(self.subscribers.get(channel, ()))
+
+    def publish(self, channel, event):
+        """
+        Deliver `event` to every subscriber of `channel`. Safe to call from any thread.
+        """
+        self.fan_out(channel, event)
+
+    def fan_out(self, channel, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        # One wake-up per event loop instead of one per subscriber
+        by_loop = defaultdict(list)
+        for subscription in subscribers:
+            by_loop[subscription.loop].append(subscription)
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(deliver_all, subscriptions, event)
+            except RuntimeError:
+                # The subscribers' loop has shut down
+                for subscription in subscriptions:
+                    self.unsubscribe(subscription)
+
+
+def deliver_all(subscriptions, event):
+    for subscription in subscriptions:
+        subscription.deliver(event)
+
+
+class RedisBroker(InProcessBroker):
+    # Seconds before resubscribing after the Redis connection drops, doubling per
+    # failed attempt up to the cap
+    reconnect_delay = 0.5
+    max_reconnect_delay = 30
+
+    def __init__(self, url, max_pending=100):
+        super().__init__(max_pending)
+        import redis
+
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+        self.listener = None
+
+    def subscribe(self, channel):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.get_running_loop().create_task(self.listen())
+        return super().subscribe(channel)
+
+    def publish(self, channel, event):
+        self.client.publish(channel, json.dumps(event))
+
+    def connect(self):
+        import redis.asyncio
+
+        return redis.asyncio.Redis.from_url(self.url)
+
+    async def listen(self):
+        """
+        Relay events from Redis to this process's subscribers. A dropped connection is
+        retried with backoff rather than ending the listener, which only a new subscriber
+        would restart; events published while disconnected are missed.
+        """
+        delay = self.reconnect_delay
+        while True:
+            client = self.connect()
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(comments_channel('*'))
+                delay = self.reconnect_delay
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.fan_out(message['channel'].decode(), json.loads(message['data']))
+            except Exception:
+                logger.exception('Lost the Redis comment stream subscription, retrying in %ss', delay)
+            finally:
+                # Closing a broken connection can fail as well
+                with contextlib.suppress(Exception):
+                    await pubsub.aclose()
+                    await client.aclose()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+
+def publish_comment_event(post_id, event_type, comment):
+    """
+    Broadcast a comment event to the post's stream once the current transaction has
+    committed, so subscribers never see a write that is rolled back.
+    """
+    # Encoded once here rather than once per subscriber
+    event = {'type': event_type, 'data': json.dumps(comment, cls=JSONEncoder, separators=(',', ':'))}
+    transaction.on_commit(lambda: broker.publish(comments_channel(post_id), event))
+
+
+def create_broker():
+    max_pending = getattr(settings, 'COMMENT_STREAM_MAX_PENDING', 100)
+    if getattr(settings, 'COMMENT_STREAM_BROKER', 'memory') == 'redis':
+        return RedisBroker(settings.REDIS_URL, max_pending=max_pending)
+    return InProcessBroker(max_pending=max_pending)
+
+
+broker = create_broker()
@@ -0,0 +1,251 @@
+"""
+Batch creation of posts and comments for import jobs and offline-sync clients.
+
+A batch is validated item by item; the valid items are then inserted together with
+bulk_create in one transaction and invalid ones are reported without being written.
+bulk_create sends no save signals, so everything the single-object views do after a
+save (thread positions, counters, search indexing, events, cache invalidation) is
+done here once per batch.
+"""
+import uuid
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+
+from . import notifications, search
+from .broker import publish_comment_event
+from .cache import invalidate_comments, invalidate_feed
+from .counters import comments_added
+from .images import schedule_variants
+from .models import Comment, ImageUpload, Post
+from .serializers import BulkCommentSerializer, FlatCommentSerializer, PostSerializer
+from .timeline import schedule_fan_out
+from .uploads import UploadConflict, attach_upload
+
+MAX_ITEMS = getattr(settings, 'BULK_WRITE_MAX_ITEMS', 500)
+# Rows per INSERT statement
+BATCH_SIZE = 500
+
+
+def batch_items(data):
+    if not isinstance(data, list):
+        raise ValidationError({'detail': 'Expected a list of items.'})
+    if not data:
+        raise ValidationError({'detail': 'The batch is empty.'})
+    if len(data) > MAX_ITEMS:
+        raise ValidationError({'detail': f'A batch holds at most {MAX_ITEMS} items.'})
+    return data
+
+
+def created(data, **extra):
+    return {**extra, 'status': status.HTTP_201_CREATED, 'data': data}
+
+
+def failed(errors, **extra):
+    return {**extra, 'status': status.HTTP_400_BAD_REQUEST, 'errors': errors}
+
+
+def batch_response_data(results):
+    """
+    Body and status code for a batch: 201 when every item was created, 400 when none
+    was and 207 otherwise.
+    """
+    count = sum(result['status'] == status.HTTP_201_CREATED for result in results)
+    if count == len(results):
+        code = status.HTTP_201_CREATED
+    elif count == 0:
+        code = status.HTTP_400_BAD_REQUEST
+    else:
+        code = status.HTTP_207_MULTI_STATUS
+    return {'created': count, 'failed': len(results) - count, 'results': results}, code
+
+
+def referenced_upload_ids(items):
+    ids = set()
+    for item in items:
+        try:
+            ids.add(uuid.UUID(str(item['upload_id'])))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return ids
+
+
+def create_posts(request, items):
+    """
+    Create the posts described by `items`, authored by the requesting user. Images
+    come from completed chunked uploads given as `upload_id`. Returns one result per
+    item, in order.
+    """
+    user = request.user
+    uploads = ImageUpload.objects.filter(
+        id__in=referenced_upload_ids(items), user_id=user.id, status=ImageUpload.COMPLETE,
+    ).in_bulk()
+    context = {'request': request, 'uploads': uploads}
+
+    results = [None] * len(items)
+    pending = []
+    used_uploads = set()
+    for index, item in enumerate(items):
+        serializer = PostSerializer(data=item, context=context)
+        if not serializer.is_valid():
+            results[index] = failed(serializer.errors)
+            continue
+        upload = serializer.validated_data.get('upload_id')
+        if upload is not None:
+            if upload.pk in used_uploads:
+                results[index] = failed({'upload_id': ['Another item in this batch uses this upload.']})
+                continue
+            used_uploads.add(upload.pk)
+        pending.append((index, serializer.validated_data))
+    if not pending:
+        return results
+
+    with transaction.atomic():
+        # Checked again under lock: another request may have attached one since
+        available = set(
+            ImageUpload.objects.select_for_update()
+            .filter(pk__in=used_uploads, status=ImageUpload.COMPLETE).values_list('pk', flat=True)
+        )
+        posts = []
+        creating = []
+        for index, data in pending:
+            upload = data.pop('upload_id', None)
+            if upload is not None and upload.pk not in available:
+                results[index] = failed({'upload_id': ['No completed upload with this id.']})
+                continue
+            post = Post(author_id=user.id, **data)
+            if upload is not None:
+                attach_upload(upload, post, save=False)
+            posts.append(post)
+            creating.append((index, data))
+        if not posts:
+            return results
+        Post.objects.bulk_create(posts, batch_size=BATCH_SIZE)
+        attached = ImageUpload.objects.filter(pk__in=available, status=ImageUpload.COMPLETE).update(
+            status=ImageUpload.ATTACHED, updated_at=timezone.now(),
+        )
+        # Only possible where rows cannot be locked; nothing of the batch is kept
+        if attached != len(available):
+            raise UploadConflict('An upload of this batch was attached by another request.')
+        search.index_posts(posts)
+        schedule_variants(*posts)
+        schedule_fan_out(*[post.pk for post in posts])
+    invalidate_feed()
+
+    # Read back with the authors joined in, for the nested author field
+    saved = Post.objects.select_related('author').in_bulk([post.pk for post in posts])
+    data = PostSerializer([saved[post.pk] for post in posts], many=True, context={'request': request}).data
+    for (index, _), post_data in zip(creating, data):
+        results[index] = created(post_data)
+    return results
+
+
+def create_comments(request, items):
+    """
+    Create the comments described by `items` as the requesting user. An item replies
+    either to an existing comment (`parent_comment`) or to an earlier item of the
+    batch (`parent_ref`). Returns one result per item, in order, echoing its `ref`.
+    """
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        serializer = BulkCommentSerializer(data=item)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            ref = item.get('ref') if isinstance(item, dict) else None
+            results[index] = failed(serializer.errors, ref=ref)
+
+    # Every referenced post and existing parent, in two queries for the whole batch
+    post_ids = set(Post.objects.filter(pk__in={data['post'] for _, data in valid}).values_list('pk', flat=True))
+    parents = Comment.objects.live().only('id', 'post_id', 'path', 'depth').in_bulk(
+        {data['parent_comment'] for _, data in valid if data.get('parent_comment')}
+    )
+
+    # Replies to items of the batch are inserted a level after their parent, once it has an id
+    levels = defaultdict(list)
+    new_refs = {}
+    failed_refs = set()
+    for index, data in valid:
+        ref = data.get('ref')
+        errors = {}
+        parent = None
+        level = 0
+        depth = 0
+        if ref is not None and (ref in new_refs or ref in failed_refs):
+            errors['ref'] = ['Another item in this batch has this ref.']
+        if data['post'] not in post_ids:
+            errors['post'] = ['Post not found.']
+        if data.get('parent_comment'):
+            parent = parents.get(data['parent_comment'])
+            if parent is None or parent.post_id != data['post']:
+                errors['parent_comment'] = ['Parent comment not found.']
+            else:
+                depth = parent.depth + 1
+        elif data.get('parent_ref') is not None:
+            parent_ref = data['parent_ref']
+            if parent_ref in new_refs:
+                parent, parent_level, parent_depth = new_refs[parent_ref]
+                level, depth = parent_level + 1, parent_depth + 1
+                if parent.post_id != data['post']:
+                    errors['parent_ref'] = ['The referenced item is on another post.']
+            elif parent_ref in failed_refs:
+                errors['parent_ref'] = ['The referenced item was not created.']
+            else:
+                errors['parent_ref'] = ['No earlier item in this batch has this ref.']
+        if depth > Comment.MAX_DEPTH:
+            field = 'parent_comment' if data.get('parent_comment') else 'parent_ref'
+            errors[field] = ['This thread is nested too deeply to reply to.']
+
+        if errors:
+            results[index] = failed(errors, ref=ref)
+            if ref is not None:
+                failed_refs.add(ref)
+            continue
+
+        comment = Comment(
+            post_id=data['post'], user_id=request.user.id, content=data['content'], parent_comment=parent,
+        )
+        if parent is not None and parent.pk is None:
+            parent.reply_count += 1
+        if ref is not None:
+            new_refs[ref] = (comment, level, depth)
+        levels[level].append((index, ref, comment))
+
+    entries = [entry for level in sorted(levels) for entry in levels[level]]
+    if not entries:
+        return results
+
+    with transaction.atomic():
+        for level in sorted(levels):
+            Comment.objects.bulk_create([comment for _, _, comment in levels[level]], batch_size=BATCH_SIZE)
+
+        # Parents come before their replies in `entries`, so their paths are already known
+        comments = [comment for _, _, comment in entries]
+        for comment in comments:
+            comment.place_in_thread(comment.parent_comment)
+        Comment.objects.bulk_update(comments, ['path', 'depth'], batch_size=BATCH_SIZE)
+
+        # Replies to comments created in this batch were counted before the insert
+        comments_added(
+            Counter(comment.post_id for comment in comments),
+            Counter(comment.parent_comment_id for comment in comments if comment.parent_comment_id in parents),
+        )
+        search.index_comments(comments)
+        notifications.replies_added(comments)
+        data = FlatCommentSerializer(comments, many=True).data
+        for comment, comment_data in zip(comments, data):
+            publish_comment_event(comment.post_id, 'comment.created', comment_data)
+
+    for post_id in {comment.post_id for comment in comments}:
+        invalidate_comments(post_id)
+    # The feed shows comment counts
+    invalidate_feed()
+
+    for (index, ref, _), comment_data in zip(entries, data):
+        results[index] = created(comment_data, ref=ref)
+    return results
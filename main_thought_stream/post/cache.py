@@ -0,0 +1,119 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.response import Response
+
+from main_thought_stream.db_routers import current_replica, pinned_to_primary
+
+FEED_NAMESPACE = 'post:feed'
+
+
+def response_cache():
+    return caches[getattr(settings, 'RESPONSE_CACHE_ALIAS', 'default')]
+
+
+def comments_namespace(post_id):
+    return f'post:{post_id}:comments'
+
+
+def get_generation(namespace):
+    """
+    Current generation of a namespace. Cached responses are stored under it, so moving
+    to a new generation invalidates all of them at once without enumerating keys.
+    """
+    cache = response_cache()
+    key = f'{namespace}:generation'
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, time.time_ns(), None)
+        generation = cache.get(key)
+    return generation
+
+
+def invalidate(namespace):
+    response_cache().set(f'{namespace}:generation', time.time_ns(), None)
+
+
+def invalidate_feed():
+    invalidate(FEED_NAMESPACE)
+
+
+def invalidate_comments(post_id):
+    invalidate(comments_namespace(post_id))
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in etags
+
+
+class CachedResponseMixin:
+    """
+    Cache the rendered body of GET responses that are the same for every caller, and
+    answer If-None-Match with 304 Not Modified.
+
+    Views name the namespace their response belongs to; writes invalidate it with
+    invalidate_feed() or invalidate_comments().
+    """
+
+    def get_cache_namespace(self):
+        raise NotImplementedError('CachedResponseMixin requires get_cache_namespace()')
+
+    def get_response_cache_key(self):
+        namespace = self.get_cache_namespace()
+        url = hashlib.md5(self.request.build_absolute_uri().encode()).hexdigest()
+        self.response_cache_generation = get_generation(namespace)
+        return f'{namespace}:{self.response_cache_generation}:{self.request.accepted_renderer.format}:{url}'
+
+    def may_be_stale(self):
+        """
+        Whether the response was read from a replica soon enough after the write that
+        started its generation for the replica not to have that write yet. Such a
+        response is served but not cached, or every reader would get it.
+        """
+        if current_replica.get() is None:
+            return False
+        lag = getattr(settings, 'READ_YOUR_WRITES_SECONDS', 5) * 1_000_000_000
+        return time.time_ns() - self.response_cache_generation < lag
+
+    def get(self, request, *args, **kwargs):
+        key = self.get_response_cache_key()
+        # A client that just wrote may not see its write in a response cached from a replica
+        cached = None if pinned_to_primary(request) else response_cache().get(key)
+        if cached is None:
+            self.response_cache_key = key
+            return super().get(request, *args, **kwargs)
+
+        content, content_type, etag = cached
+        response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+
+        key = getattr(self, 'response_cache_key', None)
+        if key is not None and isinstance(response, Response):
+            response.render()
+            response['ETag'] = quote_etag(hashlib.md5(response.content).hexdigest())
+            if not self.may_be_stale():
+                response_cache().set(
+                    key,
+                    (response.content, response['Content-Type'], response['ETag']),
+                    getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300),
+                )
+
+        if response.has_header('ETag') and etag_matches(request, response['ETag']):
+            not_modified = HttpResponseNotModified()
+            not_modified['ETag'] = response['ETag']
+            return not_modified
+        return response
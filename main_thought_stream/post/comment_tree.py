@@ -0,0 +1,63 @@
+from .models import Comment
+from .rows import acomment_representations, comment_representations
+
+
+def build_comment_tree(comments, max_depth=None, reply_limit=None):
+    """
+    Nest serialized comments under their parents in a single pass.
+
+    `comments` must be ordered so that every parent comes before its replies, which
+    created_at order guarantees. Top-level comments have depth 0; anything deeper than
+    `max_depth`, or past the first `reply_limit` replies of a comment, is dropped
+    together with its own replies.
+    """
+    nodes = {}
+    depths = {}
+    roots = []
+    for comment in comments:
+        node = dict(comment, replies=[])
+        parent_id = node['parent_comment']
+        if parent_id is None:
+            depth = 0
+            roots.append(node)
+        else:
+            parent = nodes.get(parent_id)
+            if parent is None:
+                # The parent was cut off, so is the whole branch below it
+                continue
+            depth = depths[parent_id] + 1
+            if max_depth is not None and depth > max_depth:
+                continue
+            if reply_limit is not None and len(parent['replies']) >= reply_limit:
+                continue
+            parent['replies'].append(node)
+        nodes[node['id']] = node
+        depths[node['id']] = depth
+    return roots
+
+
+def thread_queryset(post_id, max_depth=None):
+    # A deleted post's thread is gone at once, though its rows wait for the purge
+    comments = (
+        Comment.objects.visible().filter(post_id=post_id, post__deleted_at__isnull=True).order_by('created_at', 'id')
+    )
+    if max_depth is not None:
+        comments = comments.filter(depth__lte=max_depth)
+    return comments
+
+
+def load_comment_tree(post_id, max_depth=None, reply_limit=None):
+    """
+    Fetch every comment of a post with one query and return the nested thread in the
+    same shape CommentSerializer produces.
+    """
+    data = comment_representations(thread_queryset(post_id, max_depth))
+    return build_comment_tree(data, max_depth=max_depth, reply_limit=reply_limit)
+
+
+async def aload_comment_tree(post_id, max_depth=None, reply_limit=None):
+    """
+    load_comment_tree for async views, reading the thread through the async ORM.
+    """
+    data = await acomment_representations(thread_queryset(post_id, max_depth))
+    return build_comment_tree(data, max_depth=max_depth, reply_limit=reply_limit)
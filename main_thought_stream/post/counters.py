@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Comment, Post
+
+
+def comment_added(comment):
+    """
+    Count a new comment on its post and, for a reply, on its parent comment.
+    Both are single UPDATEs relative to the current value, so concurrent writers
+    never lose increments.
+    """
+    Post.objects.filter(pk=comment.post_id).update(comment_count=F('comment_count') + 1)
+    if comment.parent_comment_id:
+        Comment.objects.filter(pk=comment.parent_comment_id).update(reply_count=F('reply_count') + 1)
+
+
+def comments_added(post_counts, reply_counts):
+    """
+    comment_added for a batch: `post_counts` and `reply_counts` map post and parent
+    comment ids to how many comments were added under them. Rows gaining the same
+    amount share one UPDATE.
+    """
+    for model, field, counts in ((Post, 'comment_count', post_counts), (Comment, 'reply_count', reply_counts)):
+        by_amount = defaultdict(list)
+        for pk, amount in counts.items():
+            by_amount[amount].append(pk)
+        for amount, pks in by_amount.items():
+            model.objects.filter(pk__in=pks).update(**{field: F(field) + amount})
+
+
+def comment_deleted(post_id):
+    """
+    Uncount a soft deleted comment from its post. Placeholders left for replies are
+    not counted.
+    """
+    Post.objects.filter(pk=post_id).update(comment_count=Greatest(F('comment_count') - 1, Value(0)))
+
+
+def reply_hidden(parent_comment_id):
+    """
+    Uncount a reply from its parent once the reply no longer shows in the thread.
+    """
+    Comment.objects.filter(pk=parent_comment_id).update(reply_count=Greatest(F('reply_count') - 1, Value(0)))
+
+
+def actual_comment_counts():
+    return Coalesce(Subquery(
+        Comment.objects.live().filter(post=OuterRef('pk')).order_by().values('post')
+        .annotate(total=Count('pk')).values('total')
+    ), 0)
+
+
+def actual_reply_counts():
+    # A deleted reply counts while it is the placeholder of replies of its own
+    return Coalesce(Subquery(
+        Comment.objects.visible().filter(parent_comment=OuterRef('pk')).order_by().values('parent_comment')
+        .annotate(total=Count('pk')).values('total')
+    ), 0)
+
+
+def drifted_posts():
+    return Post.objects.annotate(actual=actual_comment_counts()).exclude(comment_count=F('actual'))
+
+
+def drifted_comments():
+    return Comment.objects.annotate(actual=actual_reply_counts()).exclude(reply_count=F('actual'))
+
+
+def reconcile():
+    """
+    Reset every drifted counter to its true value. Returns how many posts and comments
+    were corrected.
+    """
+    posts = drifted_posts().update(comment_count=actual_comment_counts())
+    # Whether a placeholder counts as a reply depends on its own count, so fixing a
+    # comment can unsettle its parent; repeat until nothing drifts, once per level at most
+    comments = set()
+    while drifted := list(drifted_comments().values_list('pk', flat=True)):
+        comments.update(drifted)
+        Comment.objects.filter(pk__in=drifted).update(reply_count=actual_reply_counts())
+    return posts, len(comments)
@@ -0,0 +1,103 @@
+"""
+Soft deletion of posts and comments.
+
+A delete request only flags the row with deleted_at, which hides it at once, and
+leaves removing rows to a background purge. The purge deletes PURGE_BATCH_SIZE
+rows per statement, each chunk in its own transaction, so a huge thread is never
+loaded whole by the CASCADE collector nor kept locked for the length of a request.
+
+A deleted comment with visible replies stays in its thread as a "[deleted]"
+placeholder, so the replies keep their place. Without any it is hidden, and no
+longer counts as a reply of its parent; a deleted parent left with no visible
+replies is hidden in turn. Hidden comments are what the comment purge removes.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from jobs.queue import task
+
+from . import search
+from .counters import comment_deleted, reply_hidden
+from .images import schedule_file_deletion
+from .models import Comment, Post, TimelineEntry
+
+# Rows deleted per statement by the purges
+PURGE_BATCH_SIZE = getattr(settings, 'PURGE_BATCH_SIZE', 500)
+
+
+def delete_post(post):
+    """
+    Soft delete `post`, taking its thread and timeline entries out of sight with it,
+    and purge them once the deletion commits.
+    """
+    with transaction.atomic():
+        Post.all_objects.filter(pk=post.pk).update(deleted_at=timezone.now())
+        purge_post.enqueue(post.pk, key=f'purge-post:{post.pk}')
+    search.unindex_post(post.pk)
+
+
+def delete_comment(comment):
+    """
+    Soft delete `comment`, hiding it and the deleted ancestors it leaves without
+    visible replies, and purge what was hidden once the deletion commits.
+    """
+    with transaction.atomic():
+        # Locked so the reply counts read below cannot change before they are acted on
+        current = Comment.objects.select_for_update().get(pk=comment.pk)
+        Comment.objects.filter(pk=comment.pk).update(deleted_at=timezone.now())
+        comment_deleted(comment.post_id)
+        hidden = current.reply_count == 0
+        if hidden:
+            # A placeholder has nothing to purge until its last reply goes
+            purge_comments.enqueue(comment.post_id)
+        while hidden and current.parent_comment_id:
+            reply_hidden(current.parent_comment_id)
+            current = Comment.objects.select_for_update().get(pk=current.parent_comment_id)
+            hidden = current.deleted_at is not None and current.reply_count == 0
+    search.unindex_comment(comment.pk)
+
+
+def delete_in_chunks(queryset):
+    """
+    Delete the rows of `queryset` PURGE_BATCH_SIZE at a time, in its order. Returns
+    the number of rows deleted, cascades included.
+    """
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:PURGE_BATCH_SIZE])
+        if not pks:
+            return deleted
+        deleted += queryset.model._base_manager.filter(pk__in=pks).delete()[0]
+
+
+@task
+def purge_post(post_id):
+    """
+    Delete a soft deleted post with its timeline entries and comments, then its files
+    once the post row is gone.
+    """
+    post = Post.all_objects.filter(pk=post_id, deleted_at__isnull=False).first()
+    if post is None:
+        return
+    delete_in_chunks(TimelineEntry.objects.filter(post_id=post_id).order_by('pk'))
+    # Newest first, so replies go before their parents and no chunk cascades into the next
+    delete_in_chunks(Comment.objects.filter(post_id=post_id).order_by('-created_at', '-id'))
+    with transaction.atomic():
+        schedule_file_deletion(post)
+        post.delete()
+
+
+@task
+def purge_comments(post_id):
+    """
+    Delete the hidden comments of a post. Only those without replies left are taken
+    at each step, so a reply that is still visible is never deleted with its parent.
+    """
+    leaves = (
+        Comment.objects.hidden().filter(post_id=post_id)
+        .exclude(Exists(Comment.objects.filter(parent_comment=OuterRef('pk'))))
+        .order_by('-created_at', '-id')
+    )
+    delete_in_chunks(leaves)
@@ -0,0 +1,66 @@
+"""
+Edits of posts and comments with optimistic concurrency.
+
+Every edit bumps the row's `version`, which edit responses send as a strong ETag
+and representations include. A client that sends it back in If-Match only has its
+edit applied if nobody edited the row in between, and gets 412 Precondition
+Failed otherwise; without If-Match the edit is unconditional.
+
+The ownership and version checks are part of the UPDATE that writes the edit, so
+the row is not read first and two concurrent editors cannot both win. Only the
+columns sent are written. When nothing was updated, one more query tells why.
+"""
+import re
+
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, PermissionDenied
+
+VERSION_ETAG_RE = re.compile(r'"(\d+)"')
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The resource was edited since the version given in If-Match.'
+    default_code = 'precondition_failed'
+
+
+def version_etag(version):
+    return quote_etag(str(version))
+
+
+def if_match_versions(request):
+    """
+    The versions If-Match accepts, or None when it accepts any. Weak ETags never
+    match, as If-Match compares strongly.
+    """
+    header = request.headers.get('If-Match')
+    if header is None:
+        return None
+    etags = parse_etags(header)
+    if '*' in etags:
+        return None
+    return {int(match[1]) for match in map(VERSION_ETAG_RE.fullmatch, etags) if match}
+
+
+def apply_edit(queryset, owner_field, owner_id, versions, values, name):
+    """
+    Write `values` to the row of `queryset` and bump its version, provided
+    `owner_field` is `owner_id` and the version is one of `versions` (any if None).
+    Raises NotFound, PermissionDenied or PreconditionFailed, naming the row `name`,
+    when it is not updated.
+    """
+    target = queryset.filter(**{owner_field: owner_id})
+    if versions is not None:
+        target = target.filter(version__in=versions)
+    if target.update(**values, version=F('version') + 1, updated_at=timezone.now()):
+        return
+
+    current = queryset.values(owner_field).first()
+    if current is None:
+        raise NotFound(f'{name.capitalize()} not found.')
+    if current[owner_field] != owner_id:
+        raise PermissionDenied(f'You do not have permission to edit this {name}.')
+    raise PreconditionFailed(f'The {name} was edited since the version given in If-Match.')
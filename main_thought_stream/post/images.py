@@ -0,0 +1,110 @@
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from jobs.queue import task
+
+from .cache import invalidate_feed
+from .models import Post
+
+# Widths (in pixels) of the resized copies generated for every post image
+VARIANT_WIDTHS = getattr(settings, 'POST_IMAGE_VARIANT_WIDTHS', (320, 640, 1280))
+
+# Format name: (Pillow format, file extension, save options)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+def render_variant(image, width, image_format, options):
+    """
+    Resize to `width` (never upscaling) and encode. Pillow only writes EXIF or other
+    metadata when it is passed explicitly, so the result carries none.
+    """
+    variant = image.copy()
+    variant.thumbnail((width, variant.height), Image.Resampling.LANCZOS)
+    if image_format == 'JPEG' and variant.mode != 'RGB':
+        variant = variant.convert('RGB')
+    buffer = io.BytesIO()
+    variant.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def delete_variants(variants):
+    for names in variants.values():
+        for name in names.values():
+            default_storage.delete(name)
+
+
+@task(max_attempts=3)
+def generate_variants(post_id):
+    """
+    Write the compressed, metadata-free variants of a post's image and record their
+    storage names on the post as {format: {width: name}}.
+    """
+    try:
+        post = Post.objects.get(pk=post_id)
+    except Post.DoesNotExist:
+        return
+    if not post.image:
+        return
+
+    with post.image.open('rb') as source:
+        image = Image.open(source)
+        # Apply the EXIF orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    stem = os.path.splitext(os.path.basename(post.image.name))[0]
+    variants = {}
+    for name, (image_format, extension, options) in VARIANT_FORMATS.items():
+        variants[name] = {}
+        for width in VARIANT_WIDTHS:
+            content = render_variant(image, min(width, image.width), image_format, options)
+            path = f'media/variants/{post.pk}/{stem}-{width}.{extension}'
+            variants[name][str(width)] = default_storage.save(path, ContentFile(content))
+            # Wider variants would just repeat the original size
+            if width >= image.width:
+                break
+
+    # The image may have been replaced while this ran; keep whichever variants match
+    updated = Post.objects.filter(pk=post.pk, image=post.image.name).update(image_variants=variants)
+    if not updated:
+        delete_variants(variants)
+        return
+    if post.image_variants:
+        delete_variants(post.image_variants)
+    invalidate_feed()
+
+
+def schedule_variants(*posts):
+    """
+    Generate the variants in a background job once the current transaction commits,
+    so the request that uploaded the image does not wait for it. The key is the
+    image, so a replaced image gets new variants but the same one is not redone.
+    """
+    generate_variants.enqueue_many([((post.pk,), f'image-variants:{post.pk}:{post.image.name}') for post in posts])
+
+
+@task
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+def schedule_file_deletion(post):
+    """
+    Delete the image of a deleted post, and its variants, in a background job once
+    the deletion commits.
+    """
+    names = [name for variants in post.image_variants.values() for name in variants.values()]
+    if post.image:
+        names.append(post.image.name)
+    if names:
+        delete_files.enqueue(names, key=f'post-files:{post.pk}')
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from post.uploads import UPLOAD_EXPIRY, expire_uploads
+
+
+class Command(BaseCommand):
+    help = "Delete abandoned image uploads, and their temp files, once they have been idle for too long."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=float, default=UPLOAD_EXPIRY.total_seconds() / 3600,
+            help="Hours an upload may stay idle before it is deleted.",
+        )
+
+    def handle(self, *args, **options):
+        deleted = expire_uploads(timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} abandoned uploads."))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from post.cache import invalidate_comments, invalidate_feed
+from post.counters import drifted_comments, drifted_posts, reconcile
+
+
+class Command(BaseCommand):
+    help = "Recompute Post.comment_count and Comment.reply_count wherever they drifted from the real counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report the drifted rows.")
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            posts, comments = drifted_posts().count(), drifted_comments().count()
+            self.stdout.write(f"{posts} posts and {comments} comments have drifted counters.")
+            return
+
+        # Cached threads show reply counts, so note which ones are about to change
+        threads = set(drifted_comments().values_list('post_id', flat=True))
+        posts, comments = reconcile()
+        if posts:
+            invalidate_feed()
+        for post_id in threads:
+            invalidate_comments(post_id)
+        self.stdout.write(self.style.SUCCESS(f"Reconciled {posts} posts and {comments} comments."))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from post.timeline import MAX_ENTRIES, oversized_timelines, trim_timeline
+
+
+class Command(BaseCommand):
+    help = "Delete the oldest home timeline entries of every user with more than the maximum kept."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=MAX_ENTRIES, help="Entries to keep per user.")
+
+    def handle(self, *args, **options):
+        users = deleted = 0
+        for user_id in oversized_timelines(options['keep']):
+            deleted += trim_timeline(user_id, options['keep'])
+            users += 1
+        self.stdout.write(self.style.SUCCESS(f"Trimmed {deleted} entries from {users} timelines."))
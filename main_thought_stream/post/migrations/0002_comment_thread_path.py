@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:01
+
+from django.db import migrations, models
+
+PATH_STEP = 10
+
+
+def backfill_thread_paths(apps, schema_editor):
+    Comment = apps.get_model('post', 'Comment')
+    parents = dict(Comment.objects.values_list('id', 'parent_comment_id'))
+    positions = {}
+
+    def position(comment_id):
+        if comment_id not in positions:
+            segment = str(comment_id).zfill(PATH_STEP)
+            parent_id = parents[comment_id]
+            if parent_id is None:
+                positions[comment_id] = (segment, 0)
+            else:
+                parent_path, parent_depth = position(parent_id)
+                positions[comment_id] = (parent_path + segment, parent_depth + 1)
+        return positions[comment_id]
+
+    # Replies always get higher ids than their parents, so walking in id order
+    # keeps the recursion one level deep
+    comments = []
+    for comment in Comment.objects.only('id').order_by('id').iterator():
+        comment.path, comment.depth = position(comment.id)
+        comments.append(comment)
+    Comment.objects.bulk_update(comments, ['path', 'depth'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(backfill_thread_paths, migrations.RunPython.noop),
+    ]
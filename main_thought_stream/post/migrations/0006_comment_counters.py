@@ -0,0 +1,38 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:08
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Post = apps.get_model('post', 'Post')
+    Comment = apps.get_model('post', 'Comment')
+    comments = Comment.objects.order_by()
+    Post.objects.update(comment_count=Coalesce(Subquery(
+        comments.filter(post=OuterRef('pk')).values('post').annotate(total=Count('pk')).values('total')
+    ), 0))
+    Comment.objects.update(reply_count=Coalesce(Subquery(
+        comments.filter(parent_comment=OuterRef('pk')).values('parent_comment').annotate(total=Count('pk')).values('total')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post', '0005_imageupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:10
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+SEARCH_CONFIG = getattr(settings, 'SEARCH_CONFIG', 'english')
+
+
+def create_search_indexes(apps, schema_editor):
+    # tsvector and GIN only exist on PostgreSQL; elsewhere post.search keeps an
+    # in-process index instead, so these stay outside the models' Meta.indexes
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "UPDATE post_post SET search_vector = "
+        "setweight(to_tsvector(%s, coalesce(title, '')), 'A') || setweight(to_tsvector(%s, coalesce(content, '')), 'B')",
+        [SEARCH_CONFIG, SEARCH_CONFIG],
+    )
+    schema_editor.execute(
+        "UPDATE post_comment SET search_vector = setweight(to_tsvector(%s, coalesce(content, '')), 'B')",
+        [SEARCH_CONFIG],
+    )
+    schema_editor.execute("CREATE INDEX post_search_idx ON post_post USING gin (search_vector)")
+    schema_editor.execute("CREATE INDEX comment_search_idx ON post_comment USING gin (search_vector)")
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS post_search_idx")
+    schema_editor.execute("DROP INDEX IF EXISTS comment_search_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post', '0006_comment_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
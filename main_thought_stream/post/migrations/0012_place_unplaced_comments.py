@@ -0,0 +1,41 @@
+from django.db import migrations
+
+PATH_STEP = 10
+
+
+def place_unplaced_comments(apps, schema_editor):
+    # Comments created outside the views, e.g. in the admin, were left with an empty path
+    Comment = apps.get_model('post', 'Comment')
+    parents = dict(Comment.objects.values_list('id', 'parent_comment_id'))
+    positions = {
+        comment_id: (path, depth)
+        for comment_id, path, depth in Comment.objects.exclude(path='').values_list('id', 'path', 'depth')
+    }
+
+    def position(comment_id):
+        if comment_id not in positions:
+            segment = str(comment_id).zfill(PATH_STEP)
+            parent_id = parents[comment_id]
+            if parent_id is None:
+                positions[comment_id] = (segment, 0)
+            else:
+                parent_path, parent_depth = position(parent_id)
+                positions[comment_id] = (parent_path + segment, parent_depth + 1)
+        return positions[comment_id]
+
+    comments = []
+    for comment in Comment.objects.filter(path='').only('id').order_by('id').iterator():
+        comment.path, comment.depth = position(comment.id)
+        comments.append(comment)
+    Comment.objects.bulk_update(comments, ['path', 'depth'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post', '0011_edit_versions'),
+    ]
+
+    operations = [
+        migrations.RunPython(place_unplaced_comments, migrations.RunPython.noop),
+    ]
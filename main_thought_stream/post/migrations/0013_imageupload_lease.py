@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post', '0012_place_unplaced_comments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
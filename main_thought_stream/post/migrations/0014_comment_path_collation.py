@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def use_bytewise_collation(apps, schema_editor):
+    # CommentQuerySet.subtree() takes the paths in [path, path + ':'), which only holds
+    # if ':' sorts right after the digits. SQLite compares bytes already; PostgreSQL
+    # follows the database's locale, which mostly ignores punctuation, unless told not to.
+    # Changing the column's type rebuilds its index with the new collation.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('ALTER TABLE post_comment ALTER COLUMN path TYPE varchar(1024) COLLATE "C"')
+
+
+def use_default_collation(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('ALTER TABLE post_comment ALTER COLUMN path TYPE varchar(1024) COLLATE "default"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post', '0013_imageupload_lease'),
+    ]
+
+    operations = [
+        migrations.RunPython(use_bytewise_collation, use_default_collation),
+    ]
@@ -1,6 +1,21 @@
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.contrib.auth.models import User
 
+class LivePostManager(models.Manager):
+    """
+    Posts that are not soft deleted. Deleted posts stay in the table, reachable
+    through Post.all_objects, until post.deletion purges them.
+    """
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 # Post model representing a blog post or similar entity
 class Post(models.Model):
     title = models.CharField(max_length=255)
@@ -9,19 +24,234 @@ class Post(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     image = models.ImageField(upload_to='media/')
+    # Storage names of the resized copies of `image`, as {format: {width: name}}
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Number of comments on the post at any depth, maintained by post.counters
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    # Weighted title + content lexemes; filled and GIN-indexed on PostgreSQL only
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Bumped by every edit and sent as the ETag, see post.editing
+    version = models.PositiveIntegerField(default=1, editable=False)
+    # Set when the post is deleted; the row and its thread are purged in the background
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = LivePostManager()
+    all_objects = models.Manager()
+
     def __str__(self):
         return self.title
 
+    class Meta:
+        indexes = [
+            # Newest-first feed, keyset paginated on (created_at, id)
+            models.Index(
+                fields=['-created_at', '-id'], condition=models.Q(deleted_at__isnull=True), name='post_feed_idx',
+            ),
+            # One author's posts newest first, pulled into timelines of their followers
+            models.Index(
+                fields=['author', '-created_at', '-id'], condition=models.Q(deleted_at__isnull=True),
+                name='post_author_idx',
+            ),
+        ]
+
+class CommentQuerySet(models.QuerySet):
+    # Paths are fixed-width digits, so every path below `prefix` sorts in [prefix, prefix + ':')
+    # as long as they are compared bytewise
+    def subtree(self, comment):
+        if not comment.path:
+            # An empty prefix would match every comment
+            raise ValueError('The comment has no place in its thread yet.')
+        return self.filter(path__gte=comment.path, path__lt=comment.path + ':').order_by('path')
+
+    def descendants(self, comment):
+        return self.subtree(comment).exclude(pk=comment.pk)
+
+    def within_depth(self, comment, levels):
+        return self.subtree(comment).filter(depth__lte=comment.depth + levels)
+
+    def reply_count(self, comment):
+        return self.descendants(comment).count()
+
+    def live(self):
+        return self.filter(deleted_at__isnull=True)
+
+    def visible(self):
+        # Live comments, and deleted ones kept as placeholders above their replies
+        return self.filter(models.Q(deleted_at__isnull=True) | models.Q(reply_count__gt=0))
+
+    def hidden(self):
+        return self.filter(deleted_at__isnull=False, reply_count=0)
+
+
 class Comment(models.Model):
+    # Width of one id in the materialized path
+    PATH_STEP = 10
+    PATH_MAX_LENGTH = 1024
+    # Deepest reply whose path still fits in PATH_MAX_LENGTH
+    MAX_DEPTH = PATH_MAX_LENGTH // PATH_STEP - 1
+    # Shown instead of the content of a deleted comment that still has replies
+    DELETED_CONTENT = '[deleted]'
+
     post = models.ForeignKey(Post, related_name="comments", on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
     parent_comment = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='replies')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Materialized path of zero-padded ids from the root comment down to this one,
+    # compared bytewise ("C" collation on PostgreSQL, see migration 0014)
+    path = models.CharField(max_length=PATH_MAX_LENGTH, default='', editable=False, db_index=True)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    # Number of visible direct replies, maintained by post.counters
+    reply_count = models.PositiveIntegerField(default=0, editable=False)
+    # Content lexemes; filled and GIN-indexed on PostgreSQL only
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Bumped by every edit and sent as the ETag, see post.editing
+    version = models.PositiveIntegerField(default=1, editable=False)
+    # Set when the comment is deleted, see post.deletion
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = CommentQuerySet.as_manager()
+
+    def place_in_thread(self, parent=None):
+        """
+        Compute path and depth once the comment has an id, without saving them. The
+        parent must already have its own position.
+        """
+        segment = str(self.pk).zfill(self.PATH_STEP)
+        if parent is None:
+            self.path, self.depth = segment, 0
+        else:
+            self.path, self.depth = parent.path + segment, parent.depth + 1
+
+    def set_thread_position(self, parent=None):
+        self.place_in_thread(parent)
+        Comment.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Places comments however they are created, the admin included; bulk_create
+        # skips save(), so post.bulk places its comments itself
+        if not self.path:
+            self.set_thread_position(self.parent_comment)
 
     def __str__(self):
         return f"Comment by {self.user.username} on {self.post.title}"
 
     class Meta:
         ordering = ['created_at']  
+        indexes = [
+            # Whole thread of a post in created_at order
+            models.Index(fields=['post', 'created_at', 'id'], name='comment_thread_idx'),
+            # Top-level comments of a post only
+            models.Index(
+                fields=['post', 'created_at'],
+                condition=models.Q(parent_comment__isnull=True),
+                name='comment_top_level_idx',
+            ),
+            # Direct replies of a comment
+            models.Index(fields=['parent_comment', 'created_at'], name='comment_replies_idx'),
+            # Recent replies anywhere, scanned when reply notifications are delivered
+            models.Index(
+                fields=['created_at'], condition=models.Q(parent_comment__isnull=False), name='comment_recent_replies_idx',
+            ),
+            # Deleted comments of a post, waiting to be purged
+            models.Index(fields=['post'], condition=models.Q(deleted_at__isnull=False), name='comment_deleted_idx'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """
+    A post in one user's home timeline, written when post.timeline fans the post out.
+    The post's created_at and author are copied in, so a timeline page is a range
+    scan of one index.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Post {self.post_id} in the timeline of {self.user_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'], name='timeline_entry_unique'),
+        ]
+        indexes = [
+            # A user's timeline newest first, keyset paginated on (created_at, post)
+            models.Index(fields=['user', '-created_at', '-post'], name='timeline_page_idx'),
+        ]
+
+
+class Notification(models.Model):
+    """
+    The replies to one of a user's comments since they last read about it, coalesced
+    into one inbox row ("5 new replies to your comment on X"). Written in batches by
+    post.notifications, never by the request that posts a reply.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+')
+    # The comment that was replied to
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='+')
+    latest_reply = models.ForeignKey(Comment, null=True, on_delete=models.SET_NULL, related_name='+')
+    # Replies covered, and when the first and last of them were posted
+    count = models.PositiveIntegerField(default=0)
+    first_reply_at = models.DateTimeField()
+    last_reply_at = models.DateTimeField()
+    read_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.count} replies to comment {self.comment_id} for {self.user_id}"
+
+    class Meta:
+        constraints = [
+            # Replies coalesce into the one unread notification of their comment
+            models.UniqueConstraint(
+                fields=['comment'], condition=models.Q(read_at__isnull=True), name='notification_unread_unique',
+            ),
+        ]
+        indexes = [
+            # A user's inbox, latest activity first, keyset paginated on (last_reply_at, id)
+            models.Index(fields=['user', '-last_reply_at', '-id'], name='notification_inbox_idx'),
+            # Unread count
+            models.Index(fields=['user'], condition=models.Q(read_at__isnull=True), name='notification_unread_idx'),
+            # Replies already read about, per comment
+            models.Index(
+                fields=['comment', 'last_reply_at'], condition=models.Q(read_at__isnull=False),
+                name='notification_read_idx',
+            ),
+        ]
+
+
+class ImageUpload(models.Model):
+    """
+    A resumable, chunked image upload. Chunks are appended to a temp file on disk
+    until `received` reaches `size`; the finished file is then moved into a Post.
+    """
+    RECEIVING = 'receiving'
+    COMPLETE = 'complete'
+    ATTACHED = 'attached'
+    STATUS_CHOICES = [(RECEIVING, 'Receiving'), (COMPLETE, 'Complete'), (ATTACHED, 'Attached')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='image_uploads')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=RECEIVING)
+    # Set while a request writes a chunk, see post.uploads.append_chunk
+    leased_until = models.DateTimeField(null=True, blank=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.id} by {self.user_id}"
+
+    @property
+    def temp_path(self):
+        directory = settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir()
+        return os.path.join(directory, f'post-upload-{self.id}.part')
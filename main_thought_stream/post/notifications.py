@@ -0,0 +1,147 @@
+"""
+Reply notifications: a user's inbox of "N new replies to your comment on X".
+
+The request that posts a reply writes no notification. It only makes sure a
+delivery job is queued for the current window of BATCH_SECONDS, once per window
+and process thanks to a cache flag. When the window ends that job finds every
+comment replied to during it and rewrites the unread notifications of their
+authors in bulk, so a burst of replies to a comment becomes one row updated once
+per window, whatever the number of replies or requests.
+
+Notifications are recomputed from the replies themselves, so delivering a window
+twice, or windows that overlap, is harmless, and deleted replies drop out. A read
+notification keeps the time of the last reply it covered; replies after that
+start a new unread one.
+"""
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Exists, F, Max, Min, OuterRef
+from django.utils import timezone
+
+from jobs.queue import task
+
+from .models import Comment, Notification
+
+# Seconds of replies coalesced into each delivery
+BATCH_SECONDS = getattr(settings, 'NOTIFICATION_BATCH_SECONDS', 10)
+# Replied-to comments per aggregate query and rows per INSERT or UPDATE
+BATCH_SIZE = 500
+
+
+def replies_added(comments):
+    """
+    Have the replies among `comments` delivered after the current transaction commits.
+    """
+    if any(comment.parent_comment_id for comment in comments):
+        transaction.on_commit(schedule_delivery)
+
+
+def schedule_delivery():
+    window = int(time.time() // BATCH_SECONDS)
+    if cache.add(f'notifications:window:{window}', 1, BATCH_SECONDS * 2):
+        deliver_replies.enqueue(
+            window, key=f'reply-notifications:{window}', delay=(window + 1) * BATCH_SECONDS - time.time(),
+        )
+
+
+def replies_removed(parent_id):
+    """
+    Recount the notification of a comment whose replies are being deleted, once the
+    deletion commits.
+    """
+    if parent_id is not None:
+        update_notifications.enqueue([parent_id])
+
+
+@task
+def deliver_replies(window):
+    """
+    Update the notifications of every comment replied to during `window`, or the one
+    before it, which covers replies whose transaction committed late.
+    """
+    since = datetime.fromtimestamp((window - 1) * BATCH_SECONDS, tz=dt_timezone.utc)
+    replied = (
+        Comment.objects.filter(parent_comment__isnull=False, created_at__gte=since)
+        .order_by().values_list('parent_comment_id', flat=True).distinct()
+    )
+    comment_ids = list(replied)
+    for start in range(0, len(comment_ids), BATCH_SIZE):
+        update_notifications(comment_ids[start:start + BATCH_SIZE])
+
+
+@task
+def update_notifications(comment_ids):
+    """
+    Bring the unread notifications of the given comments in line with their replies
+    by other users that no read notification covers.
+    """
+    covered = Notification.objects.filter(
+        comment=OuterRef('parent_comment'), read_at__isnull=False, last_reply_at__gte=OuterRef('created_at'),
+    )
+    unread = (
+        Comment.objects.live().filter(parent_comment__in=comment_ids)
+        .exclude(user=F('parent_comment__user'))
+        .filter(~Exists(covered))
+        .order_by()
+        .values('parent_comment', 'parent_comment__user', 'parent_comment__post')
+        .annotate(
+            count=Count('id'), first_reply_at=Min('created_at'), last_reply_at=Max('created_at'),
+            latest_reply=Max('id'),
+        )
+    )
+    with transaction.atomic():
+        # Locked, so marking them read waits for this update instead of being overwritten
+        existing = {
+            notification.comment_id: notification
+            for notification in Notification.objects.select_for_update().filter(
+                comment__in=comment_ids, read_at__isnull=True,
+            )
+        }
+        created, changed = [], []
+        for group in unread:
+            values = {
+                'count': group['count'],
+                'first_reply_at': group['first_reply_at'],
+                'last_reply_at': group['last_reply_at'],
+                'latest_reply_id': group['latest_reply'],
+            }
+            notification = existing.pop(group['parent_comment'], None)
+            if notification is None:
+                created.append(Notification(
+                    user_id=group['parent_comment__user'], post_id=group['parent_comment__post'],
+                    comment_id=group['parent_comment'], **values,
+                ))
+            elif any(getattr(notification, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(notification, field, value)
+                changed.append(notification)
+
+        Notification.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        Notification.objects.bulk_update(
+            changed, ['count', 'first_reply_at', 'last_reply_at', 'latest_reply'], batch_size=BATCH_SIZE,
+        )
+        # Every unread reply of these was deleted
+        if existing:
+            Notification.objects.filter(pk__in=[notification.pk for notification in existing.values()]).delete()
+
+
+def mark_read(user_id, ids=None):
+    """
+    Mark the user's unread notifications read, or only those with the given ids.
+    """
+    unread = Notification.objects.filter(user_id=user_id, read_at__isnull=True)
+    if ids is not None:
+        unread = unread.filter(id__in=ids)
+    return unread.update(read_at=timezone.now())
+
+
+def unread_count(user_id):
+    return Notification.objects.filter(user_id=user_id, read_at__isnull=True).count()
+
+
+def inbox(user_id):
+    return Notification.objects.filter(user_id=user_id).select_related('post', 'latest_reply__user')
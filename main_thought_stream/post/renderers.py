@@ -0,0 +1,48 @@
+from rest_framework.renderers import JSONRenderer
+
+from main_thought_stream.instrumentation import measure
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LINE_SEPARATOR = '\u2028'.encode()
+PARAGRAPH_SEPARATOR = '\u2029'.encode()
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that reports its time as the request's serialization time.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with measure('serialize'):
+            return self.encode(data, accepted_media_type, renderer_context)
+
+    def encode(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class FastJSONRenderer(TimedJSONRenderer):
+    """
+    JSONRenderer that encodes with orjson when it is installed, producing the same
+    bytes: compact separators, unescaped non-ASCII, escaped U+2028/U+2029, and
+    datetimes formatted by DRF's encoder. Indented output, and anything orjson
+    refuses, goes through JSONRenderer.
+
+    orjson writes some floats differently from Python (1e-07 as 1e-7), so this is
+    only meant for responses without float fields.
+    """
+
+    def encode(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None or data is None or self.ensure_ascii or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().encode(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            return super().encode(data, accepted_media_type, renderer_context)
+        return ret.replace(LINE_SEPARATOR, b'\\u2028').replace(PARAGRAPH_SEPARATOR, b'\\u2029')
@@ -0,0 +1,154 @@
+"""
+Read-only fast path for the hot list endpoints: representations built straight
+from .values() rows, without instantiating DRF serializers and fields for every
+object. The output is identical to PostSerializer and FlatCommentSerializer; the
+tests compare the two byte for byte, so a field added to either serializer has to
+be added here too.
+"""
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+from main_thought_stream.instrumentation import measure
+
+from .fieldsets import DEFAULT_POST_FIELDS, POST_FIELD_COLUMNS, make_excerpt
+from .models import Comment, Post
+
+image_storage = Post._meta.get_field('image').storage
+
+COMMENT_COLUMNS = (
+    'id', 'post_id', 'user_id', 'content', 'parent_comment_id', 'created_at', 'reply_count', 'version', 'deleted_at',
+)
+
+datetime_field = serializers.DateTimeField()
+
+
+def datetime_formatter():
+    """
+    DRF's DateTimeField representation, with the current time zone looked up once
+    for a whole batch of rows rather than once per value.
+    """
+    if not settings.USE_TZ or api_settings.DATETIME_FORMAT.lower() != ISO_8601:
+        return datetime_field.to_representation
+    zone = timezone.get_current_timezone()
+
+    def format_datetime(value):
+        if not value or timezone.is_naive(value):
+            return datetime_field.to_representation(value)
+        value = value.astimezone(zone).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    return format_datetime
+
+
+@lru_cache(maxsize=10000)
+def cached_storage_url(name):
+    return image_storage.url(name)
+
+
+def storage_url(name):
+    # File system storage URLs depend on the name alone; others, such as signed URLs, may not
+    if isinstance(image_storage, FileSystemStorage):
+        return cached_storage_url(name)
+    return image_storage.url(name)
+
+
+@receiver(setting_changed)
+def clear_storage_urls(setting, **kwargs):
+    if setting in ('MEDIA_URL', 'STORAGES'):
+        cached_storage_url.cache_clear()
+
+
+def absolute_url(url, request):
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def image_url(name, request):
+    return absolute_url(storage_url(name), request) if name else None
+
+
+def variant_urls(variants, request):
+    """
+    URLs of the resized copies of an image, e.g. {"webp": {"320": url}}.
+    """
+    return {
+        image_format: {width: absolute_url(storage_url(name), request) for width, name in names.items()}
+        for image_format, names in variants.items()
+    }
+
+
+def compile_post_row(fields, request):
+    """
+    A function turning one fieldsets.post_values(fields) row into what
+    PostSerializer(fields=fields) produces for that post.
+    """
+    selected = set(fields or DEFAULT_POST_FIELDS)
+    format_datetime = datetime_formatter()
+    builders = {
+        'id': lambda row: row['id'],
+        'title': lambda row: row['title'],
+        'author': lambda row: {'id': row['author__id'], 'username': row['author__username']},
+        'content': lambda row: row['content'],
+        'excerpt': lambda row: make_excerpt(row['content_prefix'] if 'content_prefix' in row else row['content']),
+        'image': lambda row: image_url(row['image'], request),
+        'image_variants': lambda row: variant_urls(row['image_variants'], request),
+        'comment_count': lambda row: row['comment_count'],
+        'version': lambda row: row['version'],
+        'created_at': lambda row: format_datetime(row['created_at']),
+        'updated_at': lambda row: format_datetime(row['updated_at']),
+    }
+    # Serializer field order, whatever order ?fields= named them in
+    steps = [(name, builders[name]) for name in POST_FIELD_COLUMNS if name in selected]
+    return lambda row: {name: build(row) for name, build in steps}
+
+
+def post_representations(rows, fields=None, request=None):
+    """
+    PostSerializer(many=True, fields=fields).data for rows of
+    fieldsets.post_values(fields).
+    """
+    rows = list(rows)
+    with measure('serialize'):
+        build = compile_post_row(fields, request)
+        return [build(row) for row in rows]
+
+
+def comment_representation(row, format_datetime):
+    pk, post_id, user_id, content, parent_comment_id, created_at, reply_count, version, deleted_at = row
+    if deleted_at is not None:
+        user_id, content = None, Comment.DELETED_CONTENT
+    return {
+        'id': pk,
+        'post': post_id,
+        'user': user_id,
+        'content': content,
+        'parent_comment': parent_comment_id,
+        'created_at': format_datetime(created_at),
+        'reply_count': reply_count,
+        'version': version,
+    }
+
+
+def comment_representations(queryset):
+    """
+    FlatCommentSerializer(queryset, many=True).data, read with values_list().
+    """
+    return build_comments(list(queryset.values_list(*COMMENT_COLUMNS)))
+
+
+async def acomment_representations(queryset):
+    return build_comments([row async for row in queryset.values_list(*COMMENT_COLUMNS)])
+
+
+def build_comments(rows):
+    with measure('serialize'):
+        format_datetime = datetime_formatter()
+        return [comment_representation(row, format_datetime) for row in rows]
@@ -0,0 +1,265 @@
+"""
+Full-text search over post titles, post bodies and comments.
+
+On PostgreSQL every Post and Comment row carries a precomputed, GIN-indexed
+`search_vector`. Elsewhere (SQLite during development and tests) an in-process
+inverted index stands in for it; it is built from the database on first use and then
+kept current by the same save/delete hooks.
+"""
+import html
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F
+
+from .models import Comment, Post
+
+SEARCH_CONFIG = getattr(settings, 'SEARCH_CONFIG', 'english')
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_STOP = '</mark>'
+# What PostgreSQL wraps matches in; swapped for the tags once the text is escaped
+HEADLINE_START = '\x02'
+HEADLINE_STOP = '\x03'
+SNIPPET_WORDS = 30
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def use_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def search(query, kind=None, offset=0, limit=20):
+    """
+    Ranked matches for `query` as (total, results). Results are dicts with type
+    ('post' or 'comment'), id, post, title, snippet and rank; `kind` restricts them
+    to one type.
+    """
+    kinds = [kind] if kind else ['post', 'comment']
+    if use_postgres():
+        return postgres_search(query, kinds, offset, limit)
+    return inverted_index.search(query, kinds, offset, limit)
+
+
+def index_post(post):
+    if use_postgres():
+        Post.objects.filter(pk=post.pk).update(
+            search_vector=SearchVector('title', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('content', weight='B', config=SEARCH_CONFIG)
+        )
+    else:
+        inverted_index.add(('post', post.pk), post.pk, post.title, [(post.title, 2.0), (post.content, 1.0)])
+
+
+def index_comment(comment):
+    if use_postgres():
+        Comment.objects.filter(pk=comment.pk).update(
+            search_vector=SearchVector('content', weight='B', config=SEARCH_CONFIG)
+        )
+    else:
+        inverted_index.add(('comment', comment.pk), comment.post_id, None, [(comment.content, 1.0)])
+
+
+def index_posts(posts):
+    """
+    index_post for rows written without save signals, e.g. by bulk_create.
+    """
+    if use_postgres():
+        Post.objects.filter(pk__in=[post.pk for post in posts]).update(
+            search_vector=SearchVector('title', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('content', weight='B', config=SEARCH_CONFIG)
+        )
+    else:
+        for post in posts:
+            index_post(post)
+
+
+def index_comments(comments):
+    if use_postgres():
+        Comment.objects.filter(pk__in=[comment.pk for comment in comments]).update(
+            search_vector=SearchVector('content', weight='B', config=SEARCH_CONFIG)
+        )
+    else:
+        for comment in comments:
+            index_comment(comment)
+
+
+def unindex_post(post_id):
+    """
+    Drop a soft deleted post and its comments from the in-process index. PostgreSQL
+    queries filter them out instead, so their rows need no UPDATE.
+    """
+    if not use_postgres():
+        inverted_index.remove_post(post_id)
+
+
+def unindex_comment(comment_id):
+    if not use_postgres():
+        inverted_index.remove(('comment', comment_id))
+
+
+def postgres_search(query, kinds, offset, limit):
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    headline = {
+        'query': search_query, 'config': SEARCH_CONFIG,
+        'start_sel': HEADLINE_START, 'stop_sel': HEADLINE_STOP, 'max_words': SNIPPET_WORDS,
+    }
+    querysets = {
+        'post': Post.objects.filter(search_vector=search_query).annotate(
+            rank=SearchRank(F('search_vector'), search_query),
+            snippet=SearchHeadline('content', **headline),
+            post_ref=F('id'),
+        ).values('id', 'post_ref', 'title', 'snippet', 'rank'),
+        'comment': Comment.objects.live().filter(search_vector=search_query, post__deleted_at__isnull=True).annotate(
+            rank=SearchRank(F('search_vector'), search_query),
+            snippet=SearchHeadline('content', **headline),
+            post_ref=F('post_id'),
+        ).values('id', 'post_ref', 'snippet', 'rank'),
+    }
+
+    # Each type's top offset + limit rows are enough to fill the requested page of the merge
+    total = 0
+    results = []
+    for kind in kinds:
+        queryset = querysets[kind]
+        total += queryset.count()
+        for row in queryset.order_by('-rank', '-id')[:offset + limit]:
+            results.append({
+                'type': kind, 'id': row['id'], 'post': row['post_ref'], 'title': row.get('title'),
+                'snippet': escape_headline(row['snippet']), 'rank': row['rank'],
+            })
+    results.sort(key=lambda result: (-result['rank'], -result['id']))
+    return total, results[offset:offset + limit]
+
+
+def escape_headline(headline):
+    """
+    A ts_headline snippet as HTML, escaped like highlight() output.
+    """
+    return html.escape(headline).replace(HEADLINE_START, HIGHLIGHT_START).replace(HEADLINE_STOP, HIGHLIGHT_STOP)
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+
+def highlight(text, terms):
+    """
+    A window of SNIPPET_WORDS words around the first match, with matches wrapped in
+    HIGHLIGHT_START / HIGHLIGHT_STOP.
+    """
+    words = (text or '').split()
+    first = next((i for i, word in enumerate(words) if set(tokenize(word)) & terms), 0)
+    start = max(0, first - SNIPPET_WORDS // 3)
+    snippet = []
+    for word in words[start:start + SNIPPET_WORDS]:
+        word_text = html.escape(word)
+        if set(tokenize(word)) & terms:
+            word_text = f'{HIGHLIGHT_START}{word_text}{HIGHLIGHT_STOP}'
+        snippet.append(word_text)
+    return ' '.join(snippet)
+
+
+class InvertedIndex:
+    """
+    Term -> {document: weighted term frequency} postings, ranked with tf-idf. All
+    query terms must match, like PostgreSQL's websearch_to_tsquery.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def add(self, key, post_id, title, fields):
+        with self.lock:
+            if not self.loaded:
+                # The initial load reads this write from the database anyway
+                return
+            self.discard(key)
+            frequencies = defaultdict(float)
+            for text, weight in fields:
+                for term in tokenize(text):
+                    frequencies[term] += weight
+            for term, frequency in frequencies.items():
+                self.postings[term][key] = frequency
+            self.documents[key] = (post_id, title, fields[-1][0], frozenset(frequencies))
+
+    def remove(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def remove_post(self, post_id):
+        with self.lock:
+            for key in [key for key, document in self.documents.items() if document[0] == post_id]:
+                self.discard(key)
+
+    def discard(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        for term in document[3]:
+            postings = self.postings[term]
+            postings.pop(key, None)
+            if not postings:
+                del self.postings[term]
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.documents.clear()
+            self.loaded = False
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            for post in Post.objects.only('id', 'title', 'content').iterator():
+                index_post(post)
+            comments = Comment.objects.live().filter(post__deleted_at__isnull=True)
+            for comment in comments.only('id', 'post_id', 'content').iterator():
+                index_comment(comment)
+
+    def search(self, query, kinds, offset, limit):
+        self.load()
+        terms = set(tokenize(query))
+        if not terms:
+            return 0, []
+
+        with self.lock:
+            matches = None
+            for term in terms:
+                keys = set(self.postings.get(term, ()))
+                matches = keys if matches is None else matches & keys
+            matches = [key for key in matches if key[0] in kinds]
+
+            total_documents = len(self.documents)
+            scored = []
+            for key in matches:
+                score = 0.0
+                for term in terms:
+                    idf = math.log(1 + total_documents / len(self.postings[term]))
+                    score += self.postings[term][key] * idf
+                # Normalise by document length so long posts do not win on size alone
+                score /= math.log(2 + len(self.documents[key][3]))
+                scored.append((score, key))
+            scored.sort(key=lambda item: (-item[0], -item[1][1]))
+
+            results = []
+            for score, (kind, pk) in scored[offset:offset + limit]:
+                post_id, title, text, _ = self.documents[(kind, pk)]
+                results.append({
+                    'type': kind, 'id': pk, 'post': post_id, 'title': title,
+                    'snippet': highlight(text, terms), 'rank': round(score, 6),
+                })
+        return len(scored), results
+
+
+inverted_index = InvertedIndex()
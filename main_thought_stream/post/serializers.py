@@ -1,6 +1,10 @@
 from rest_framework import serializers
-from .models import Post, Comment
+from .models import Post, Comment, ImageUpload, Notification
+from .uploads import attach_upload
+from .fieldsets import make_excerpt
+from .rows import variant_urls
 from django.contrib.auth.models import User
+from rest_framework_simplejwt.models import TokenUser
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -8,15 +12,66 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username'] 
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class DeletedCommentMixin:
+    """
+    Show a deleted comment, kept in its thread for the sake of its replies, as a
+    placeholder without author or content.
+    """
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.deleted_at is not None:
+            data.update(user=None, content=Comment.DELETED_CONTENT)
+        return data
+
+
+class FlatCommentSerializer(DeletedCommentMixin, serializers.ModelSerializer):
+    """
+    A single comment without its replies, used when the thread is assembled in memory
+    by post.comment_tree instead of one query per comment.
+    """
+    class Meta:
+        model = Comment
+        fields = ['id', 'post', 'user', 'content', 'parent_comment', 'created_at', 'reply_count', 'version']
+
+
+class BulkCommentSerializer(serializers.Serializer):
+    """
+    One item of a comment batch. Existence of the post and parent is checked for the
+    whole batch at once by post.bulk. `ref` is a client-chosen name that later items
+    use as `parent_ref` to reply to a comment created in the same batch.
+    """
+    ref = serializers.CharField(required=False, max_length=100)
+    post = serializers.IntegerField()
+    content = serializers.CharField()
+    parent_comment = serializers.IntegerField(required=False, allow_null=True)
+    parent_ref = serializers.CharField(required=False, allow_null=True, max_length=100)
+
+    def validate(self, attrs):
+        if attrs.get('parent_comment') and attrs.get('parent_ref'):
+            raise serializers.ValidationError({'parent_ref': 'Send either a parent_comment or a parent_ref, not both.'})
+        return attrs
+
+
+class CommentEditSerializer(serializers.ModelSerializer):
+    """
+    What an edit may change. The post and parent stay put: the thread path, depth
+    and counters all depend on them.
+    """
+    class Meta:
+        model = Comment
+        fields = ['content']
+
+
+class CommentSerializer(DeletedCommentMixin, serializers.ModelSerializer):
     replies = serializers.SerializerMethodField()
 
     class Meta:
         model = Comment
-        fields = ['id', 'post', 'user', 'content', 'parent_comment', 'created_at', 'replies']
+        fields = ['id', 'post', 'user', 'content', 'parent_comment', 'created_at', 'reply_count', 'version', 'replies']
+        read_only_fields = ['user']
 
     def get_replies(self, obj):
-        replies = Comment.objects.filter(parent_comment=obj).order_by('created_at')
+        replies = Comment.objects.visible().filter(parent_comment=obj).order_by('created_at')
         return CommentSerializer(replies, many=True).data
 
     def create(self, validated_data):
@@ -27,23 +82,121 @@ class CommentSerializer(serializers.ModelSerializer):
 
 class PostSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
+    excerpt = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    # A completed chunked upload to use as the image instead of a multipart file
+    upload_id = serializers.UUIDField(write_only=True, required=False)
 
     class Meta:
         model = Post
-        fields = ['id', 'title', 'author', 'content', 'image', 'created_at', 'updated_at']
+        fields = ['id', 'title', 'author', 'content', 'excerpt', 'image', 'image_variants', 'upload_id',
+                  'comment_count', 'version', 'created_at', 'updated_at']
         read_only_fields = ['created_at', 'updated_at', 'author']
+        extra_kwargs = {'image': {'required': False}}
+
+    def __init__(self, *args, fields=None, **kwargs):
+        """
+        `fields` limits the output to those fields, as parsed by
+        post.fieldsets.parse_fields. The excerpt is only returned when asked for.
+        """
+        super().__init__(*args, **kwargs)
+        if fields is None:
+            self.fields.pop('excerpt')
+        else:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
+    def get_excerpt(self, obj):
+        # post.fieldsets loads just the start of the content when that is all that is needed
+        prefix = getattr(obj, 'content_prefix', None)
+        return make_excerpt(obj.content if prefix is None else prefix)
+
+    def validate_upload_id(self, value):
+        # Batch writes look up all of their uploads in one query beforehand
+        if 'uploads' in self.context:
+            if value not in self.context['uploads']:
+                raise serializers.ValidationError('No completed upload with this id.')
+            return self.context['uploads'][value]
+        user = self.context['request'].user
+        try:
+            return ImageUpload.objects.get(id=value, user_id=user.id, status=ImageUpload.COMPLETE)
+        except ImageUpload.DoesNotExist:
+            raise serializers.ValidationError('No completed upload with this id.')
+
+    def validate(self, attrs):
+        if attrs.get('image') and attrs.get('upload_id'):
+            raise serializers.ValidationError({'upload_id': 'Send either an image or an upload_id, not both.'})
+        if not self.partial and not attrs.get('image') and not attrs.get('upload_id'):
+            raise serializers.ValidationError({'image': 'No file was submitted.'})
+        return attrs
+
+    def get_image_variants(self, obj):
+        """
+        URLs of the resized copies of the image, e.g. {"webp": {"320": url}}. Empty
+        until post.images has generated them.
+        """
+        return variant_urls(obj.image_variants, self.context.get('request'))
 
     def create(self, validated_data):
         user = self.context['request'].user
-        print("-------------->",user.id)
-        validated_data['author'] = user
-        return super().create(validated_data)
+        if isinstance(user, TokenUser):
+            # Users resolved from token claims have no row loaded, only the id
+            validated_data['author_id'] = user.id
+        else:
+            validated_data['author'] = user
+
+        upload = validated_data.pop('upload_id', None)
+        if upload is None:
+            return super().create(validated_data)
+        post = Post(**validated_data)
+        attach_upload(upload, post)
+        post.save()
+        return post
 
     def update(self, instance, validated_data):
         validated_data.pop('author', None)
+        upload = validated_data.pop('upload_id', None)
+        if upload is not None:
+            attach_upload(upload, instance)
 
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         instance.save()
         return instance
+
+
+class NotificationSerializer(serializers.ModelSerializer):
+    """
+    One inbox entry, with a `message` such as "5 new replies to your comment on
+    "Title"" and the latest of the replies.
+    """
+    post = serializers.SerializerMethodField()
+    message = serializers.SerializerMethodField()
+    latest_reply = serializers.SerializerMethodField()
+    read = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Notification
+        fields = ['id', 'post', 'comment', 'count', 'message', 'latest_reply', 'first_reply_at', 'last_reply_at',
+                  'read']
+
+    def get_post(self, obj):
+        return {'id': obj.post_id, 'title': obj.post.title}
+
+    def get_message(self, obj):
+        replies = 'new reply' if obj.count == 1 else 'new replies'
+        return f'{obj.count} {replies} to your comment on "{obj.post.title}"'
+
+    def get_latest_reply(self, obj):
+        reply = obj.latest_reply
+        if reply is None:
+            return None
+        return {
+            'id': reply.id,
+            'user': {'id': reply.user.id, 'username': reply.user.username},
+            'content': reply.content,
+            'created_at': serializers.DateTimeField().to_representation(reply.created_at),
+        }
+
+    def get_read(self, obj):
+        return obj.read_at is not None
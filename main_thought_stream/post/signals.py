@@ -0,0 +1,55 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.db import connection
+from django.dispatch import receiver
+
+from user.models import Follow
+
+from . import search, timeline
+from .authentication import user_cache
+from .models import Comment, Post
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Post)
+def index_saved_post(sender, instance, **kwargs):
+    search.index_post(instance)
+
+
+@receiver(post_save, sender=Comment)
+def index_saved_comment(sender, instance, **kwargs):
+    search.index_comment(instance)
+
+
+@receiver(post_save, sender=Follow)
+def add_followed_posts(sender, instance, created, **kwargs):
+    if created:
+        timeline.backfill(instance.follower_id, instance.followee_id)
+        timeline.forget_pulled_authors(instance.follower_id)
+
+
+@receiver(post_delete, sender=Follow)
+def remove_unfollowed_posts(sender, instance, **kwargs):
+    timeline.remove_author(instance.follower_id, instance.followee_id)
+    timeline.forget_pulled_authors(instance.follower_id)
+
+
+def remove_deleted_post(sender, instance, **kwargs):
+    search.inverted_index.remove(('post', instance.pk))
+
+
+def remove_deleted_comment(sender, instance, **kwargs):
+    search.inverted_index.remove(('comment', instance.pk))
+
+
+# PostgreSQL drops a row's search vector together with the row, so only the
+# in-process index needs to hear about deletes. Delete receivers also stop Django
+# from fast-deleting comment cascades, which is why they are not connected there.
+if connection.vendor != 'postgresql':
+    post_delete.connect(remove_deleted_post, sender=Post)
+    post_delete.connect(remove_deleted_comment, sender=Comment)
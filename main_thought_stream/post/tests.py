@@ -1,3 +1,1890 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from jobs import queue
+from jobs.models import Job
+from jobs.queue import DatabaseBroker
+from main_thought_stream.db_routers import PIN_COOKIE, ReplicaRouter
+from main_thought_stream.instrumentation import InstrumentationMiddleware, registry
+from main_thought_stream.throttling import MemoryBucketStore, bucket_store
+from user.models import Follow, FollowerCount
+
+from . import timeline
+from .authentication import user_cache
+from .broker import InProcessBroker, RedisBroker, broker, comments_channel
+from .cache import invalidate_feed, response_cache
+from .comment_tree import thread_queryset
+from .deletion import purge_comments, purge_post
+from .fieldsets import post_values
+from .images import delete_files, generate_variants
+from .models import Post, Comment, ImageUpload, Notification, TimelineEntry
+from .notifications import BATCH_SECONDS, deliver_replies, update_notifications
+from .pagination import FeedCursorPagination, keyset_filter
+from .renderers import FastJSONRenderer
+from .rows import comment_representations, post_representations
+from .search import escape_headline, inverted_index
+from .serializers import CommentSerializer, FlatCommentSerializer, PostSerializer
+from .timeline import backfill_followers, fan_out, trim_timeline
+from .uploads import UploadConflict, append_chunk, attach_upload
+
+
+class PostFeedPaginationTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        self.client = APIClient()
+        self.url = reverse('post-list')
+
+    def create_posts(self, count):
+        offset = User.objects.count()
+        authors = [User.objects.create_user(username=f'author{offset + i}') for i in range(3)]
+        Post.objects.bulk_create([
+            Post(title=f'Post {i}', content='content', image='media/post.jpg', author=authors[i % 3])
+            for i in range(count)
+        ])
+
+    def test_pages_cover_the_feed_without_gaps_or_duplicates(self):
+        self.create_posts(45)
+        seen = []
+        url = self.url + '?page_size=20'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+
+        expected = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_page_costs_one_query_whatever_the_feed_size(self):
+        for total in (25, 150):
+            self.create_posts(total)
+            response_cache().clear()
+            with self.assertNumQueries(1):
+                first = self.client.get(self.url)
+            self.assertEqual(len(first.data['results']), 20)
+            self.assertEqual(first.data['results'][0]['author']['username'][:6], 'author')
+            with self.assertNumQueries(1):
+                self.client.get(first.data['next'])
+
+    def test_page_size_is_capped(self):
+        cap = FeedCursorPagination.max_page_size
+        self.create_posts(cap + 5)
+        response = self.client.get(self.url, {'page_size': cap * 2})
+        self.assertEqual(len(response.data['results']), cap)
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(self.url + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_sparse_fieldsets_skip_unrequested_columns(self):
+        author = User.objects.create_user(username='writer')
+        Post.objects.create(title='Long', content='word ' * 2000, image='media/post.jpg', author=author)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, {'fields': 'id,title,excerpt'})
+        self.assertEqual(response.status_code, 200)
+        item = response.data['results'][0]
+        self.assertEqual(set(item), {'id', 'title', 'excerpt'})
+        self.assertTrue(item['excerpt'].endswith('…'))
+        self.assertLessEqual(len(item['excerpt']), 281)
+        self.assertEqual(len(context.captured_queries), 1)
+        sql = context.captured_queries[0]['sql']
+        # Only the start of the content is read, for the excerpt
+        self.assertIn('SUBSTR("post_post"."content", 1, 281)', sql)
+        self.assertNotIn('"post_post"."content"', sql.replace('SUBSTR("post_post"."content"', ''))
+        self.assertNotIn('auth_user', sql)
+
+        response = self.client.get(self.url, {'fields': 'title,author'})
+        self.assertEqual(response.data['results'][0], {'title': 'Long', 'author': {'id': author.id, 'username': 'writer'}})
+        self.assertNotIn('excerpt', self.client.get(self.url).data['results'][0])
+
+        async_response = self.client.get(reverse('post-list-async'), {'fields': 'id,excerpt'})
+        self.assertEqual(set(async_response.json()['results'][0]), {'id', 'excerpt'})
+
+    def test_unknown_fields_are_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'fields': 'title,password'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('post-list-async'), {'fields': ''}).status_code, 400)
+
+
+class PostCommentsTreeTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='commenter')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+        self.url = reverse('post-comments', kwargs={'post_id': self.post.id})
+
+    def comment(self, parent=None, content='comment'):
+        return Comment.objects.create(post=self.post, user=self.user, content=content, parent_comment=parent)
+
+    def build_thread(self):
+        first = self.comment(content='first')
+        second = self.comment(content='second')
+        reply = self.comment(first, 'reply')
+        self.comment(first, 'another reply')
+        self.comment(reply, 'nested reply')
+        self.comment(second, 'reply to second')
+        return first, second
+
+    def test_matches_recursive_serializer_in_one_query(self):
+        self.build_thread()
+        top_level = Comment.objects.filter(post=self.post, parent_comment__isnull=True).order_by('created_at')
+        expected = CommentSerializer(top_level, many=True).data
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, expected)
+
+    def test_max_depth_and_reply_limit(self):
+        self.build_thread()
+        response = self.client.get(self.url + '?max_depth=1')
+        first = response.data[0]
+        self.assertEqual(len(first['replies']), 2)
+        self.assertEqual(first['replies'][0]['replies'], [])
+
+        response = self.client.get(self.url + '?reply_limit=1')
+        self.assertEqual([r['content'] for r in response.data[0]['replies']], ['reply'])
+        self.assertEqual(len(response.data[0]['replies'][0]['replies']), 1)
+
+        response = self.client.get(self.url + '?max_depth=0')
+        self.assertEqual([c['replies'] for c in response.data], [[], []])
+
+    def test_invalid_limits_are_rejected(self):
+        self.assertEqual(self.client.get(self.url + '?max_depth=-1').status_code, 400)
+        self.assertEqual(self.client.get(self.url + '?reply_limit=x').status_code, 400)
+
+    def test_unknown_post_has_no_comments(self):
+        response = self.client.get(reverse('post-comments', kwargs={'post_id': 999}))
+        self.assertEqual(response.data, [])
+
+
+class CommentThreadIndexTests(TestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.addCleanup(bucket_store.clear)
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='commenter')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+
+    def reply(self, parent=None, content='comment'):
+        response = self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': self.post.id}),
+            {'content': content, 'parent_comment': parent.id if parent else None},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 201)
+        return Comment.objects.get(id=response.data['id'])
+
+    def test_created_comments_get_a_thread_position(self):
+        root = self.reply()
+        child = self.reply(root)
+        grandchild = self.reply(child)
+        self.assertEqual((root.depth, child.depth, grandchild.depth), (0, 1, 2))
+        self.assertTrue(grandchild.path.startswith(child.path))
+        self.assertTrue(child.path.startswith(root.path))
+
+    def test_subtree_queries(self):
+        root = self.reply()
+        child = self.reply(root)
+        self.reply(child)
+        self.reply(root)
+        other = self.reply()
+        self.reply(other)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Comment.objects.reply_count(root), 3)
+        self.assertEqual(Comment.objects.within_depth(root, 1).count(), 3)
+        self.assertEqual(set(Comment.objects.descendants(child).values_list('parent_comment', flat=True)), {child.id})
+
+    def test_comments_created_outside_the_views_get_a_thread_position(self):
+        root = Comment.objects.create(post=self.post, user=self.user, content='from the admin')
+        child = Comment.objects.create(post=self.post, user=self.user, content='reply', parent_comment=root)
+        root.refresh_from_db()
+        child.refresh_from_db()
+        self.assertEqual((root.depth, child.depth), (0, 1))
+        self.assertEqual(list(Comment.objects.subtree(root)), [root, child])
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Locale collations only apply on PostgreSQL')
+    def test_subtrees_ignore_the_database_locale(self):
+        ten, hundred, eleven = (self.reply(content=str(n)) for n in (10, 100, 11))
+        child = self.reply(ten)
+        # Paths of comments 10, 100 and 11, and of a reply to 10, which a locale that
+        # skips ':' would sort out of order
+        paths = {ten: '0000000010', hundred: '0000000100', eleven: '0000000011'}
+        paths[child] = paths[ten] + '0000000012'
+        for comment, path in paths.items():
+            Comment.objects.filter(pk=comment.pk).update(path=path)
+            comment.path = path
+        self.assertEqual(list(Comment.objects.subtree(ten)), [ten, child])
+        self.assertEqual(list(Comment.objects.subtree(hundred)), [hundred])
+
+    def test_subtree_of_an_unplaced_comment_is_refused(self):
+        with self.assertRaises(ValueError):
+            Comment.objects.subtree(Comment(post=self.post, user=self.user))
+
+    def test_replies_are_capped_at_the_max_depth(self):
+        parent = self.reply()
+        Comment.objects.filter(pk=parent.pk).update(depth=Comment.MAX_DEPTH - 1)
+        deepest = self.reply(Comment.objects.get(pk=parent.pk))
+        self.assertEqual(deepest.depth, Comment.MAX_DEPTH)
+        response = self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': self.post.id}),
+            {'content': 'too deep', 'parent_comment': deepest.id},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_parent_must_belong_to_the_post(self):
+        other_post = Post.objects.create(title='Other', content='content', image='media/post.jpg', author=self.user)
+        foreign = Comment.objects.create(post=other_post, user=self.user, content='elsewhere')
+        response = self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': self.post.id}),
+            {'content': 'reply', 'parent_comment': foreign.id},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def delete(self, comment):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse('comment-update-delete', kwargs={'comment_id': comment.id}))
+        self.assertEqual(response.status_code, 204)
+
+    def thread(self):
+        response = self.client.get(reverse('post-comments', kwargs={'post_id': self.post.id}))
+        return [(c['id'], c['user'], c['content'], [r['id'] for r in c['replies']]) for c in response.data]
+
+    def test_deleted_comments_with_replies_stay_as_placeholders(self):
+        root = self.reply(content='root')
+        child = self.reply(root)
+        grandchild = self.reply(child)
+        sibling = self.reply(content='sibling')
+        with mock.patch.object(queue, 'broker', DatabaseBroker()):
+            self.delete(root)
+            self.assertEqual(self.thread(), [
+                (root.id, None, '[deleted]', [child.id]), (sibling.id, self.user.id, 'sibling', []),
+            ])
+            # Placeholders take no replies or edits
+            self.assertEqual(self.client.post(
+                reverse('post-comment-create', kwargs={'post_id': self.post.id}),
+                {'content': 'late', 'parent_comment': root.id}, format='json',
+            ).status_code, 404)
+            self.assertEqual(self.client.put(
+                reverse('comment-update-delete', kwargs={'comment_id': root.id}), {'content': 'back'}, format='json',
+            ).status_code, 404)
+            self.assertFalse(Job.objects.exists())
+
+            # The last reply going hides the placeholders above it
+            self.delete(grandchild)
+            self.delete(child)
+            self.assertEqual(self.thread(), [(sibling.id, self.user.id, 'sibling', [])])
+            self.assertEqual(Comment.objects.count(), 4)
+
+            purge = Job.objects.filter(name='post.deletion.purge_comments').first()
+            purge_comments(*purge.args)
+        self.assertEqual(list(Comment.objects.values_list('id', flat=True)), [sibling.id])
+
+
+class QueryPlanTests(TestCase):
+    """
+    Every feed and thread query must be answered from an index, without a full scan
+    of the table or a sort step. Runs against SQLite or PostgreSQL.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='planner')
+        Post.objects.bulk_create([
+            Post(title=f'Post {i}', content='content', image='media/post.jpg', author=cls.user)
+            for i in range(300)
+        ])
+        cls.post = Post.objects.first()
+        parent = None
+        for i in range(200):
+            comment = Comment.objects.create(
+                post=cls.post, user=cls.user, content='comment', parent_comment=parent if i % 3 else None,
+            )
+            parent = comment
+        cls.comment = Comment.objects.filter(parent_comment__isnull=True).first()
+
+    def assertIndexed(self, queryset):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # Tiny test tables would otherwise be read sequentially regardless of indexes
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+            self.assertNotIn('Seq Scan', plan, plan)
+            self.assertNotRegex(plan, r'->\s+Sort\b|^Sort\b', plan)
+        else:
+            plan = queryset.explain()
+            self.assertNotIn('TEMP B-TREE', plan, plan)
+            for line in plan.splitlines():
+                self.assertIsNone(re.search(r'\bSCAN \w+$', line), plan)
+
+    def test_feed_pages(self):
+        feed = Post.objects.select_related('author').order_by('-created_at', '-id')
+        self.assertIndexed(feed[:21])
+        self.assertIndexed(keyset_filter(feed, (timezone.now(), self.post.id))[:21])
+
+    def test_comment_threads(self):
+        thread = Comment.objects.filter(post=self.post).order_by('created_at', 'id')
+        self.assertIndexed(thread)
+        self.assertIndexed(thread.filter(depth__lte=2))
+
+    def test_top_level_comments_and_replies(self):
+        self.assertIndexed(Comment.objects.filter(post=self.post, parent_comment__isnull=True).order_by('created_at'))
+        self.assertIndexed(Comment.objects.filter(parent_comment=self.comment).order_by('created_at'))
+
+    def test_subtree(self):
+        self.assertIndexed(Comment.objects.subtree(self.comment))
+        self.assertIndexed(Comment.objects.within_depth(self.comment, 2))
+
+    def test_thread_and_deleted_comments(self):
+        self.assertIndexed(thread_queryset(self.post.id))
+        self.assertIndexed(Comment.objects.hidden().filter(post=self.post).order_by('-created_at', '-id'))
+
+    def test_notifications(self):
+        inbox = Notification.objects.filter(user=self.user).order_by('-last_reply_at', '-id')
+        self.assertIndexed(inbox[:21])
+        self.assertIndexed(keyset_filter(inbox, (timezone.now(), 1), time_field='last_reply_at')[:21])
+        self.assertIndexed(Notification.objects.filter(user=self.user, read_at__isnull=True).values('id'))
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='cached')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+        self.url = reverse('post-comment-create', kwargs={'post_id': self.post.id})
+
+    def comment(self):
+        response = self.client.post(self.url, {'content': 'hello'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response
+
+    def count_user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.comment()
+        return sum('FROM "auth_user"' in query['sql'] for query in queries.captured_queries)
+
+    def test_second_request_skips_the_user_lookup(self):
+        self.assertEqual(self.count_user_queries(), 1)
+        self.assertEqual(self.count_user_queries(), 0)
+        self.assertEqual(user_cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_saving_or_deleting_the_user_invalidates_the_entry(self):
+        self.comment()
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertEqual(user_cache.stats()['size'], 0)
+
+        self.comment()
+        self.assertEqual(user_cache.get(self.user.id).username, 'renamed')
+        self.user.delete()
+        self.assertIsNone(user_cache.get(self.user.id))
+
+    def test_entries_expire_and_size_is_bounded(self):
+        cache = type(user_cache)(max_size=2, ttl=0)
+        cache.set(1, self.user)
+        self.assertIsNone(cache.get(1))
+
+        cache.ttl = 60
+        for user_id in (1, 2, 3):
+            cache.set(user_id, self.user)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+
+    @override_settings(JWT_USER_RESOLUTION='claims')
+    def test_claims_mode_never_loads_the_user(self):
+        self.assertEqual(self.count_user_queries(), 0)
+        self.assertEqual(user_cache.stats()['misses'], 0)
+
+        comment = Comment.objects.get()
+        response = self.client.put(
+            reverse('comment-update-delete', kwargs={'comment_id': comment.id}),
+            {'content': 'edited'}, format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='writer')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+        self.other = Post.objects.create(title='Other', content='content', image='media/post.jpg', author=self.user)
+        self.comments_url = reverse('post-comments', kwargs={'post_id': self.post.id})
+        self.other_comments_url = reverse('post-comments', kwargs={'post_id': self.other.id})
+
+    def add_comment(self, post):
+        return self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': post.id}), {'content': 'hi'}, format='json', **self.auth,
+        )
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        first = self.client.get(reverse('post-list'))
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('post-list'))
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_if_none_match_returns_not_modified(self):
+        etag = self.client.get(self.comments_url)['ETag']
+        response = self.client.get(self.comments_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_comment_writes_only_invalidate_their_thread_and_the_feed(self):
+        self.client.get(self.comments_url)
+        self.client.get(self.other_comments_url)
+        self.client.get(reverse('post-list'))
+
+        comment_id = self.add_comment(self.post).data['id']
+        self.assertEqual(len(self.client.get(self.comments_url).data), 1)
+        with self.assertNumQueries(0):
+            self.client.get(self.other_comments_url)
+        # The feed shows comment counts, so it is refreshed too
+        self.assertEqual(self.client.get(reverse('post-list')).data['results'][1]['comment_count'], 1)
+
+        self.client.put(
+            reverse('comment-update-delete', kwargs={'comment_id': comment_id}),
+            {'content': 'edited'}, format='json', **self.auth,
+        )
+        self.assertEqual(self.client.get(self.comments_url).data[0]['content'], 'edited')
+
+        self.client.delete(reverse('comment-update-delete', kwargs={'comment_id': comment_id}), **self.auth)
+        self.assertEqual(self.client.get(self.comments_url).data, [])
+
+    def test_post_writes_invalidate_the_feed(self):
+        etag = self.client.get(reverse('post-list'))['ETag']
+        self.client.put(
+            reverse('post-update-delete', kwargs={'post_id': self.post.id}),
+            {'title': 'Renamed'}, format='json', **self.auth,
+        )
+        response = self.client.get(reverse('post-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Renamed', [post['title'] for post in response.data['results']])
+
+        self.client.delete(reverse('post-update-delete', kwargs={'post_id': self.post.id}), **self.auth)
+        self.assertEqual(len(self.client.get(reverse('post-list')).data['results']), 1)
+
+
+class AsyncReadViewTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='reader')
+        Post.objects.bulk_create([
+            Post(title=f'Post {i}', content='content', image='media/post.jpg', author=self.user)
+            for i in range(5)
+        ])
+        self.post = Post.objects.first()
+        root = Comment.objects.create(post=self.post, user=self.user, content='root')
+        Comment.objects.create(post=self.post, user=self.user, content='reply', parent_comment=root)
+
+    async def test_async_feed_matches_sync_feed(self):
+        sync = await sync_to_async(self.client.get)(reverse('post-list') + '?page_size=2')
+        response = await self.async_client.get(reverse('post-list-async') + '?page_size=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['results'], sync.json()['results'])
+        self.assertIn('/post/async/?', data['next'])
+
+        response = await self.async_client.get(data['next'])
+        self.assertEqual(len(response.json()['results']), 2)
+
+    async def test_async_comments_match_sync_comments(self):
+        url_kwargs = {'post_id': self.post.id}
+        sync = await sync_to_async(self.client.get)(reverse('post-comments', kwargs=url_kwargs))
+        response = await self.async_client.get(reverse('post-comments-async', kwargs=url_kwargs))
+        self.assertEqual(response.content, sync.content)
+
+    async def test_async_views_reject_bad_parameters(self):
+        response = await self.async_client.get(reverse('post-list-async') + '?cursor=bogus')
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get(
+            reverse('post-comments-async', kwargs={'post_id': self.post.id}) + '?max_depth=-2'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+def make_image(width=1600, height=900, image_format='JPEG', noise=False, **save_options):
+    buffer = io.BytesIO()
+    if noise:
+        image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    else:
+        image = Image.new('RGB', (width, height), (200, 30, 30))
+    image.save(buffer, image_format, **save_options)
+    return buffer.getvalue()
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_override = self.settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='photographer')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def upload(self, **image_options):
+        exif = Image.Exif()
+        exif[0x010F] = 'SecretCamera'
+        image = SimpleUploadedFile('photo.jpg', make_image(exif=exif, **image_options), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                reverse('post-create'), {'title': 'Photo', 'content': 'content', 'image': image}, format='multipart',
+            )
+        self.assertEqual(response.status_code, 201)
+        # Image variants and the timeline fan-out
+        self.assertEqual(len(callbacks), 2)
+        return Post.objects.get(id=response.data['id'])
+
+    def test_variants_are_resized_compressed_and_stripped(self):
+        post = self.upload()
+        generate_variants(post.id)
+        post.refresh_from_db()
+
+        self.assertEqual(set(post.image_variants), {'webp', 'jpeg'})
+        self.assertEqual(list(post.image_variants['webp']), ['320', '640', '1280'])
+        for image_format, names in post.image_variants.items():
+            for width, name in names.items():
+                with default_storage.open(name) as variant_file:
+                    variant = Image.open(variant_file)
+                    self.assertEqual(variant.width, int(width))
+                    self.assertEqual(variant.format, image_format.upper())
+                    self.assertEqual(len(variant.getexif()), 0)
+                self.assertLess(default_storage.size(name), post.image.size)
+
+    def test_small_images_are_not_upscaled(self):
+        post = self.upload(width=500, height=300)
+        generate_variants(post.id)
+        post.refresh_from_db()
+        self.assertEqual(list(post.image_variants['jpeg']), ['320', '640'])
+        with default_storage.open(post.image_variants['jpeg']['640']) as variant_file:
+            self.assertEqual(Image.open(variant_file).width, 500)
+
+    def test_serializer_exposes_variant_urls(self):
+        post = self.upload()
+        self.client.get(reverse('post-list'))
+        generate_variants(post.id)
+        result = self.client.get(reverse('post-list')).data['results'][0]
+        self.assertTrue(result['image_variants']['webp']['320'].startswith('http://testserver/media/media/variants/'))
+
+    def test_replacing_the_image_regenerates_variants(self):
+        post = self.upload()
+        generate_variants(post.id)
+        old_names = list(Post.objects.get(id=post.id).image_variants['webp'].values())
+
+        replacement = SimpleUploadedFile('new.jpg', make_image(800, 600), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.put(reverse('post-update-delete', kwargs={'post_id': post.id}), {'image': replacement})
+        self.assertEqual(len(callbacks), 1)
+
+        generate_variants(post.id)
+        self.assertEqual(list(Post.objects.get(id=post.id).image_variants['webp']), ['320', '640', '1280'])
+        self.assertFalse(any(default_storage.exists(name) for name in old_names))
+
+    def test_deleting_the_post_deletes_its_files(self):
+        post = self.upload()
+        generate_variants(post.id)
+        post.refresh_from_db()
+        names = [post.image.name, *post.image_variants['webp'].values(), *post.image_variants['jpeg'].values()]
+
+        with mock.patch.object(queue, 'broker', DatabaseBroker()):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.delete(reverse('post-update-delete', kwargs={'post_id': post.id}))
+            self.assertEqual(response.status_code, 204)
+            self.assertTrue(all(default_storage.exists(name) for name in names))
+            with self.captureOnCommitCallbacks(execute=True):
+                purge_post(post.id)
+        job = Job.objects.get(name='post.images.delete_files')
+        self.assertEqual((job.name, job.key), ('post.images.delete_files', f'post-files:{post.id}'))
+        self.assertEqual(sorted(job.args[0]), sorted(names))
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+
+        delete_files(*job.args)
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        override = self.settings(MEDIA_ROOT=self.tmp, FILE_UPLOAD_TEMP_DIR=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='uploader')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.image = make_image(300, 200, 'PNG', noise=True)
+
+    def start(self, size=None, content_type='image/png'):
+        return self.client.post(reverse('image-upload-create'), {
+            'filename': 'big.png', 'content_type': content_type, 'size': size or len(self.image),
+        }, format='json')
+
+    def send(self, upload_id, offset, chunk):
+        return self.client.generic(
+            'PATCH', reverse('image-upload-chunk', kwargs={'upload_id': upload_id}), chunk,
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def upload(self, chunk_size=64 * 1024):
+        upload_id = self.start().data['id']
+        for offset in range(0, len(self.image), chunk_size):
+            response = self.send(upload_id, offset, self.image[offset:offset + chunk_size])
+            self.assertEqual(response.status_code, 200, response.data)
+        return upload_id
+
+    def test_chunks_are_assembled_and_attached_to_a_new_post(self):
+        upload_id = self.upload()
+        upload = ImageUpload.objects.get(id=upload_id)
+        self.assertEqual((upload.status, upload.width, upload.height), (ImageUpload.COMPLETE, 300, 200))
+
+        with mock.patch.object(queue, 'broker', DatabaseBroker()), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('post-create'), {
+                'title': 'Chunked', 'content': 'content', 'upload_id': str(upload_id),
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        post = Post.objects.get(id=response.data['id'])
+        with post.image.open('rb') as stored:
+            self.assertEqual(stored.read(), self.image)
+        self.assertFalse(os.path.exists(upload.temp_path))
+        self.assertEqual(ImageUpload.objects.get(id=upload_id).status, ImageUpload.ATTACHED)
+
+    def test_rolled_back_attachments_keep_the_upload(self):
+        upload = ImageUpload.objects.get(id=self.upload())
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            attach_upload(upload, Post(title='Lost', content='content', author=self.user), save=False)
+            raise RuntimeError('batch failed')
+        self.assertTrue(os.path.exists(upload.temp_path))
+        self.assertEqual(ImageUpload.objects.get(id=upload.id).status, ImageUpload.COMPLETE)
+
+    def test_an_upload_attached_meanwhile_is_not_attached_again(self):
+        upload = ImageUpload.objects.get(id=self.upload())
+        ImageUpload.objects.filter(pk=upload.pk).update(status=ImageUpload.ATTACHED)
+        post = Post(title='Late', content='content', author=self.user)
+        with self.assertRaises(UploadConflict):
+            attach_upload(upload, post)
+        self.assertFalse(post.image)
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'media')), [])
+
+    def test_upload_can_replace_the_image_of_an_existing_post(self):
+        post = Post.objects.create(title='Post', content='content', image='media/old.jpg', author=self.user)
+        upload_id = self.upload()
+        response = self.client.put(
+            reverse('post-update-delete', kwargs={'post_id': post.id}), {'upload_id': str(upload_id)}, format='json',
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        post.refresh_from_db()
+        self.assertNotEqual(post.image.name, 'media/old.jpg')
+
+    def test_interrupted_upload_resumes_from_the_acknowledged_offset(self):
+        upload_id = self.start().data['id']
+        self.send(upload_id, 0, self.image[:5000])
+        status_response = self.client.get(reverse('image-upload-chunk', kwargs={'upload_id': upload_id}))
+        self.assertEqual(status_response.data['offset'], 5000)
+
+        self.assertEqual(self.send(upload_id, 4000, self.image[4000:]).status_code, 409)
+        response = self.send(upload_id, 5000, self.image[5000:])
+        self.assertEqual(response.data['status'], ImageUpload.COMPLETE)
+
+    def test_stale_chunks_leave_the_file_alone(self):
+        upload_id = self.start().data['id']
+        stale = ImageUpload.objects.get(id=upload_id)
+        self.send(upload_id, 0, self.image[:5000])
+        # A request that read the upload before the first chunk landed
+        with self.assertRaises(UploadConflict):
+            append_chunk(stale, 0, io.BytesIO(b'x' * 100), 100)
+        with open(stale.temp_path, 'rb') as partial:
+            self.assertEqual(partial.read(), self.image[:5000])
+
+    def test_chunks_are_streamed_outside_transactions(self):
+        upload = ImageUpload.objects.get(id=self.start().data['id'])
+        depth = len(connection.savepoint_ids)
+        image = self.image
+        reads = []
+
+        class Stream(io.BytesIO):
+            def read(self, size=-1):
+                reads.append((len(connection.savepoint_ids), ImageUpload.objects.get(pk=upload.pk).leased_until))
+                return super().read(size)
+
+        append_chunk(upload, 0, Stream(image), len(image))
+        self.assertTrue(all(savepoints == depth and leased for savepoints, leased in reads))
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.leased_until), (ImageUpload.COMPLETE, None))
+
+    def test_a_leased_upload_takes_no_other_chunk_until_the_lease_ends(self):
+        upload_id = self.start().data['id']
+        ImageUpload.objects.filter(id=upload_id).update(leased_until=timezone.now() + timedelta(minutes=1))
+        response = self.send(upload_id, 0, self.image[:5000])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['detail'], 'Another request is writing to this upload.')
+
+        ImageUpload.objects.filter(id=upload_id).update(leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.send(upload_id, 0, self.image[:5000]).data['offset'], 5000)
+
+    def test_abandoned_uploads_expire(self):
+        abandoned = self.start().data['id']
+        self.send(abandoned, 0, self.image[:5000])
+        attached = self.upload()
+        with mock.patch.object(queue, 'broker', DatabaseBroker()), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('post-create'), {
+                'title': 'Kept', 'content': 'content', 'upload_id': str(attached),
+            }, format='json')
+        ImageUpload.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        recent = self.start().data['id']
+        temp_path = ImageUpload.objects.get(id=abandoned).temp_path
+
+        out = io.StringIO()
+        call_command('expire_uploads', stdout=out)
+        self.assertIn('Deleted 1 abandoned uploads.', out.getvalue())
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertEqual(set(ImageUpload.objects.values_list('id', flat=True)), {attached, recent})
+
+    def test_oversize_uploads_are_refused_early(self):
+        self.assertEqual(self.start(size=500 * 1024 * 1024).status_code, 413)
+        upload_id = self.start().data['id']
+        self.assertEqual(self.send(upload_id, 0, self.image + b'extra').status_code, 413)
+
+    def test_content_is_checked_from_the_first_chunk(self):
+        upload_id = self.start(content_type='image/jpeg').data['id']
+        response = self.send(upload_id, 0, self.image[:2048])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ImageUpload.objects.filter(id=upload_id).exists())
+
+        self.assertEqual(self.start(content_type='application/pdf').status_code, 400)
+
+    def test_oversized_dimensions_are_rejected(self):
+        self.image = make_image(12000, 10, 'PNG')
+        upload_id = self.start().data['id']
+        self.assertEqual(self.send(upload_id, 0, self.image[:1024]).status_code, 400)
+
+    def test_uploads_belong_to_their_user(self):
+        upload_id = self.upload()
+        other = User.objects.create_user(username='intruder')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(other)}')
+        response = self.client.post(reverse('post-create'), {
+            'title': 'Stolen', 'content': 'content', 'upload_id': str(upload_id),
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class CommentCounterTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='counter')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+
+    def reply(self, parent=None):
+        response = self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': self.post.id}),
+            {'content': 'comment', 'parent_comment': parent.id if parent else None},
+            format='json',
+        )
+        return Comment.objects.get(id=response.data['id'])
+
+    def counts(self, *comments):
+        self.post.refresh_from_db()
+        return [self.post.comment_count] + [Comment.objects.get(id=c.id).reply_count for c in comments]
+
+    def test_counters_follow_creates_and_deletes(self):
+        root = self.reply()
+        child = self.reply(root)
+        grandchild = self.reply(child)
+        self.reply(child)
+        leaf = self.reply(root)
+        self.assertEqual(self.counts(root, child), [5, 2, 2])
+
+        # A placeholder still counts as a reply, but not as a comment of the post
+        self.client.delete(reverse('comment-update-delete', kwargs={'comment_id': child.id}))
+        self.assertEqual(self.counts(root, child), [4, 2, 2])
+        self.client.delete(reverse('comment-update-delete', kwargs={'comment_id': leaf.id}))
+        self.client.delete(reverse('comment-update-delete', kwargs={'comment_id': grandchild.id}))
+        self.assertEqual(self.counts(root, child), [2, 1, 1])
+
+        Post.objects.update(comment_count=0)
+        Comment.objects.update(reply_count=0)
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.assertEqual(self.counts(root), [2, 1])
+
+    def test_counters_are_serialized(self):
+        root = self.reply()
+        self.reply(root)
+        feed = self.client.get(reverse('post-list')).json()
+        self.assertEqual(feed['results'][0]['comment_count'], 2)
+        thread = self.client.get(reverse('post-comments', kwargs={'post_id': self.post.id})).json()
+        self.assertEqual(thread[0]['reply_count'], 1)
+
+    def test_reconcile_command_repairs_drift(self):
+        root = self.reply()
+        self.reply(root)
+        Post.objects.update(comment_count=40)
+        Comment.objects.filter(id=root.id).update(reply_count=0)
+
+        out = io.StringIO()
+        call_command('reconcile_counters', '--dry-run', stdout=out)
+        self.assertIn('1 posts and 1 comments', out.getvalue())
+
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.assertEqual(self.counts(root), [2, 1])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        inverted_index.clear()
+        user_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='searcher')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.url = reverse('post-search')
+        self.garden = Post.objects.create(
+            title='Tomato garden', content='Growing tomatoes on the balcony all summer.',
+            image='media/post.jpg', author=self.user,
+        )
+        self.kitchen = Post.objects.create(
+            title='Kitchen notes', content='A sauce made with one garden tomato and basil.',
+            image='media/post.jpg', author=self.user,
+        )
+        Comment.objects.create(post=self.kitchen, user=self.user, content='My garden has basil too')
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_results_are_ranked_with_highlighted_snippets(self):
+        data = self.search(q='garden')
+        self.assertEqual(data['count'], 3)
+        # The title match outranks matches in body text
+        self.assertEqual((data['results'][0]['type'], data['results'][0]['id']), ('post', self.garden.id))
+        comment = next(result for result in data['results'] if result['type'] == 'comment')
+        self.assertEqual(comment['post'], self.kitchen.id)
+        self.assertIn('<mark>garden</mark>', comment['snippet'])
+
+    def test_all_terms_must_match_and_type_filters(self):
+        data = self.search(q='garden basil')
+        self.assertEqual({(r['type'], r['post']) for r in data['results']}, {('post', self.kitchen.id), ('comment', self.kitchen.id)})
+        data = self.search(q='garden basil', type='comment')
+        self.assertEqual([r['type'] for r in data['results']], ['comment'])
+
+    def test_index_follows_writes(self):
+        self.search(q='garden')
+        self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': self.garden.id}), {'content': 'zucchini everywhere'},
+            format='json',
+        )
+        self.assertEqual(self.search(q='zucchini')['count'], 1)
+
+        self.client.put(
+            reverse('post-update-delete', kwargs={'post_id': self.garden.id}), {'title': 'Cucumber garden'},
+            format='json',
+        )
+        self.assertEqual(self.search(q='cucumber')['count'], 1)
+        self.assertEqual(self.search(q='tomato')['count'], 1)
+
+        self.client.delete(reverse('post-update-delete', kwargs={'post_id': self.garden.id}))
+        self.assertEqual(self.search(q='zucchini')['count'], 0)
+
+    def test_pagination(self):
+        for i in range(5):
+            Post.objects.create(title=f'Garden {i}', content='garden', image='media/post.jpg', author=self.user)
+        first = self.search(q='garden', page_size=3)
+        self.assertEqual(first['count'], 8)
+        self.assertIsNone(first['previous'])
+        second = self.client.get(first['next']).data
+        third = self.client.get(second['next']).data
+        self.assertIsNone(third['next'])
+        ids = [(r['type'], r['id']) for page in (first, second, third) for r in page['results']]
+        self.assertEqual(len(set(ids)), 8)
+
+    def test_snippets_are_escaped_by_both_backends(self):
+        Comment.objects.create(post=self.garden, user=self.user, content='<script>garden()</script> beds')
+        snippet = self.search(q='beds')['results'][0]['snippet']
+        self.assertEqual(snippet, '&lt;script&gt;garden()&lt;/script&gt; <mark>beds</mark>')
+        # PostgreSQL's headline of the same text, with its match markers
+        self.assertEqual(escape_headline('<script>garden()</script> \x02beds\x03'), snippet)
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'q': 'x', 'type': 'user'}).status_code, 400)
+
+
+class CommentStreamTests(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        # Deleting a comment queues its purge, which must not run on a thread against the test database
+        patcher = mock.patch.object(queue, 'broker', DatabaseBroker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='streamer')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+
+    def write(self, method, url, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(self.client, method)(url, data, format='json')
+
+    async def next_event(self, stream):
+        chunk = await asyncio.wait_for(anext(stream), 2)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        lines = dict(line.split(': ', 1) for line in chunk.strip().splitlines())
+        return lines['event'], json.loads(lines['data'])
+
+    async def test_stream_receives_incremental_comment_events(self):
+        response = await self.async_client.get(reverse('post-comments-stream', kwargs={'post_id': self.post.id}))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertIn('retry', (await anext(stream)).decode())
+        self.assertEqual(broker.subscriber_count(comments_channel(self.post.id)), 1)
+
+        create_url = reverse('post-comment-create', kwargs={'post_id': self.post.id})
+        created = await sync_to_async(self.write)('post', create_url, {'content': 'live'})
+        event, data = await self.next_event(stream)
+        self.assertEqual((event, data['id'], data['content']), ('comment.created', created.data['id'], 'live'))
+
+        comment_url = reverse('comment-update-delete', kwargs={'comment_id': created.data['id']})
+        await sync_to_async(self.write)('put', comment_url, {'content': 'edited'})
+        event, data = await self.next_event(stream)
+        self.assertEqual((event, data['content']), ('comment.updated', 'edited'))
+
+        await sync_to_async(self.write)('delete', comment_url)
+        event, data = await self.next_event(stream)
+        self.assertEqual((event, data), ('comment.deleted', {'id': created.data['id'], 'parent_comment': None, 'removed': 1}))
+
+        # A client disconnect cancels the task that is waiting for the next event
+        waiting = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(broker.subscriber_count(comments_channel(self.post.id)), 0)
+
+    async def test_slow_subscribers_are_dropped(self):
+        local_broker = InProcessBroker(max_pending=2)
+        slow = local_broker.subscribe('channel')
+        for i in range(3):
+            local_broker.publish('channel', {'type': 'comment.created', 'data': str(i)})
+        await asyncio.sleep(0)
+        self.assertTrue(slow.overflowed)
+        self.assertEqual(local_broker.subscriber_count('channel'), 0)
+
+    async def test_publishing_from_another_thread(self):
+        local_broker = InProcessBroker()
+        subscriptions = [local_broker.subscribe('channel') for _ in range(3)]
+        await sync_to_async(local_broker.publish, thread_sensitive=False)('channel', {'type': 't', 'data': '1'})
+        events = [await subscription.get(timeout=1) for subscription in subscriptions]
+        self.assertEqual(events, [{'type': 't', 'data': '1'}] * 3)
+
+
+    async def test_redis_listener_resubscribes_after_losing_the_connection(self):
+        event = {'type': 'comment.created', 'data': '1'}
+        redis_broker = FlakyRedisBroker([
+            [ConnectionError('connection reset')],
+            [{'type': 'pmessage', 'channel': b'channel', 'data': json.dumps(event).encode()}],
+        ])
+        subscription = redis_broker.subscribe('channel')
+        try:
+            with self.assertLogs('post.broker', 'ERROR'):
+                self.assertEqual(await subscription.get(timeout=1), event)
+            self.assertFalse(redis_broker.listener.done())
+            self.assertEqual([client.closed for client in redis_broker.clients], [True, False])
+        finally:
+            redis_broker.listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await redis_broker.listener
+
+
+class FlakyRedisBroker(RedisBroker):
+    """
+    Replays one list of messages per connection; an exception in the list drops the
+    connection there.
+    """
+    reconnect_delay = 0
+
+    def __init__(self, connections):
+        InProcessBroker.__init__(self)
+        self.listener = None
+        self.connections = iter(connections)
+        self.clients = []
+
+    def connect(self):
+        self.clients.append(FakeRedisClient(next(self.connections)))
+        return self.clients[-1]
+
+
+class FakeRedisClient:
+    def __init__(self, messages):
+        self.messages = messages
+        self.closed = False
+
+    def pubsub(self):
+        return self
+
+    async def psubscribe(self, pattern):
+        pass
+
+    async def listen(self):
+        for message in self.messages:
+            if isinstance(message, Exception):
+                raise message
+            yield message
+        # Then stays connected
+        await asyncio.Event().wait()
+
+    async def aclose(self):
+        self.closed = True
+
+
+class BulkWriteTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        override = self.settings(MEDIA_ROOT=self.tmp, FILE_UPLOAD_TEMP_DIR=self.tmp, REST_FRAMEWORK=throttle_rates())
+        override.enable()
+        self.addCleanup(override.disable)
+
+        response_cache().clear()
+        user_cache.clear()
+        inverted_index.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='importer')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+
+    def completed_upload(self):
+        content = make_image(40, 30, 'PNG')
+        upload = ImageUpload.objects.create(
+            user=self.user, filename='import.png', content_type='image/png', size=len(content),
+            received=len(content), width=40, height=30, status=ImageUpload.COMPLETE,
+        )
+        with open(upload.temp_path, 'wb') as out:
+            out.write(content)
+        return upload
+
+    def send(self, name, items):
+        with self.captureOnCommitCallbacks():
+            return self.client.post(reverse(name), items, format='json')
+
+    def test_comments_can_reply_to_items_of_the_same_batch(self):
+        existing = Comment.objects.create(post=self.post, user=self.user, content='existing')
+        response = self.send('comment-bulk-create', [
+            {'ref': 'a', 'post': self.post.id, 'content': 'root'},
+            {'ref': 'b', 'post': self.post.id, 'content': 'child', 'parent_ref': 'a'},
+            {'ref': 'c', 'post': self.post.id, 'content': 'grandchild', 'parent_ref': 'b'},
+            {'post': self.post.id, 'content': 'reply to existing', 'parent_comment': existing.id},
+            {'ref': 'd', 'post': self.post.id, 'content': 'dangling', 'parent_ref': 'missing'},
+            {'post': self.post.id, 'content': 'orphaned', 'parent_ref': 'd'},
+        ])
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual((response.data['created'], response.data['failed']), (4, 2))
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], [201, 201, 201, 201, 400, 400])
+        self.assertIn('parent_ref', results[4]['errors'])
+        self.assertEqual(results[5]['errors']['parent_ref'], ['The referenced item was not created.'])
+
+        root, child, grandchild = (Comment.objects.get(id=results[i]['data']['id']) for i in range(3))
+        self.assertEqual(child.parent_comment_id, root.id)
+        self.assertEqual((grandchild.depth, grandchild.path), (2, child.path + str(grandchild.id).zfill(10)))
+        self.assertEqual(list(Comment.objects.descendants(root)), [child, grandchild])
+        self.assertEqual((root.reply_count, child.reply_count), (1, 1))
+        self.assertEqual(results[0]['data']['reply_count'], 1)
+        existing.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((existing.reply_count, self.post.comment_count), (1, 4))
+
+        thread = self.client.get(reverse('post-comments', kwargs={'post_id': self.post.id})).json()
+        self.assertEqual(thread[1]['replies'][0]['replies'][0]['content'], 'grandchild')
+        search_results = self.client.get(reverse('post-search'), {'q': 'grandchild'}).json()['results']
+        self.assertEqual([result['id'] for result in search_results], [grandchild.id])
+
+    def test_batch_replies_are_capped_at_the_max_depth(self):
+        deep = Comment.objects.create(post=self.post, user=self.user, content='deep')
+        Comment.objects.filter(pk=deep.pk).update(depth=Comment.MAX_DEPTH - 1)
+        response = self.send('comment-bulk-create', [
+            {'ref': 'a', 'post': self.post.id, 'content': 'deepest', 'parent_comment': deep.id},
+            {'post': self.post.id, 'content': 'too deep', 'parent_ref': 'a'},
+        ])
+        self.assertEqual(response.status_code, 207, response.data)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], [201, 400])
+        self.assertEqual(results[1]['errors']['parent_ref'], ['This thread is nested too deeply to reply to.'])
+
+    def test_comment_batch_query_count_does_not_grow_with_its_size(self):
+        def queries(size):
+            items = [{'ref': 'root', 'post': self.post.id, 'content': 'root'}]
+            items += [{'post': self.post.id, 'content': f'reply {i}', 'parent_ref': 'root'} for i in range(size)]
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.send('comment-bulk-create', items).status_code, 201)
+            return len(context.captured_queries)
+
+        queries(1)  # Resolves and caches the requesting user
+        self.assertEqual(queries(5), queries(50))
+
+    def test_posts_are_created_with_per_item_results(self):
+        upload = self.completed_upload()
+        response = self.send('post-bulk-create', [
+            {'title': 'First', 'content': 'imported', 'upload_id': str(upload.id)},
+            {'title': 'Second', 'content': 'imported', 'upload_id': str(upload.id)},
+            {'title': 'Third', 'content': 'no image'},
+        ])
+        self.assertEqual(response.status_code, 207, response.data)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], [201, 400, 400])
+        self.assertEqual(results[0]['data']['author'], {'id': self.user.id, 'username': 'importer'})
+        self.assertIn('upload_id', results[1]['errors'])
+        self.assertIn('image', results[2]['errors'])
+
+        post = Post.objects.get(id=results[0]['data']['id'])
+        with post.image.open('rb') as stored:
+            self.assertEqual(stored.read()[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(ImageUpload.objects.get(id=upload.id).status, ImageUpload.ATTACHED)
+        feed = self.client.get(reverse('post-list')).json()
+        self.assertEqual(feed['results'][0]['title'], 'First')
+
+    def test_uploads_attached_during_a_batch_fail_their_items(self):
+        taken, kept = self.completed_upload(), self.completed_upload()
+        atomic = transaction.atomic
+
+        def attach_meanwhile(*args, **kwargs):
+            # Another request attaches one after the batch validated it
+            if ImageUpload.objects.filter(pk=taken.pk, status=ImageUpload.COMPLETE).exists():
+                ImageUpload.objects.filter(pk=taken.pk).update(status=ImageUpload.ATTACHED)
+            return atomic(*args, **kwargs)
+
+        with mock.patch('post.bulk.transaction.atomic', attach_meanwhile):
+            response = self.send('post-bulk-create', [
+                {'title': 'Taken', 'content': 'imported', 'upload_id': str(taken.id)},
+                {'title': 'Kept', 'content': 'imported', 'upload_id': str(kept.id)},
+            ])
+        self.assertEqual(response.status_code, 207, response.data)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], [400, 201])
+        self.assertEqual(results[0]['errors'], {'upload_id': ['No completed upload with this id.']})
+        self.assertEqual(list(Post.objects.filter(title__in=['Taken', 'Kept']).values_list('title', flat=True)), ['Kept'])
+        self.assertEqual(ImageUpload.objects.get(id=kept.id).status, ImageUpload.ATTACHED)
+
+    def test_malformed_batches_are_rejected(self):
+        self.assertEqual(self.send('post-bulk-create', {'title': 'Not a list'}).status_code, 400)
+        self.assertEqual(self.send('comment-bulk-create', []).status_code, 400)
+        response = self.send('comment-bulk-create', [{'post': 0, 'content': 'x'}] * 501)
+        self.assertEqual(response.status_code, 400)
+        response = self.send('comment-bulk-create', [{'post': self.post.id + 1, 'content': 'x'}, 'junk'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['results'][0]['errors'], {'post': ['Post not found.']})
+
+
+class FastSerializationTests(TestCase):
+    TRICKY = 'Caf\u00e9 \u2603 \U0001f600 "quoted" back\\slash tab\t new\nline \x01 \u2028 \u2029 </script>'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='\u00fcnicode')
+        self.request = APIRequestFactory().get('/post/')
+        self.posts = [
+            Post.objects.create(title=self.TRICKY, content=self.TRICKY * 20, image='media/post.jpg', author=self.user),
+            Post.objects.create(title='Plain', content='short', image='', author=self.user),
+        ]
+        Post.objects.filter(pk=self.posts[0].pk).update(
+            image_variants={'webp': {'320': 'media/variants/1/a-320.webp'}},
+            created_at=timezone.now().replace(microsecond=0),
+        )
+        root = Comment.objects.create(post=self.posts[0], user=self.user, content=self.TRICKY)
+        Comment.objects.create(post=self.posts[0], user=self.user, content='reply', parent_comment=root)
+
+    def test_post_rows_match_post_serializer_byte_for_byte(self):
+        for fields in (None, ['id', 'title', 'excerpt'], ['author', 'content', 'excerpt', 'image', 'updated_at']):
+            posts = Post.objects.select_related('author').order_by('-created_at', '-id')
+            expected = JSONRenderer().render(
+                PostSerializer(posts, many=True, fields=fields, context={'request': self.request}).data
+            )
+            rows = post_values(fields).order_by('-created_at', '-id')
+            actual = FastJSONRenderer().render(post_representations(rows, fields, self.request))
+            self.assertEqual(actual, expected)
+        self.assertIn(b'\\u2028', actual)
+
+    def test_comment_rows_match_flat_comment_serializer_byte_for_byte(self):
+        comments = Comment.objects.order_by('created_at', 'id')
+        expected = JSONRenderer().render(FlatCommentSerializer(comments, many=True).data)
+        self.assertEqual(FastJSONRenderer().render(comment_representations(comments)), expected)
+
+    def test_feed_and_thread_responses_are_unchanged(self):
+        client = APIClient()
+        response = client.get(reverse('post-list'))
+        posts = Post.objects.select_related('author').order_by('-created_at', '-id')
+        data = PostSerializer(posts, many=True, context={'request': response.wsgi_request}).data
+        self.assertEqual(response.content, JSONRenderer().render({'next': None, 'results': data}))
+
+        response = client.get(reverse('post-comments', kwargs={'post_id': self.posts[0].id}))
+        root = Comment.objects.get(parent_comment=None)
+        self.assertEqual(response.content, JSONRenderer().render([CommentSerializer(root).data]))
+
+    def test_indented_output_falls_back_to_json_renderer(self):
+        data = {'text': self.TRICKY, 'when': timezone.now()}
+        for media_type in (None, 'application/json; indent=2'):
+            self.assertEqual(FastJSONRenderer().render(data, media_type), JSONRenderer().render(data, media_type))
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        override = self.settings(INSTRUMENTATION={**settings.INSTRUMENTATION, 'LOG_REQUESTS': True})
+        override.enable()
+        self.addCleanup(override.disable)
+        response_cache().clear()
+        registry.clear()
+        self.user = User.objects.create_user(username='measured')
+        for i in range(3):
+            Post.objects.create(title=f'Post {i}', content='content', image='media/post.jpg', author=self.user)
+
+    def test_requests_get_server_timing_and_a_structured_log_record(self):
+        with self.assertLogs('main_thought_stream.requests', 'INFO') as logs:
+            response = self.client.get(reverse('post-list'))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="1 queries", serialize;dur=[\d.]+, total;dur=[\d.]+$')
+
+        record = logs.records[0].request
+        self.assertEqual((record['endpoint'], record['status'], record['db_queries']), ('post-list', 200, 1))
+        self.assertEqual(record['response_bytes'], len(response.content))
+        self.assertGreater(record['serialize_ms'], 0)
+
+    async def test_async_views_count_queries_run_in_worker_threads(self):
+        with self.assertLogs('main_thought_stream.requests', 'INFO') as logs:
+            await self.async_client.get(reverse('post-list-async'))
+        self.assertEqual(logs.records[0].request['db_queries'], 1)
+
+    def test_metrics_endpoint_exposes_per_endpoint_histograms(self):
+        with self.assertLogs('main_thought_stream.requests', 'INFO'):
+            self.client.get(reverse('post-list'))
+            self.client.get(reverse('post-list'))
+            body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_requests_total{method="GET",endpoint="post-list",status="200"} 2', body)
+        self.assertIn('http_request_db_queries_bucket{method="GET",endpoint="post-list",le="1"} 2', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",endpoint="post-list"} 2', body)
+        self.assertIn('# TYPE http_response_size_bytes histogram', body)
+
+        with self.settings(INSTRUMENTATION={'METRICS_TOKEN': 'secret', 'LOG_REQUESTS': False}):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+    @override_settings(INSTRUMENTATION={})
+    def test_user_cache_counters_are_exposed(self):
+        user_cache.clear()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        for _ in range(3):
+            client.get(reverse('post-timeline'))
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('# TYPE jwt_user_cache_hits_total counter\njwt_user_cache_hits_total 2\n', body)
+        self.assertIn('jwt_user_cache_misses_total 1\n', body)
+        self.assertIn('jwt_user_cache_entries 1\n', body)
+
+    @override_settings(INSTRUMENTATION={})
+    def test_metrics_are_internal_without_a_token(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.7').status_code, 200)
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='93.184.216.34').status_code, 403)
+        forwarded = self.client.get(reverse('metrics'), HTTP_X_FORWARDED_FOR='93.184.216.34')
+        self.assertEqual(forwarded.status_code, 403)
+        with self.settings(INSTRUMENTATION={'METRICS_PUBLIC': True}):
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='93.184.216.34').status_code, 200)
+
+    def test_repeated_query_shapes_are_flagged_as_n_plus_one(self):
+        def view(request):
+            for post in Post.objects.all():
+                User.objects.get(pk=post.author_id)
+            Post.objects.filter(id__in=[1, 2]).count()
+            Post.objects.filter(id__in=[1, 2, 3]).count()
+            return HttpResponse('ok')
+
+        middleware = InstrumentationMiddleware(view)
+        settings = {'DETECT_N_PLUS_ONE': True, 'N_PLUS_ONE_THRESHOLD': 3, 'LOG_REQUESTS': False}
+        with self.settings(INSTRUMENTATION=settings), self.assertLogs('main_thought_stream.requests') as logs:
+            middleware(RequestFactory().get('/'))
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].request['count'], 3)
+        self.assertIn('auth_user', logs.records[0].request['repeated_query'])
+
+
+class TimelineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        response_cache().clear()
+        user_cache.clear()
+        self.reader = User.objects.create_user(username='reader')
+        self.followed = User.objects.create_user(username='followed')
+        self.stranger = User.objects.create_user(username='stranger')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.reader)}')
+
+    def publish(self, author, title):
+        post = Post.objects.create(title=title, content='content', image='media/post.jpg', author=author)
+        fan_out(post.id)
+        return post
+
+    def timeline(self, **params):
+        return self.client.get(reverse('post-timeline'), params)
+
+    def test_posts_are_fanned_out_to_followers(self):
+        Follow.objects.create(follower=self.reader, followee=self.followed)
+        own = self.publish(self.reader, 'own')
+        followed = self.publish(self.followed, 'followed')
+        self.publish(self.stranger, 'stranger')
+
+        response = self.timeline()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post['id'] for post in response.data['results']], [followed.id, own.id])
+        self.assertEqual(response.data['results'][0], PostSerializer(
+            followed, context={'request': response.wsgi_request}).data)
+
+    def test_reading_a_page_does_not_join_follows(self):
+        Follow.objects.create(follower=self.reader, followee=self.followed)
+        for i in range(3):
+            self.publish(self.followed, f'post {i}')
+        self.timeline()
+        with CaptureQueriesContext(connection) as queries:
+            self.timeline()
+        # The entries and the posts; the list of pulled authors is cached
+        self.assertEqual(len(queries), 2)
+        self.assertFalse(any('user_follow' in query['sql'] for query in queries))
+
+    def test_pages_follow_the_cursor(self):
+        Follow.objects.create(follower=self.reader, followee=self.followed)
+        created = [self.publish(self.followed, f'post {i}').id for i in range(5)]
+        seen = []
+        response = self.timeline(page_size=2)
+        while True:
+            seen.extend(post['id'] for post in response.data['results'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, created[::-1])
+
+    def test_following_backfills_and_unfollowing_removes_posts(self):
+        old = self.publish(self.followed, 'before following')
+        self.assertEqual(self.timeline().data['results'], [])
+
+        response = self.client.post(reverse('user-follow', args=[self.followed.id]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([post['id'] for post in self.timeline().data['results']], [old.id])
+        self.assertEqual(FollowerCount.objects.get(user=self.followed).count, 1)
+
+        response = self.client.delete(reverse('user-follow', args=[self.followed.id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.timeline().data['results'], [])
+        self.assertEqual(FollowerCount.objects.get(user=self.followed).count, 0)
+
+    def test_high_follower_authors_are_pulled_on_read(self):
+        Follow.objects.create(follower=self.reader, followee=self.followed)
+        FollowerCount.objects.create(user=self.followed, count=10 ** 6)
+        pushed = self.publish(self.reader, 'pushed')
+        pulled = self.publish(self.followed, 'pulled')
+
+        self.assertFalse(TimelineEntry.objects.filter(post=pulled).exists())
+        self.assertEqual([post['id'] for post in self.timeline().data['results']], [pulled.id, pushed.id])
+
+    def test_trimming_keeps_the_newest_entries(self):
+        posts = [self.publish(self.reader, f'post {i}') for i in range(5)]
+        self.assertEqual(trim_timeline(self.reader.id, keep=2), 3)
+        kept = TimelineEntry.objects.filter(user=self.reader).values_list('post_id', flat=True)
+        self.assertEqual(sorted(kept), [posts[3].id, posts[4].id])
+
+    def test_fan_out_trims_the_timelines_it_writes_to(self):
+        with mock.patch.multiple(timeline, MAX_ENTRIES=2, TRIM_EVERY=1):
+            posts = [self.publish(self.reader, f'post {i}') for i in range(4)]
+        kept = TimelineEntry.objects.filter(user=self.reader).values_list('post_id', flat=True)
+        self.assertEqual(sorted(kept), [posts[2].id, posts[3].id])
+
+    def test_authors_dropping_under_the_threshold_are_backfilled(self):
+        Follow.objects.create(follower=self.reader, followee=self.followed)
+        Follow.objects.create(follower=self.stranger, followee=self.followed)
+        FollowerCount.objects.create(user=self.followed, count=2)
+        with mock.patch.object(timeline, 'FANOUT_MAX_FOLLOWERS', 1):
+            pulled = self.publish(self.followed, 'pulled')
+            self.assertFalse(TimelineEntry.objects.filter(post=pulled).exists())
+
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.stranger)}')
+            with mock.patch.object(queue, 'broker', DatabaseBroker()), self.captureOnCommitCallbacks(execute=True):
+                response = self.client.delete(reverse('user-follow', args=[self.followed.id]))
+            self.assertEqual(response.status_code, 204)
+            job = Job.objects.get(name='post.timeline.backfill_followers')
+            backfill_followers(*job.args)
+        self.assertEqual(
+            set(TimelineEntry.objects.filter(post=pulled).values_list('user_id', flat=True)),
+            {self.reader.id, self.followed.id},
+        )
+
+
+def throttle_rates(**rates):
+    return {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {
+        scope.replace('_', '.'): rate for scope, rate in rates.items()
+    }}
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.addCleanup(bucket_store.clear)
+        user_cache.clear()
+        self.user = User.objects.create_user(username='commenter')
+        self.post = Post.objects.create(title='Post', content='content', image='media/post.jpg', author=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.url = reverse('post-comment-create', kwargs={'post_id': self.post.id})
+
+    def comment(self, **extra):
+        return self.client.post(self.url, {'content': 'first'}, format='json', **extra)
+
+    def test_users_are_limited_to_their_bucket(self):
+        with self.settings(REST_FRAMEWORK=throttle_rates(comment_user='2/min')):
+            self.assertEqual(self.comment().status_code, 201)
+            self.assertEqual(self.comment().status_code, 201)
+            response = self.comment()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(Comment.objects.count(), 2)
+
+    def test_rejections_by_address_do_no_database_work(self):
+        with self.settings(REST_FRAMEWORK=throttle_rates(comment_ip='1/min')):
+            self.assertEqual(self.comment(REMOTE_ADDR='10.0.0.1').status_code, 201)
+            user_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.comment(REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(len(queries), 0)
+            self.assertEqual(self.comment(REMOTE_ADDR='10.0.0.2').status_code, 201)
+
+    def test_batches_are_charged_per_item(self):
+        url = reverse('comment-bulk-create')
+        items = [{'post': self.post.id, 'content': f'item {i}'} for i in range(3)]
+        with self.settings(REST_FRAMEWORK=throttle_rates(comment_user='4/min')):
+            self.assertEqual(self.client.post(url, items, format='json').status_code, 201)
+            # One token is left, not enough for another three items
+            self.assertEqual(self.client.post(url, items, format='json').status_code, 429)
+            self.assertEqual(self.comment().status_code, 201)
+            # Never allowed, whatever the wait
+            response = self.client.post(url, items * 2, format='json')
+        self.assertEqual(response.status_code, 429)
+        self.assertNotIn('Retry-After', response)
+        self.assertEqual(Comment.objects.count(), 4)
+
+    def test_buckets_refill_over_time(self):
+        store = MemoryBucketStore()
+        with mock.patch('main_thought_stream.throttling.time.monotonic', return_value=100.0):
+            self.assertEqual(store.take('key', 2, 1.0), (True, 0))
+            self.assertEqual(store.take('key', 2, 1.0), (True, 0))
+            self.assertEqual(store.take('key', 2, 1.0), (False, 1.0))
+        with mock.patch('main_thought_stream.throttling.time.monotonic', return_value=100.5):
+            self.assertEqual(store.take('key', 2, 1.0), (False, 0.5))
+        with mock.patch('main_thought_stream.throttling.time.monotonic', return_value=101.0):
+            self.assertEqual(store.take('key', 2, 1.0), (True, 0))
+            self.assertEqual(store.take('key', 2, 1.0, cost=2), (False, 2.0))
+
+
+class ReplicaRoutingTests(TestCase):
+    """
+    Runs against a second, separately migrated SQLite database standing in for a
+    replica, so reads can be told apart by which database holds the rows. The
+    replica only joins `databases` once the test runner has set up its own.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict,
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.tmp, 'replica.sqlite3'),
+            'OPTIONS': {},
+            'CONN_MAX_AGE': 0,
+        }
+        cls.databases = cls.databases | {'replica'}
+        call_command('migrate', database='replica', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        cls.databases = cls.databases - {'replica'}
+        shutil.rmtree(cls.tmp)
+        super().tearDownClass()
+
+    def setUp(self):
+        override = self.settings(DATABASE_REPLICAS=['replica'])
+        override.enable()
+        self.addCleanup(override.disable)
+        response_cache().clear()
+        user_cache.clear()
+        self.user = User.objects.create_user(username='writer')
+        self.client = APIClient()
+        replica_author = User.objects.using('replica').create(id=self.user.id, username='writer')
+        self.replicated = Post.objects.using('replica').create(
+            title='Replicated', content='content', image='media/post.jpg', author=replica_author,
+        )
+
+    def titles(self):
+        return [post['title'] for post in self.client.get(reverse('post-list')).json()['results']]
+
+    def test_anonymous_reads_go_to_the_replica(self):
+        Post.objects.create(title='Primary only', content='content', image='media/post.jpg', author=self.user)
+        self.assertEqual(self.titles(), ['Replicated'])
+        response = self.client.get(reverse('post-list-async'))
+        self.assertEqual([post['title'] for post in response.json()['results']], ['Replicated'])
+        response = self.client.get(reverse('post-comments', kwargs={'post_id': self.replicated.id}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_writers_read_from_the_primary_for_a_while(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        image = SimpleUploadedFile('photo.jpg', make_image(), content_type='image/jpeg')
+        with self.settings(MEDIA_ROOT=self.enterContext(tempfile.TemporaryDirectory())):
+            response = self.client.post(reverse('post-create'), {'title': 'Mine', 'content': 'content', 'image': image},
+                                        format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 5)
+        self.assertEqual(self.titles(), ['Mine'])
+
+        self.client.cookies.pop(PIN_COOKIE)
+        # The pinned read cached the primary's page
+        response_cache().clear()
+        self.assertEqual(self.titles(), ['Replicated'])
+
+    def test_lagging_replica_reads_are_not_cached_right_after_a_write(self):
+        self.assertEqual(self.titles(), ['Replicated'])
+        # A write the replica has not caught up with yet
+        Post.objects.create(title='Primary only', content='content', image='media/post.jpg', author=self.user)
+        invalidate_feed()
+        self.assertEqual(self.titles(), ['Replicated'])
+
+        # Once it has, the next reader sees it rather than the stale page
+        Post.objects.using('replica').create(
+            title='Primary only', content='content', image='media/post.jpg', author_id=self.user.id,
+        )
+        self.assertEqual(self.titles(), ['Primary only', 'Replicated'])
+
+        # Past the lag window replica reads are cached again
+        with self.settings(READ_YOUR_WRITES_SECONDS=0):
+            self.assertEqual(self.titles(), ['Primary only', 'Replicated'])
+        Post.objects.using('replica').filter(title='Primary only').delete()
+        self.assertEqual(self.titles(), ['Primary only', 'Replicated'])
+
+    def test_writes_and_unmarked_views_use_the_primary(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_write(Post, instance=self.replicated), 'default')
+        self.assertIsNone(router.db_for_read(Post))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        Post.objects.create(title='Primary only', content='content', image='media/post.jpg', author=self.user)
+        response = self.client.get(reverse('post-timeline'))
+        self.assertEqual(response.status_code, 200)
+
+
+# Unthrottled, since every test posts a burst of replies
+@override_settings(REST_FRAMEWORK=throttle_rates())
+class NotificationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        # Deliveries are stored as jobs, and run by the tests themselves
+        patcher = mock.patch.object(queue, 'broker', DatabaseBroker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.author = User.objects.create_user(username='author')
+        self.fans = [User.objects.create_user(username=f'fan{i}') for i in range(3)]
+        self.post = Post.objects.create(title='Thoughts', content='content', image='media/post.jpg', author=self.author)
+        self.comment = self.comment_as(self.author)
+
+    def comment_as(self, user, parent=None, content='comment'):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                reverse('post-comment-create', kwargs={'post_id': self.post.id}),
+                {'content': content, 'parent_comment': parent.id if parent else None}, format='json',
+            )
+        self.assertEqual(response.status_code, 201)
+        return Comment.objects.get(id=response.data['id'])
+
+    def deliver(self):
+        deliver_replies(int(time.time() // BATCH_SECONDS))
+
+    def inbox(self, user, **params):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return client, client.get(reverse('notification-list'), params)
+
+    def test_replies_are_coalesced_into_one_notification(self):
+        for fan in self.fans:
+            self.comment_as(fan, self.comment)
+        last = self.comment_as(self.fans[0], self.comment, content='me again')
+        # Replying to yourself notifies nobody
+        self.comment_as(self.author, self.comment)
+        # One delivery for the whole window, and nothing written yet
+        job = Job.objects.get()
+        self.assertEqual(job.name, 'post.notifications.deliver_replies')
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertFalse(Notification.objects.exists())
+
+        self.deliver()
+        client, response = self.inbox(self.author)
+        self.assertEqual(response.status_code, 200)
+        notification, = response.data['results']
+        self.assertEqual(notification['count'], 4)
+        self.assertEqual(notification['message'], '4 new replies to your comment on "Thoughts"')
+        self.assertEqual(notification['post'], {'id': self.post.id, 'title': 'Thoughts'})
+        self.assertEqual(notification['comment'], self.comment.id)
+        self.assertEqual(notification['latest_reply']['id'], last.id)
+        self.assertEqual(notification['latest_reply']['user'], {'id': self.fans[0].id, 'username': 'fan0'})
+        self.assertFalse(notification['read'])
+        self.assertEqual(client.get(reverse('notification-unread')).data, {'unread': 1})
+
+        # Delivering again changes nothing
+        self.deliver()
+        self.assertEqual(Notification.objects.get().count, 4)
+
+    def test_deliveries_write_in_batches(self):
+        comments = [self.comment_as(self.author) for _ in range(3)]
+        for comment in comments:
+            for fan in self.fans:
+                self.comment_as(fan, comment)
+        with CaptureQueriesContext(connection) as queries:
+            self.deliver()
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(sorted(Notification.objects.values_list('count', flat=True)), [3, 3, 3])
+
+        for fan in self.fans:
+            self.comment_as(fan, comments[0])
+        with CaptureQueriesContext(connection) as queries:
+            self.deliver()
+        updates = [query for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Notification.objects.get(comment=comments[0]).count, 6)
+
+    def test_replies_after_reading_start_a_new_notification(self):
+        self.comment_as(self.fans[0], self.comment)
+        self.deliver()
+        client, _ = self.inbox(self.author)
+        response = client.post(reverse('notification-read'), {}, format='json')
+        self.assertEqual(response.data, {'marked': 1, 'unread': 0})
+
+        self.deliver()
+        self.assertEqual(client.get(reverse('notification-unread')).data, {'unread': 0})
+        self.comment_as(self.fans[1], self.comment)
+        self.deliver()
+        _, response = self.inbox(self.author)
+        self.assertEqual([(n['count'], n['read']) for n in response.data['results']], [(1, False), (1, True)])
+
+        unread = response.data['results'][0]['id']
+        response = client.post(reverse('notification-read'), {'ids': [unread]}, format='json')
+        self.assertEqual(response.data, {'marked': 1, 'unread': 0})
+        response = client.post(reverse('notification-read'), {'ids': 'all'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_deleted_replies_are_no_longer_counted(self):
+        first = self.comment_as(self.fans[0], self.comment)
+        second = self.comment_as(self.fans[1], self.comment)
+        self.deliver()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.fans[1])}')
+        Job.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            client.delete(reverse('comment-update-delete', kwargs={'comment_id': second.id}))
+        job = Job.objects.get(name='post.notifications.update_notifications')
+        self.assertEqual((job.name, job.args), ('post.notifications.update_notifications', [[self.comment.id]]))
+        update_notifications(*job.args)
+        notification = Notification.objects.get()
+        self.assertEqual((notification.count, notification.latest_reply_id), (1, first.id))
+
+        first.delete()
+        update_notifications([self.comment.id])
+        self.assertFalse(Notification.objects.exists())
+
+    def test_inbox_is_paginated_by_latest_reply(self):
+        comments = [self.comment_as(self.author) for _ in range(3)]
+        for comment in comments:
+            self.comment_as(self.fans[0], comment)
+        # The oldest notification gets a new reply and moves to the top
+        self.comment_as(self.fans[1], comments[0])
+        self.deliver()
+
+        client, response = self.inbox(self.author, page_size=2)
+        self.assertEqual([n['comment'] for n in response.data['results']], [comments[0].id, comments[2].id])
+        response = client.get(response.data['next'])
+        self.assertEqual([n['comment'] for n in response.data['results']], [comments[1].id])
+        self.assertIsNone(response.data['next'])
+        # Nobody else sees them
+        _, response = self.inbox(self.fans[0])
+        self.assertEqual(response.data['results'], [])
+
+
+@override_settings(REST_FRAMEWORK=throttle_rates())
+class PostDeletionTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        user_cache.clear()
+        inverted_index.clear()
+        patcher = mock.patch.object(queue, 'broker', DatabaseBroker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='deleter')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.post = Post.objects.create(title='Doomed', content='ephemeral', image='media/post.jpg', author=self.user)
+        parent = None
+        for i in range(7):
+            comment = Comment.objects.create(post=self.post, user=self.user, content='ephemeral', parent_comment=parent)
+            parent = comment if i % 2 else None
+        fan_out(self.post.id)
+
+    def test_deleted_posts_are_hidden_at_once_and_purged_in_chunks(self):
+        self.client.get(reverse('post-comments', kwargs={'post_id': self.post.id}))
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(reverse('post-update-delete', kwargs={'post_id': self.post.id}))
+        self.assertEqual(response.status_code, 204)
+        # One UPDATE, whatever the size of the thread
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('DELETE')])
+        self.assertEqual(self.client.get(reverse('post-list')).data['results'], [])
+        self.assertEqual(self.client.get(reverse('post-timeline')).data['results'], [])
+        self.assertEqual(self.client.get(reverse('post-comments', kwargs={'post_id': self.post.id})).data, [])
+        self.assertEqual(self.client.get(reverse('post-search'), {'q': 'ephemeral'}).data['count'], 0)
+        self.assertEqual(self.client.post(
+            reverse('post-comment-create', kwargs={'post_id': self.post.id}), {'content': 'late'}, format='json',
+        ).status_code, 404)
+        # Nothing is removed yet
+        self.assertEqual((Comment.objects.count(), TimelineEntry.objects.count()), (7, 1))
+
+        job = Job.objects.get()
+        self.assertEqual((job.name, job.key), ('post.deletion.purge_post', f'purge-post:{self.post.id}'))
+        with mock.patch('post.deletion.PURGE_BATCH_SIZE', 3), CaptureQueriesContext(connection) as queries:
+            purge_post(*job.args)
+        chunks = [q for q in queries.captured_queries if q['sql'].startswith('DELETE FROM "post_comment"')]
+        self.assertEqual(len(chunks), 3)
+        self.assertFalse(Post.all_objects.exists())
+        self.assertFalse(Comment.objects.exists())
+        self.assertFalse(TimelineEntry.objects.exists())
+
+
+class ConditionalEditTests(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        user_cache.clear()
+        inverted_index.clear()
+        self.author = User.objects.create_user(username='editor')
+        self.client = self.client_for(self.author)
+        self.post = Post.objects.create(title='Draft', content='content', image='media/post.jpg', author=self.author)
+        self.comment = Comment.objects.create(post=self.post, user=self.author, content='first take')
+        self.post_url = reverse('post-update-delete', kwargs={'post_id': self.post.id})
+        self.comment_url = reverse('comment-update-delete', kwargs={'comment_id': self.comment.id})
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return client
+
+    def test_edits_bump_the_version_and_send_it_as_the_etag(self):
+        self.assertEqual(self.client.get(reverse('post-list')).data['results'][0]['version'], 1)
+        response = self.client.put(self.post_url, {'title': 'Final'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response['ETag'], response.data['version'], response.data['title']), ('"2"', 2, 'Final'))
+        self.assertEqual(self.client.get(reverse('post-list')).data['results'][0]['version'], 2)
+        self.assertEqual(self.client.get(reverse('post-search'), {'q': 'final'}).data['count'], 1)
+
+        response = self.client.put(self.comment_url, {'content': 'second take'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual((response['ETag'], response.data['content']), ('"2"', 'second take'))
+        thread = self.client.get(reverse('post-comments', kwargs={'post_id': self.post.id})).data
+        self.assertEqual(thread[0]['version'], 2)
+
+    def test_stale_versions_are_refused(self):
+        self.client.put(self.post_url, {'title': 'Theirs'}, format='json')
+        for if_match in ('"1"', 'W/"2"', 'garbage'):
+            response = self.client.put(self.post_url, {'title': 'Mine'}, format='json', HTTP_IF_MATCH=if_match)
+            self.assertEqual(response.status_code, 412, if_match)
+        self.assertEqual(Post.objects.values_list('title', 'version').get(), ('Theirs', 2))
+
+        for if_match in ('"1", "2"', '*'):
+            response = self.client.put(self.post_url, {'title': 'Mine'}, format='json', HTTP_IF_MATCH=if_match)
+            self.assertEqual(response.status_code, 200, if_match)
+        self.assertEqual(Post.objects.get().version, 4)
+
+    def test_ownership_version_and_write_are_one_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(self.post_url, {'title': 'Final'}, format='json', HTTP_IF_MATCH='"1"')
+        writes = [q['sql'] for q in queries.captured_queries if 'post_post' in q['sql']]
+        update = writes[0]
+        # Nothing read before it, and only the columns sent written
+        self.assertTrue(update.startswith('UPDATE'), writes)
+        self.assertIn('"author_id" = ', update)
+        self.assertIn('"version" IN ', update)
+        self.assertNotIn('"content"', update)
+
+    def test_comments_cannot_be_moved(self):
+        other = Post.objects.create(title='Other', content='content', image='media/post.jpg', author=self.author)
+        parent = Comment.objects.create(post=other, user=self.author, content='elsewhere')
+        response = self.client.put(
+            self.comment_url, {'content': 'edited', 'post': other.id, 'parent_comment': parent.id}, format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+        comment = Comment.objects.get(id=self.comment.id)
+        self.assertEqual((comment.content, comment.post_id, comment.parent_comment_id), ('edited', self.post.id, None))
+
+    def test_missing_and_foreign_rows(self):
+        stranger = self.client_for(User.objects.create_user(username='stranger'))
+        self.assertEqual(stranger.put(self.post_url, {'title': 'Mine'}, format='json').status_code, 403)
+        self.assertEqual(stranger.put(self.comment_url, {'content': 'mine'}, format='json').status_code, 403)
+        self.assertEqual(Post.objects.get().version, 1)
+        missing = reverse('post-update-delete', kwargs={'post_id': self.post.id + 1})
+        self.assertEqual(self.client.put(missing, {'title': 'Mine'}, format='json').status_code, 404)
+
+        Comment.objects.update(deleted_at=timezone.now())
+        self.assertEqual(self.client.put(self.comment_url, {'content': 'back'}, format='json').status_code, 404)
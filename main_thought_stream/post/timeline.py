@@ -0,0 +1,221 @@
+"""
+Home timelines: the posts of the people a user follows, newest first.
+
+New posts are pushed (fanned out on write) into a TimelineEntry row per follower,
+so reading a timeline page is a range scan of the reader's own entries. Authors
+with more than FANOUT_MAX_FOLLOWERS followers are not fanned out, since one post
+would mean that many inserts; their posts are pulled from the post_author_idx
+index when a follower reads, and merged in.
+
+Timelines are kept to about MAX_ENTRIES entries: each fan-out trims the timelines of
+one in TRIM_EVERY of its recipients, so every timeline is trimmed about once per
+TRIM_EVERY posts it receives, and the trim_timelines command trims the rest.
+
+An author who drops back under the threshold has their BACKFILL most recent posts
+pushed to all their followers, as on a new follow. Older posts from while they were
+pulled stay out of timelines that only get pushed posts.
+"""
+import heapq
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from jobs.queue import task
+from user.models import Follow, FollowerCount
+
+from .models import Post, TimelineEntry
+from .pagination import keyset_filter
+
+# Authors with more followers than this are pulled on read instead of pushed on write
+FANOUT_MAX_FOLLOWERS = getattr(settings, 'TIMELINE_FANOUT_MAX_FOLLOWERS', 10000)
+# Entries kept per user by trim_timeline
+MAX_ENTRIES = getattr(settings, 'TIMELINE_MAX_ENTRIES', 800)
+# Each fan-out trims the timelines of one recipient in this many
+TRIM_EVERY = getattr(settings, 'TIMELINE_TRIM_EVERY', 50)
+# Recent posts of a newly followed author copied into the follower's timeline
+BACKFILL = getattr(settings, 'TIMELINE_BACKFILL', 20)
+# Rows per INSERT while fanning out
+BATCH_SIZE = 1000
+# How long a user's list of pulled authors is cached, in seconds
+PULLED_AUTHORS_TIMEOUT = 60
+
+
+def is_pulled(author_id):
+    return FollowerCount.objects.filter(user_id=author_id, count__gt=FANOUT_MAX_FOLLOWERS).exists()
+
+
+@task
+def fan_out(post_id):
+    """
+    Add a post to the timelines of its author and, unless the author has too many
+    followers, of everyone following them.
+    """
+    post = Post.objects.filter(pk=post_id).values('id', 'author_id', 'created_at').first()
+    if post is None:
+        return
+
+    def entries(user_ids):
+        return [
+            TimelineEntry(user_id=user_id, post_id=post['id'], author_id=post['author_id'],
+                          created_at=post['created_at'])
+            for user_id in user_ids
+        ]
+
+    if is_pulled(post['author_id']):
+        # The author's own timeline pulls their posts like their followers' do
+        return
+    push(entries, [post['author_id']], post['id'])
+    followers = Follow.objects.filter(followee_id=post['author_id']).values_list('follower_id', flat=True)
+    batch = []
+    for follower_id in followers.iterator(chunk_size=BATCH_SIZE):
+        batch.append(follower_id)
+        if len(batch) == BATCH_SIZE:
+            push(entries, batch, post['id'])
+            batch = []
+    if batch:
+        push(entries, batch, post['id'])
+
+
+def push(entries, user_ids, post_id):
+    """
+    Insert `entries(user_ids)`, then trim the timelines of the users whose turn it
+    is. Which users those are shifts from post to post, spreading the trimming.
+    """
+    TimelineEntry.objects.bulk_create(entries(user_ids), ignore_conflicts=True)
+    for user_id in user_ids:
+        if user_id % TRIM_EVERY == post_id % TRIM_EVERY:
+            trim_timeline(user_id, MAX_ENTRIES)
+
+
+def schedule_fan_out(*post_ids):
+    """
+    Fan the posts out in background jobs once the current transaction commits.
+    Entries are inserted ignoring conflicts, so a retried fan-out is harmless.
+    """
+    fan_out.enqueue_many([((post_id,), f'timeline-fan-out:{post_id}') for post_id in post_ids])
+
+
+def backfill(follower_id, followee_id):
+    """
+    Copy the followee's most recent posts into the follower's timeline. Pulled
+    authors need nothing copied.
+    """
+    if is_pulled(followee_id):
+        return
+    recent = Post.objects.filter(author_id=followee_id).order_by('-created_at', '-id')
+    TimelineEntry.objects.bulk_create([
+        TimelineEntry(user_id=follower_id, post_id=pk, author_id=followee_id, created_at=created_at)
+        for pk, created_at in recent.values_list('id', 'created_at')[:BACKFILL]
+    ], ignore_conflicts=True)
+
+
+@task
+def backfill_followers(author_id):
+    """
+    Copy the most recent posts of an author who is no longer pulled into their own
+    timeline and their followers', which missed the posts made while they were.
+    """
+    if is_pulled(author_id):
+        return
+    recent = list(
+        Post.objects.filter(author_id=author_id).order_by('-created_at', '-id')
+        .values_list('id', 'created_at')[:BACKFILL]
+    )
+
+    def entries(user_ids):
+        return [
+            TimelineEntry(user_id=user_id, post_id=pk, author_id=author_id, created_at=created_at)
+            for user_id in user_ids for pk, created_at in recent
+        ]
+
+    TimelineEntry.objects.bulk_create(entries([author_id]), ignore_conflicts=True)
+    followers = Follow.objects.filter(followee_id=author_id).values_list('follower_id', flat=True)
+    batch = []
+    for follower_id in followers.iterator(chunk_size=BATCH_SIZE):
+        batch.append(follower_id)
+        if len(batch) == BATCH_SIZE // BACKFILL:
+            TimelineEntry.objects.bulk_create(entries(batch), ignore_conflicts=True)
+            batch = []
+    if batch:
+        TimelineEntry.objects.bulk_create(entries(batch), ignore_conflicts=True)
+
+
+def follower_lost(author_id):
+    """
+    Note that an author lost a follower, backfilling their followers once the
+    current transaction commits if that took them back under FANOUT_MAX_FOLLOWERS.
+    """
+    if FollowerCount.objects.filter(user_id=author_id, count=FANOUT_MAX_FOLLOWERS).exists():
+        backfill_followers.enqueue(author_id, key=f'timeline-backfill:{author_id}')
+
+
+def remove_author(user_id, author_id):
+    TimelineEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+
+
+def pulled_authors_key(user_id):
+    return f'timeline:{user_id}:pulled'
+
+
+def pulled_authors(user_id):
+    """
+    Ids of the authors whose posts are merged into the user's timeline on read: the
+    high-follower authors they follow, and themselves if they are one.
+    """
+    key = pulled_authors_key(user_id)
+    authors = cache.get(key)
+    if authors is None:
+        authors = list(FollowerCount.objects.filter(
+            Q(user__followers__follower_id=user_id) | Q(user_id=user_id),
+            count__gt=FANOUT_MAX_FOLLOWERS,
+        ).values_list('user_id', flat=True).distinct())
+        cache.set(key, authors, PULLED_AUTHORS_TIMEOUT)
+    return authors
+
+
+def forget_pulled_authors(user_id):
+    cache.delete(pulled_authors_key(user_id))
+
+
+def timeline_positions(user_id, cursor, limit):
+    """
+    (created_at, post id) of the next `limit` posts of a user's timeline after the
+    cursor, newest first.
+    """
+    entries = TimelineEntry.objects.filter(user_id=user_id)
+    if cursor is not None:
+        entries = keyset_filter(entries, cursor, pk_field='post_id')
+    positions = list(entries.order_by('-created_at', '-post_id').values_list('created_at', 'post_id')[:limit])
+
+    authors = pulled_authors(user_id)
+    if authors:
+        posts = Post.objects.filter(author_id__in=authors)
+        if cursor is not None:
+            posts = keyset_filter(posts, cursor)
+        pulled = list(posts.order_by('-created_at', '-id').values_list('created_at', 'id')[:limit])
+        # Posts from before an author crossed the threshold may be in both lists
+        merged = heapq.merge(positions, pulled, reverse=True)
+        positions = list(dict.fromkeys(merged, None))[:limit]
+    return positions
+
+
+def trim_timeline(user_id, keep=MAX_ENTRIES):
+    """
+    Drop the entries of a user's timeline beyond the newest `keep`. Returns how
+    many were deleted.
+    """
+    entries = TimelineEntry.objects.filter(user_id=user_id)
+    cutoff = entries.order_by('-created_at', '-post_id').values_list('created_at', 'post_id')[keep:keep + 1].first()
+    if cutoff is None:
+        return 0
+    created_at, post_id = cutoff
+    deleted, _ = entries.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, post_id__lte=post_id)).delete()
+    return deleted
+
+
+def oversized_timelines(keep=MAX_ENTRIES):
+    return (
+        TimelineEntry.objects.order_by().values('user_id').annotate(entries=Count('id'))
+        .filter(entries__gt=keep).values_list('user_id', flat=True)
+    )
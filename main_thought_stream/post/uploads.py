@@ -0,0 +1,234 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import ImageFile
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+
+from .models import ImageUpload
+
+# Content types accepted for post images, with the format Pillow must detect for each
+ALLOWED_CONTENT_TYPES = {
+    'image/jpeg': 'JPEG',
+    'image/png': 'PNG',
+    'image/webp': 'WEBP',
+    'image/gif': 'GIF',
+}
+MAX_UPLOAD_SIZE = getattr(settings, 'POST_IMAGE_MAX_UPLOAD_SIZE', 20 * 1024 * 1024)
+MAX_DIMENSION = getattr(settings, 'POST_IMAGE_MAX_DIMENSION', 10000)
+# How long a request may take to write one chunk before another may claim the upload
+UPLOAD_LEASE = getattr(settings, 'POST_IMAGE_UPLOAD_LEASE', timedelta(minutes=5))
+# Uploads not attached to a post are deleted by the expire_uploads command once idle this long
+UPLOAD_EXPIRY = getattr(settings, 'POST_IMAGE_UPLOAD_EXPIRY', timedelta(days=1))
+# The image header must have been seen within this many bytes
+HEADER_LIMIT = 256 * 1024
+READ_SIZE = 64 * 1024
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Upload exceeds the maximum allowed size.'
+    default_code = 'upload_too_large'
+
+
+class UploadConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Upload is not accepting data at this offset.'
+    default_code = 'upload_conflict'
+
+
+def start_upload(user, filename, content_type, size):
+    """
+    Register a new upload after checking what can be checked before any byte arrives.
+    """
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise ValidationError({'content_type': f'Unsupported image type {content_type!r}.'})
+    if size <= 0:
+        raise ValidationError({'size': 'Size must be positive.'})
+    if size > MAX_UPLOAD_SIZE:
+        raise UploadTooLarge()
+    return ImageUpload.objects.create(
+        user_id=user.id, filename=os.path.basename(filename), content_type=content_type, size=size,
+    )
+
+
+def discard(upload):
+    if os.path.exists(upload.temp_path):
+        os.remove(upload.temp_path)
+
+
+def check_header(upload, image):
+    """
+    Record the image's dimensions, or return why the upload is rejected.
+    """
+    if image.format != ALLOWED_CONTENT_TYPES[upload.content_type]:
+        return f'File content is {image.format}, not {upload.content_type}.'
+    width, height = image.size
+    if width > MAX_DIMENSION or height > MAX_DIMENSION:
+        return f'Image dimensions must not exceed {MAX_DIMENSION} pixels.'
+    upload.width, upload.height = width, height
+    return None
+
+
+def append_chunk(upload, offset, stream, length):
+    """
+    Stream `length` bytes from `stream` into the upload's temp file at `offset`, in
+    small reads so memory stays flat whatever the chunk size. The image type and
+    dimensions are checked as soon as the header has arrived.
+
+    The chunk is claimed first with a lease on the upload, taken by one short UPDATE
+    that also checks the offset, so requests for the same upload write its file one
+    at a time. The bytes are then streamed outside any transaction, however slow the
+    client, and acknowledged by a second UPDATE that only applies while the lease is
+    still held.
+    """
+    if offset + length > upload.size:
+        raise UploadTooLarge('Chunk goes past the declared upload size.')
+    now = timezone.now()
+    lease = now + UPLOAD_LEASE
+    claimed = ImageUpload.objects.filter(
+        Q(leased_until__isnull=True) | Q(leased_until__lt=now),
+        pk=upload.pk, status=ImageUpload.RECEIVING, received=offset,
+    ).update(leased_until=lease, updated_at=now)
+    if not claimed:
+        raise claim_conflict(upload.pk, offset)
+    upload.refresh_from_db()
+
+    held = ImageUpload.objects.filter(pk=upload.pk, leased_until=lease)
+    try:
+        received, rejection = write_chunk(upload, stream, length)
+    except BaseException:
+        held.update(leased_until=None)
+        raise
+    if rejection is not None:
+        if held.delete()[0]:
+            discard(upload)
+        raise ValidationError({'image': rejection})
+
+    updated = held.update(
+        received=received,
+        width=upload.width,
+        height=upload.height,
+        status=ImageUpload.COMPLETE if received == upload.size else ImageUpload.RECEIVING,
+        leased_until=None,
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        raise UploadConflict('The upload lease expired before the chunk was written.')
+    upload.refresh_from_db()
+    return upload
+
+
+def claim_conflict(upload_id, offset):
+    """
+    The error for a chunk at `offset` that could not be claimed.
+    """
+    upload = ImageUpload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        return NotFound('Upload not found.')
+    if upload.status != ImageUpload.RECEIVING:
+        return UploadConflict('Upload is already complete.')
+    if offset != upload.received:
+        return UploadConflict(f'Expected offset {upload.received}.')
+    return UploadConflict('Another request is writing to this upload.')
+
+
+def write_chunk(upload, stream, length):
+    """
+    Write up to `length` bytes of `stream` at the upload's acknowledged offset.
+    Returns the offset reached, and why the upload is rejected if it is.
+    """
+    parser = None
+    if upload.width is None:
+        parser = ImageFile.Parser()
+        if upload.received:
+            with open(upload.temp_path, 'rb') as existing:
+                parser.feed(existing.read())
+
+    remaining = length
+    # Written at an explicit position, so a writer whose lease ran out cannot append
+    # past a newer one
+    with open(os.open(upload.temp_path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as out:
+        # Drop whatever an interrupted request wrote past the acknowledged offset
+        out.truncate(upload.received)
+        out.seek(upload.received)
+        while remaining:
+            chunk = stream.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            if parser is not None:
+                parser.feed(chunk)
+                if parser.image is not None:
+                    rejection = check_header(upload, parser.image)
+                    if rejection is not None:
+                        return upload.received, rejection
+                    parser = None
+            out.write(chunk)
+            remaining -= len(chunk)
+
+    received = upload.received + length - remaining
+    if parser is not None and (received >= HEADER_LIMIT or received == upload.size):
+        return received, 'Upload is not a valid image.'
+    return received, None
+
+
+def attach_upload(upload, post, save=True):
+    """
+    Move a completed upload into post.image. The post is not saved, and neither is
+    the upload's new status when `save` is False.
+    """
+    store_upload(upload, post)
+    try:
+        mark_attached(upload, save)
+    except UploadConflict:
+        post.image.delete(save=False)
+        raise
+
+
+def store_upload(upload, post):
+    """
+    Copy a completed upload into post.image, leaving the upload usable until
+    mark_attached() is called.
+    """
+    with open(upload.temp_path, 'rb') as source:
+        post.image.save(upload.filename, File(source), save=False)
+
+
+def mark_attached(upload, save=True):
+    """
+    Set the upload's status to attached, provided it is still complete when `save`
+    is True, and discard its file once that commits.
+    """
+    if save:
+        claimed = ImageUpload.objects.filter(pk=upload.pk, status=ImageUpload.COMPLETE).update(
+            status=ImageUpload.ATTACHED, updated_at=timezone.now(),
+        )
+        if not claimed:
+            raise UploadConflict('Upload was attached by another request.')
+    upload.status = ImageUpload.ATTACHED
+    # Kept until the attachment commits, so a rollback leaves a complete upload to retry with
+    transaction.on_commit(lambda: discard(upload))
+
+
+def expire_uploads(before):
+    """
+    Delete the uploads never attached to a post that were last written to before
+    `before`, with their temp files. Returns how many were deleted.
+    """
+    deleted = 0
+    expired = ImageUpload.objects.exclude(status=ImageUpload.ATTACHED).filter(updated_at__lt=before)
+    for upload_id in expired.values_list('pk', flat=True).iterator():
+        with transaction.atomic():
+            # Locked and checked again, so an upload that just received a chunk is kept
+            upload = expired.select_for_update().filter(pk=upload_id).first()
+            if upload is None:
+                continue
+            discard(upload)
+            upload.delete()
+            deleted += 1
+    return deleted
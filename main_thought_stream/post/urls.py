@@ -1,16 +1,53 @@
 from django.urls import path
-from .views import PostView, PostCreationView, PostCommentsView, CommentView, PostUpdateDeleteView, CommentUpdateDeleteView
+from .views import PostView, TimelineView, PostCreationView, BulkPostCreationView, PostCommentsView, CommentView, BulkCommentCreationView, PostUpdateDeleteView, CommentUpdateDeleteView, NotificationListView, NotificationUnreadView, NotificationReadView, ImageUploadView, ImageUploadChunkView, SearchView
+from .async_views import AsyncPostView, AsyncPostCommentsView, CommentStreamView
 
 urlpatterns = [
     # Route for listing all posts (GET request)
     path('', PostView.as_view(), name='post-list'),
 
+    # Async variant of the post list, for ASGI deployments (GET request)
+    path('async/', AsyncPostView.as_view(), name='post-list-async'),
+
+    # Route for the authenticated user's home timeline (GET request)
+    path('timeline/', TimelineView.as_view(), name='post-timeline'),
+
+    # Route for full-text search over posts and comments (GET request)
+    path('search/', SearchView.as_view(), name='post-search'),
+
     # Route for creating a new post (POST request)
     path('create/', PostCreationView.as_view(), name='post-create'),
 
+    # Route for creating a batch of posts in one transaction (POST request)
+    path('bulk/', BulkPostCreationView.as_view(), name='post-bulk-create'),
+
+    # Route for creating a batch of comments, possibly replying to each other (POST request)
+    path('comments/bulk/', BulkCommentCreationView.as_view(), name='comment-bulk-create'),
+
+    # Route for the authenticated user's reply notifications (GET request)
+    path('notifications/', NotificationListView.as_view(), name='notification-list'),
+
+    # Route for the number of unread notifications (GET request)
+    path('notifications/unread/', NotificationUnreadView.as_view(), name='notification-unread'),
+
+    # Route for marking notifications read (POST request)
+    path('notifications/read/', NotificationReadView.as_view(), name='notification-read'),
+
+    # Route for starting a chunked image upload (POST request)
+    path('uploads/', ImageUploadView.as_view(), name='image-upload-create'),
+
+    # Route for resuming or sending chunks of an image upload (GET or PATCH request)
+    path('uploads/<uuid:upload_id>/', ImageUploadChunkView.as_view(), name='image-upload-chunk'),
+
     # Route for listing comments of a specific post (GET request)
     path('<int:post_id>/comments/', PostCommentsView.as_view(), name='post-comments'),
 
+    # Async variant of the comment listing, for ASGI deployments (GET request)
+    path('<int:post_id>/comments/async/', AsyncPostCommentsView.as_view(), name='post-comments-async'),
+
+    # Server-Sent Events stream of comment changes on a post, for ASGI deployments (GET request)
+    path('<int:post_id>/comments/stream/', CommentStreamView.as_view(), name='post-comments-stream'),
+
     # Route for adding a comment to a specific post (POST request)
     path('<int:post_id>/comment/', CommentView.as_view(), name='post-comment-create'),
 
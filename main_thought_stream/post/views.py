@@ -1,56 +1,164 @@
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework import status
 from rest_framework import generics
 from rest_framework.permissions import IsAuthenticatedOrReadOnly,AllowAny
-from .serializers import PostSerializer, CommentSerializer
-from .models import Post, Comment
+from rest_framework.exceptions import APIException, ValidationError
+from django.db import transaction
+from .serializers import (
+    PostSerializer, CommentSerializer, CommentEditSerializer, FlatCommentSerializer, NotificationSerializer,
+)
+from .models import Post, Comment, ImageUpload
+from .uploads import start_upload, append_chunk, mark_attached, store_upload
+from .counters import comment_added
+from .deletion import delete_comment, delete_post
+from .editing import apply_edit, if_match_versions, version_etag
+from .broker import publish_comment_event
+from .bulk import batch_items, batch_response_data, create_comments, create_posts
+from . import notifications, search
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from .authentication import CustomJWTAuthentication
+from main_thought_stream.db_routers import ReplicaReadMixin
+from main_thought_stream.throttling import IPThrottle, ThrottleFirstMixin, UserThrottle
+from .pagination import FeedCursorPagination, InboxCursorPagination
+from .fieldsets import parse_fields, post_queryset, post_values
+from .rows import post_representations
+from .renderers import FastJSONRenderer
+from .comment_tree import load_comment_tree
+from .images import schedule_variants
+from .timeline import schedule_fan_out, timeline_positions
+from .cache import CachedResponseMixin, FEED_NAMESPACE, comments_namespace, invalidate_comments, invalidate_feed
 
-class PostView(APIView):
+def non_negative_int_param(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError({name: 'A non-negative integer is required.'})
+    if value < 0:
+        raise ValidationError({name: 'A non-negative integer is required.'})
+    return value
+
+class PostView(ReplicaReadMixin, CachedResponseMixin, generics.ListAPIView):
     permission_classes = []
     authentication_classes = [] 
+    serializer_class = PostSerializer
+    pagination_class = FeedCursorPagination
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    def get_cache_namespace(self):
+        return FEED_NAMESPACE
+
+    def list(self, request, *args, **kwargs):
+        """
+        Same output as PostSerializer, built from .values() rows by post.rows
+        instead of a serializer per post.
+        """
+        fields = parse_fields(request.query_params)
+        page = self.paginate_queryset(post_values(fields))
+        return self.get_paginated_response(post_representations(page, fields, request))
+
+
+class TimelineView(APIView):
+    """
+    The authenticated user's home timeline: their own posts and those of the users
+    they follow, newest first, keyset paginated like the global feed and with the
+    same ?fields=.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CustomJWTAuthentication]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
     def get(self, request):
-        posts = Post.objects.all().order_by('-created_at')
-        serializer = PostSerializer(posts, many=True)
-        return Response(serializer.data)
-    
-class PostCreationView(APIView):
+        fields = parse_fields(request.query_params)
+        paginator = FeedCursorPagination()
+        paginator.request = request
+        paginator.page_size = paginator.parse_page_size(request.query_params)
+        cursor = paginator.parse_cursor(request.query_params)
+        positions = timeline_positions(request.user.id, cursor, paginator.page_size + 1)
+        page = paginator.set_page(positions)
+
+        rows = {row['id']: row for row in post_values(fields).filter(id__in=[pk for _, pk in page])}
+        # Posts deleted since they were fanned out are skipped until their entries are purged
+        results = [rows[pk] for _, pk in page if pk in rows]
+        paginator.page = [{'created_at': created_at, 'id': pk} for created_at, pk in page]
+        return paginator.get_paginated_response(post_representations(results, fields, request))
+
+
+class PostCreationView(ThrottleFirstMixin, APIView):
     permission_classes = [IsAuthenticated]
     authentication_classes = [CustomJWTAuthentication]
+    throttle_classes = [IPThrottle, UserThrottle]
+    throttle_scope = 'post'
     
     def post(self, request):
-        print("request--->",request.user)
         serializer = PostSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            serializer.save() 
+            post = serializer.save() 
+            schedule_variants(post)
+            schedule_fan_out(post.id)
+            invalidate_feed()
             return Response(serializer.data, status=status.HTTP_201_CREATED)  
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+
+class BulkThrottleMixin(ThrottleFirstMixin):
+    """
+    Throttle batch writes like the single-item endpoints of their scope, charging a
+    token per item.
+    """
+    throttle_classes = [IPThrottle, UserThrottle]
+
+    def get_throttle_cost(self, request):
+        return max(len(request.data), 1) if isinstance(request.data, list) else 1
+
+
+class BulkPostCreationView(BulkThrottleMixin, APIView):
+    """
+    Create a JSON list of posts in one request and one transaction. Images are given
+    as the upload_id of completed chunked uploads. The response has one result per
+    item, in order; invalid items are reported and not written.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CustomJWTAuthentication]
+    throttle_scope = 'post'
+
+    def post(self, request):
+        data, code = batch_response_data(create_posts(request, batch_items(request.data)))
+        return Response(data, status=code)
+
     
-class PostCommentsView(generics.ListAPIView):
+class PostCommentsView(ReplicaReadMixin, CachedResponseMixin, generics.ListAPIView):
     permission_classes = [AllowAny] 
     authentication_classes = []  
-    serializer_class = CommentSerializer
+    serializer_class = FlatCommentSerializer
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
-    def get_queryset(self):
+    def get_cache_namespace(self):
+        return comments_namespace(self.kwargs.get('post_id'))
+
+    def list(self, request, *args, **kwargs):
         """
-        Override to filter comments by post_id from the URL.
+        Return the whole thread of a post, nested through `replies`, built from a
+        single query. `max_depth` and `reply_limit` bound the size of huge threads.
         """
         post_id = self.kwargs.get('post_id')
-        print("post id is----->",post_id)
-        try:
-            post = Post.objects.get(id=post_id)  
-        except Post.DoesNotExist:
-            return Comment.objects.none() 
+        tree = load_comment_tree(
+            post_id,
+            max_depth=non_negative_int_param(request.query_params, 'max_depth'),
+            reply_limit=non_negative_int_param(request.query_params, 'reply_limit'),
+        )
+        return Response(tree)
 
-        return Comment.objects.filter(post=post_id, parent_comment__isnull=True).order_by('created_at')
-
-class CommentView(APIView):
+class CommentView(ThrottleFirstMixin, APIView):
     authentication_classes = [CustomJWTAuthentication]
     permission_classes = [IsAuthenticated]
+    throttle_classes = [IPThrottle, UserThrottle]
+    throttle_scope = 'comment'
 
     def post(self, request, post_id):
         if not request.user.is_authenticated:
@@ -61,7 +169,6 @@ class CommentView(APIView):
             post = Post.objects.get(id=post_id)
         except Post.DoesNotExist:
             return Response({'detail': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
-        print("request",request.data)
         content = request.data.get('content')
         parent_comment_id = request.data.get('parent_comment',None)
 
@@ -69,9 +176,12 @@ class CommentView(APIView):
         parent_comment = None
         if parent_comment_id:
             try:
-                parent_comment = Comment.objects.get(id=parent_comment_id)
+                parent_comment = Comment.objects.live().get(id=parent_comment_id, post=post)
             except Comment.DoesNotExist:
                 return Response({'detail': 'Parent comment not found.'}, status=status.HTTP_404_NOT_FOUND)
+            if parent_comment.depth >= Comment.MAX_DEPTH:
+                return Response({'detail': 'This thread is nested too deeply to reply to.'},
+                                status=status.HTTP_400_BAD_REQUEST)
 
         # Prepare data for the new comment
         data = {
@@ -83,31 +193,68 @@ class CommentView(APIView):
 
         serializer = CommentSerializer(data=data)
         if serializer.is_valid(raise_exception=True):
-            serializer.save(user=request.user)
+            with transaction.atomic():
+                comment = serializer.save(user_id=request.user.id)
+                comment_added(comment)
+                publish_comment_event(post.id, 'comment.created', FlatCommentSerializer(comment).data)
+                notifications.replies_added([comment])
+            invalidate_comments(post.id)
+            # The feed shows comment counts
+            invalidate_feed()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class BulkCommentCreationView(BulkThrottleMixin, APIView):
+    """
+    Create a JSON list of comments, on any posts, in one request and one
+    transaction. An item can reply to an earlier item of the same batch by naming
+    its `ref` as `parent_ref`.
+    """
+    authentication_classes = [CustomJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    throttle_scope = 'comment'
+
+    def post(self, request):
+        data, code = batch_response_data(create_comments(request, batch_items(request.data)))
+        return Response(data, status=code)
+
 class PostUpdateDeleteView(APIView):
     authentication_classes = [CustomJWTAuthentication]
     permission_classes = [IsAuthenticated]
 
     def put(self, request, post_id):
-        try:
-            post = Post.objects.get(id=post_id)
-        except Post.DoesNotExist:
-            return Response({'detail': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = PostSerializer(data=request.data, partial=True, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        changes = dict(serializer.validated_data)
+        upload = changes.pop('upload_id', None)
 
-        # Ensure the authenticated user is the author of the post
-        if post.author != request.user:
-            return Response({'detail': 'You do not have permission to edit this post.'},
-                            status=status.HTTP_403_FORBIDDEN)
+        # A new image is stored first, so that its name is known to the UPDATE
+        stored = Post(pk=post_id)
+        if upload is not None:
+            store_upload(upload, stored)
+            changes['image'] = stored.image.name
+        elif 'image' in changes:
+            stored.image.save(changes['image'].name, changes['image'], save=False)
+            changes['image'] = stored.image.name
+        try:
+            apply_edit(Post.objects.filter(pk=post_id), 'author_id', request.user.id,
+                       if_match_versions(request), changes, 'post')
+        except APIException:
+            if 'image' in changes:
+                stored.image.delete(save=False)
+            raise
+        if upload is not None:
+            mark_attached(upload)
 
-        # Serialize and update the post
-        serializer = PostSerializer(post, data=request.data, partial=True)
-        if serializer.is_valid(raise_exception=True):
-            serializer.save()  # Save the changes
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        post = post_queryset().get(pk=post_id)
+        if 'image' in changes:
+            schedule_variants(post)
+        if 'title' in changes or 'content' in changes:
+            search.index_post(post)
+        invalidate_feed()
+        response = Response(PostSerializer(post, context={'request': request}).data, status=status.HTTP_200_OK)
+        response['ETag'] = version_etag(post.version)
+        return response
 
     # DELETE method to delete an existing post
     def delete(self, request, post_id):
@@ -117,11 +264,14 @@ class PostUpdateDeleteView(APIView):
             return Response({'detail': 'Post not found.'}, status=status.HTTP_404_NOT_FOUND)
 
         # Ensure the authenticated user is the author of the post
-        if post.author != request.user:
+        if post.author_id != request.user.id:
             return Response({'detail': 'You do not have permission to delete this post.'},
                             status=status.HTTP_403_FORBIDDEN)
 
-        post.delete()  # Delete the post
+        # Hidden at once; the thread, timeline entries and files are purged in the background
+        delete_post(post)
+        invalidate_feed()
+        invalidate_comments(post_id)
         return Response({'detail': 'Post deleted successfully.'}, status=status.HTTP_204_NO_CONTENT)
 
 class CommentUpdateDeleteView(APIView):
@@ -130,34 +280,167 @@ class CommentUpdateDeleteView(APIView):
 
     # PUT method to update an existing comment
     def put(self, request, comment_id):
-        try:
-            comment = Comment.objects.get(id=comment_id)
-        except Comment.DoesNotExist:
-            return Response({'detail': 'Comment not found.'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = CommentEditSerializer(data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        comments = Comment.objects.live().filter(pk=comment_id, post__deleted_at__isnull=True)
+        apply_edit(comments, 'user_id', request.user.id, if_match_versions(request), serializer.validated_data,
+                   'comment')
 
-        # Ensure the authenticated user is the author of the comment
-        if comment.user != request.user:
-            return Response({'detail': 'You do not have permission to edit this comment.'},
-                            status=status.HTTP_403_FORBIDDEN)
-
-        # Serialize and update the comment
-        serializer = CommentSerializer(comment, data=request.data, partial=True)
-        if serializer.is_valid(raise_exception=True):
-            serializer.save() 
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        comment = Comment.objects.get(pk=comment_id)
+        search.index_comment(comment)
+        publish_comment_event(comment.post_id, 'comment.updated', FlatCommentSerializer(comment).data)
+        invalidate_comments(comment.post_id)
+        response = Response(CommentSerializer(comment).data, status=status.HTTP_200_OK)
+        response['ETag'] = version_etag(comment.version)
+        return response
 
     # DELETE method to delete an existing comment
     def delete(self, request, comment_id):
         try:
-            comment = Comment.objects.get(id=comment_id)
+            comment = Comment.objects.live().get(id=comment_id, post__deleted_at__isnull=True)
         except Comment.DoesNotExist:
             return Response({'detail': 'Comment not found.'}, status=status.HTTP_404_NOT_FOUND)
 
         # Ensure the authenticated user is the author of the comment
-        if comment.user != request.user:
+        if comment.user_id != request.user.id:
             return Response({'detail': 'You do not have permission to delete this comment.'},
                             status=status.HTTP_403_FORBIDDEN)
 
-        comment.delete()  # Delete the comment
+        # Replies stay, under a placeholder if there are any
+        with transaction.atomic():
+            delete_comment(comment)
+            notifications.replies_removed(comment.parent_comment_id)
+            publish_comment_event(comment.post_id, 'comment.deleted', {
+                'id': comment_id,
+                'parent_comment': comment.parent_comment_id,
+                'removed': 1,
+            })
+        invalidate_comments(comment.post_id)
+        invalidate_feed()
         return Response({'detail': 'Comment deleted successfully.'}, status=status.HTTP_204_NO_CONTENT)
+
+class NotificationListView(APIView):
+    """
+    The authenticated user's reply notifications, latest activity first, keyset
+    paginated like the feed.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CustomJWTAuthentication]
+
+    def get(self, request):
+        paginator = InboxCursorPagination()
+        page = paginator.paginate_queryset(notifications.inbox(request.user.id), request)
+        return paginator.get_paginated_response(NotificationSerializer(page, many=True).data)
+
+class NotificationUnreadView(APIView):
+    """
+    Number of unread notifications, cheap enough to poll.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CustomJWTAuthentication]
+
+    def get(self, request):
+        return Response({'unread': notifications.unread_count(request.user.id)})
+
+class NotificationReadView(APIView):
+    """
+    Mark the notifications listed in `ids` read, or all of them when no ids are sent.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CustomJWTAuthentication]
+
+    def post(self, request):
+        ids = request.data.get('ids')
+        if ids is not None and (not isinstance(ids, list) or not all(type(pk) is int for pk in ids)):
+            return Response({'ids': 'A list of notification ids is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        marked = notifications.mark_read(request.user.id, ids)
+        return Response({'marked': marked, 'unread': notifications.unread_count(request.user.id)})
+
+class ImageUploadView(APIView):
+    """
+    Start a chunked image upload. Type and declared size are checked up front, so an
+    oversize or unsupported file is refused before any of it is sent.
+    """
+    authentication_classes = [CustomJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            return Response({'size': 'An integer size in bytes is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        upload = start_upload(
+            request.user,
+            request.data.get('filename') or 'image',
+            request.data.get('content_type', ''),
+            size,
+        )
+        return Response({'id': upload.id, 'offset': upload.received, 'size': upload.size},
+                        status=status.HTTP_201_CREATED)
+
+class ImageUploadChunkView(APIView):
+    """
+    GET reports how much of an upload has been received, so an interrupted client can
+    resume. PATCH appends the raw request body at the offset given in the
+    Upload-Offset header; it is streamed to disk and never parsed as request.data.
+    """
+    authentication_classes = [CustomJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get_upload(self, request, upload_id):
+        try:
+            return ImageUpload.objects.get(id=upload_id, user_id=request.user.id)
+        except ImageUpload.DoesNotExist:
+            return None
+
+    def get(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload is None:
+            return Response({'detail': 'Upload not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'id': upload.id, 'offset': upload.received, 'size': upload.size, 'status': upload.status})
+
+    def patch(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload is None:
+            return Response({'detail': 'Upload not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return Response({'detail': 'Upload-Offset and Content-Length headers are required.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        upload = append_chunk(upload, offset, request.stream, length)
+        return Response({'id': upload.id, 'offset': upload.received, 'size': upload.size, 'status': upload.status})
+
+class SearchView(APIView):
+    """
+    Ranked full-text search over posts and comments: ?q=<words>, optionally
+    &type=post|comment, paginated with page and page_size. Snippets wrap the
+    matched words in <mark> tags.
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+    page_size = 20
+    max_page_size = 100
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'q': 'A search query is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        kind = request.query_params.get('type')
+        if kind not in (None, 'post', 'comment'):
+            return Response({'type': 'Must be "post" or "comment".'}, status=status.HTTP_400_BAD_REQUEST)
+
+        page = non_negative_int_param(request.query_params, 'page') or 1
+        page_size = min(non_negative_int_param(request.query_params, 'page_size') or self.page_size, self.max_page_size)
+        total, results = search.search(query, kind, offset=(page - 1) * page_size, limit=page_size)
+
+        url = request.build_absolute_uri()
+        next_link = replace_query_param(url, 'page', page + 1) if page * page_size < total else None
+        previous_link = None
+        if page > 1:
+            previous_link = replace_query_param(url, 'page', page - 1) if page > 2 else remove_query_param(url, 'page')
+        return Response({'count': total, 'next': next_link, 'previous': previous_link, 'results': results})
@@ -0,0 +1,77 @@
+"""
+Async login for deployments served through main_thought_stream.asgi.
+
+LoginView hashes the password inside authenticate() on the worker thread that runs
+the request, and Django's own aauthenticate() hashes on the event loop. Here only
+the user lookup runs on the loop; hashing goes to the bounded pool in user.hashers,
+so a burst of logins queues there instead of stalling every other request.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import ParseError, Throttled
+
+from main_thought_stream.throttling import IPThrottle, UsernameThrottle, first_rejection
+from post.async_views import error_response, json_response
+
+from .hashers import amake_password, averify_password
+from .serializers import INVALID_LOGIN, LoginCredentialsSerializer
+from .views import get_token_for_user
+
+
+def parse_body(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+    return request.POST
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncLoginView(View):
+    """
+    Same request and response as LoginView.
+    """
+    throttle_classes = [IPThrottle, UsernameThrottle]
+    throttle_scope = 'login'
+
+    async def post(self, request):
+        try:
+            request.data = parse_body(request)
+        except ParseError as exc:
+            return error_response(exc)
+
+        throttles = [throttle_class() for throttle_class in self.throttle_classes]
+        # Thread, since the bucket store may be a Redis round trip
+        throttle = await sync_to_async(first_rejection, thread_sensitive=False)(throttles, request, self)
+        if throttle is not None:
+            exc = Throttled(throttle.wait())
+            response = error_response(exc)
+            if exc.wait is not None:
+                response['Retry-After'] = '%d' % exc.wait
+            return response
+
+        serializer = LoginCredentialsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return json_response(serializer.errors, status=400)
+        username = serializer.validated_data['username']
+        password = serializer.validated_data['password']
+
+        user = await get_user_model()._default_manager.filter(username=username).afirst()
+        is_correct, must_update = await averify_password(password, user.password if user else None)
+        if not is_correct or not user.is_active:
+            return json_response({'non_field_errors': [INVALID_LOGIN]}, status=400)
+        if must_update:
+            # The hasher or its cost changed since this password was stored
+            user.password = await amake_password(password)
+            await user.asave(update_fields=['password'])
+
+        response = get_token_for_user(user, request.data.get('remember_me', False))
+        response['username'] = username
+        response['email'] = user.email
+        return json_response(response)
@@ -0,0 +1,94 @@
+"""
+Password hashers with their cost set by settings.PASSWORD_HASHING, and the pool
+async views hash passwords on.
+
+Changing a cost only affects new hashes: Django rehashes a stored password at its
+next successful login whenever its hasher or cost differs from the first entry of
+PASSWORD_HASHERS, so the cost can be raised (or the algorithm switched) without
+invalidating anyone's password.
+"""
+import asyncio
+import functools
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+def cost(name, default):
+    value = getattr(settings, 'PASSWORD_HASHING', {}).get(name)
+    return default if value is None else value
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return cost('PBKDF2_ITERATIONS', hashers.PBKDF2PasswordHasher.iterations)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """
+    Needs argon2-cffi.
+    """
+
+    @property
+    def time_cost(self):
+        return cost('ARGON2_TIME_COST', hashers.Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return cost('ARGON2_MEMORY_COST', hashers.Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return cost('ARGON2_PARALLELISM', hashers.Argon2PasswordHasher.parallelism)
+
+
+class BCryptSHA256PasswordHasher(hashers.BCryptSHA256PasswordHasher):
+    """
+    Needs bcrypt.
+    """
+
+    @property
+    def rounds(self):
+        return cost('BCRYPT_ROUNDS', hashers.BCryptSHA256PasswordHasher.rounds)
+
+
+# hashlib, argon2-cffi and bcrypt all release the GIL while hashing, so threads
+# hash on every core without the pickling a process pool would add
+executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PASSWORD_HASHING', {}).get('WORKERS') or os.cpu_count(),
+    thread_name_prefix='password-hashing',
+)
+
+
+@functools.cache
+def dummy_password():
+    """
+    An encoded password nobody knows, made once with the hasher of the first
+    verification of an unknown username.
+    """
+    return hashers.make_password(secrets.token_urlsafe())
+
+
+def verify_password(password, encoded):
+    if encoded is None:
+        # Hashed anyway, then refused like a wrong password
+        hashers.verify_password(password, dummy_password())
+        return False, False
+    return hashers.verify_password(password, encoded)
+
+
+async def averify_password(password, encoded):
+    """
+    hashers.verify_password on the hashing pool: (is correct, needs rehashing).
+    A None `encoded` still costs one hash, so unknown usernames take as long as
+    wrong passwords.
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, verify_password, password, encoded)
+
+
+async def amake_password(password):
+    return await asyncio.get_running_loop().run_in_executor(executor, hashers.make_password, password)
@@ -0,0 +1,53 @@
+from django.db import migrations
+from django.db.models import Count
+
+# auth.User belongs to django.contrib.auth, so the constraint cannot go in a model's
+# Meta; users created without an email keep sharing the empty string
+INDEX_COLUMNS = "auth_user (email) WHERE email <> ''"
+
+
+def check_duplicate_emails(apps, schema_editor):
+    # Which account keeps a shared email is for an operator to decide, so the
+    # migration stops until every email belongs to one account
+    User = apps.get_model('auth', 'User')
+    duplicated = (
+        User.objects.exclude(email='').values('email')
+        .annotate(accounts=Count('id')).filter(accounts__gt=1).order_by('email')
+    )
+    problems = []
+    for email in duplicated.values_list('email', flat=True):
+        user_ids = User.objects.filter(email=email).order_by('id').values_list('id', flat=True)
+        problems.append(f"{email}: users {', '.join(map(str, user_ids))}")
+    if problems:
+        raise RuntimeError(
+            'Cannot make auth_user.email unique while accounts share an email. Change or clear '
+            'the email of all but one account of each, then migrate again:\n' + '\n'.join(problems)
+        )
+
+
+def create_email_index(apps, schema_editor):
+    # Built without locking out registrations on PostgreSQL. A build that failed there
+    # leaves an invalid index behind, dropped first so the migration can be rerun.
+    concurrently = ' CONCURRENTLY' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute(f"DROP INDEX{concurrently} IF EXISTS auth_user_email_unique")
+    schema_editor.execute(f"CREATE UNIQUE INDEX{concurrently} auth_user_email_unique ON {INDEX_COLUMNS}")
+
+
+def drop_email_index(apps, schema_editor):
+    concurrently = ' CONCURRENTLY' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute(f"DROP INDEX{concurrently} IF EXISTS auth_user_email_unique")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('user', '0002_follow'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_emails, migrations.RunPython.noop),
+        migrations.RunPython(create_email_index, drop_email_index),
+    ]
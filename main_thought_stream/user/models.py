@@ -1,4 +1,5 @@
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
+from django.conf import settings
 from django.db import models
 
 # Custom manager to handle user creation
@@ -33,3 +34,36 @@ class User(AbstractBaseUser):
 
     def __str__(self):
         return self.username
+
+
+class Follow(models.Model):
+    follower = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='following')
+    followee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='followers')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.follower_id} follows {self.followee_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['follower', 'followee'], name='follow_unique'),
+            models.CheckConstraint(check=~models.Q(follower=models.F('followee')), name='follow_not_self'),
+        ]
+        indexes = [
+            # Followers of an author, read when a post is fanned out
+            models.Index(fields=['followee', 'follower'], name='follow_followee_idx'),
+        ]
+
+
+class FollowerCount(models.Model):
+    """
+    Number of followers of a user, kept up to date by FollowView. Decides whether the
+    user's posts are pushed to followers' timelines or pulled when they are read.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='follower_count',
+    )
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.count} followers"
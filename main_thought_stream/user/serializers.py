@@ -1,14 +1,30 @@
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from rest_framework import serializers
 import re
 
+USERNAME_RE = re.compile(r"^[a-zA-Z0-9]*$")
+EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+UPPERCASE_RE = re.compile(r'[A-Z]')
+LOWERCASE_RE = re.compile(r'[a-z]')
+DIGIT_RE = re.compile(r'[0-9]')
+SPECIAL_RE = re.compile(r'[!@#$%^&*(),.?":{}|<>]')
+
+USERNAME_TAKEN = "This username is already taken."
+EMAIL_TAKEN = "This email is already taken."
+INVALID_LOGIN = "Invalid username or password."
+
+
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
     class Meta:
         model = User
         fields = ['username', 'email', 'password']
+        # Uniqueness is checked by validate() in one query and enforced by the database
+        extra_kwargs = {'username': {'validators': []}}
 
     def validate_username(self, value):
         # Username cannot be empty
@@ -16,17 +32,13 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Username cannot be empty.")
         
         # Username must consist of letters and numbers only
-        if not re.match("^[a-zA-Z0-9]*$", value):
+        if not USERNAME_RE.match(value):
             raise serializers.ValidationError("Username must consist of letters and numbers only.")
         
         # Username length should be between 5 and 20 characters
         if len(value) < 5 or len(value) > 20:
             raise serializers.ValidationError("Username length must be between 5 and 20 characters.")
         
-        # Username should not be a duplicate
-        if User.objects.filter(username=value).exists():
-            raise serializers.ValidationError("This username is already taken.")
-        
         return value
 
     def validate_password(self, value):
@@ -39,13 +51,13 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Password length must be between 8 and 20 characters.")
         
         # Password should contain at least one uppercase letter, one lowercase letter, one number, and one special character
-        if not re.search(r'[A-Z]', value):
+        if not UPPERCASE_RE.search(value):
             raise serializers.ValidationError("Password must contain at least one uppercase letter.")
-        if not re.search(r'[a-z]', value):
+        if not LOWERCASE_RE.search(value):
             raise serializers.ValidationError("Password must contain at least one lowercase letter.")
-        if not re.search(r'[0-9]', value):
+        if not DIGIT_RE.search(value):
             raise serializers.ValidationError("Password must contain at least one number.")
-        if not re.search(r'[!@#$%^&*(),.?":{}|<>]', value):  # Check for special characters
+        if not SPECIAL_RE.search(value):  # Check for special characters
             raise serializers.ValidationError("Password must contain at least one special character.")
         
         return value
@@ -56,29 +68,49 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Email cannot be empty.")
         
         # Check if email is in the correct format
-        if not re.match(r"[^@]+@[^@]+\.[^@]+", value):
+        if not EMAIL_RE.match(value):
             raise serializers.ValidationError("Invalid email format.")
         
-        # Email should not be a duplicate
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("This email is already taken.")
-        
         return value
 
+    def validate(self, attrs):
+        # Username and email should not be duplicates, checked together in one query
+        errors = self.taken_errors(attrs['username'], attrs['email'])
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def taken_errors(self, username, email):
+        taken = User.objects.filter(Q(username=username) | Q(email=email)).values_list('username', 'email')
+        errors = {}
+        for taken_username, taken_email in taken:
+            if taken_username == username:
+                errors['username'] = [USERNAME_TAKEN]
+            if taken_email == email:
+                errors['email'] = [EMAIL_TAKEN]
+        return errors
+
     def create(self, validated_data):
         # Create the user using the validated data
-        user = User.objects.create_user(
-            username=validated_data['username'],
-            email=validated_data['email'],
-            password=validated_data['password']
-        )
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    username=validated_data['username'],
+                    email=validated_data['email'],
+                    password=validated_data['password']
+                )
+        except IntegrityError:
+            # Another registration claimed the username or email since validate() ran
+            errors = self.taken_errors(validated_data['username'], validated_data['email'])
+            raise serializers.ValidationError(errors or {'username': [USERNAME_TAKEN]})
         
         return user
 
-class UserLoginSerializer(serializers.Serializer):
+class LoginCredentialsSerializer(serializers.Serializer):
         username = serializers.CharField()
         password = serializers.CharField(write_only=True)
 
+class UserLoginSerializer(LoginCredentialsSerializer):
         def validate(self, attrs):
             username = attrs.get('username')
             password = attrs.get('password')
@@ -86,7 +118,7 @@ class UserLoginSerializer(serializers.Serializer):
                 raise serializers.ValidationError("Both username and password are required.")
             user = authenticate(username = username, password = password)
             if not user:
-                raise serializers.ValidationError("Invalid username or password.")
+                raise serializers.ValidationError(INVALID_LOGIN)
             attrs['user'] = user
             return attrs
 
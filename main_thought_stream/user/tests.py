@@ -1,3 +1,182 @@
-from django.test import TestCase
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from main_thought_stream.throttling import bucket_store
+
+from .models import Follow, FollowerCount
+from .serializers import UserRegistrationSerializer
+
+# Keeps password hashing out of the test run time
+FAST_HASHING = {'PBKDF2_ITERATIONS': 1000}
+
+
+class FollowTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='follower')
+        self.other = User.objects.create_user(username='followee')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def test_following_twice_keeps_one_follow(self):
+        url = reverse('user-follow', args=[self.other.id])
+        self.assertEqual(self.client.post(url).status_code, 201)
+        self.assertEqual(self.client.post(url).status_code, 200)
+        self.assertEqual(Follow.objects.filter(follower=self.user, followee=self.other).count(), 1)
+        self.assertEqual(FollowerCount.objects.get(user=self.other).count, 1)
+
+    def test_invalid_follows_are_rejected(self):
+        self.assertEqual(self.client.post(reverse('user-follow', args=[self.user.id])).status_code, 400)
+        self.assertEqual(self.client.post(reverse('user-follow', args=[10 ** 6])).status_code, 404)
+        self.assertEqual(self.client.delete(reverse('user-follow', args=[self.other.id])).status_code, 404)
+        self.assertEqual(APIClient().post(reverse('user-follow', args=[self.other.id])).status_code, 403)
+
+
+@override_settings(PASSWORD_HASHING=FAST_HASHING)
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.addCleanup(bucket_store.clear)
+        User.objects.create_user(username='target', password='Secret123!')
+        self.client = APIClient()
+
+    def login(self, username, address):
+        return self.client.post(reverse('login'), {'username': username, 'password': 'guess'}, format='json',
+                                REMOTE_ADDR=address)
+
+    def test_attempts_are_limited_per_username_before_hashing(self):
+        rates = {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {'login.username': '2/min'}}
+        with self.settings(REST_FRAMEWORK=rates), mock.patch('user.serializers.authenticate',
+                                                             return_value=None) as authenticate:
+            self.assertEqual(self.login('target', '10.0.0.1').status_code, 400)
+            self.assertEqual(self.login('Target', '10.0.0.2').status_code, 400)
+            self.assertEqual(self.login('target', '10.0.0.3').status_code, 429)
+            self.assertEqual(self.login('someone', '10.0.0.3').status_code, 400)
+        self.assertEqual(authenticate.call_count, 3)
+
+    def test_forwarded_for_cannot_reset_the_address_bucket(self):
+        rates = {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {'login.ip': '2/min'}}
+        with self.settings(REST_FRAMEWORK=rates), mock.patch('user.serializers.authenticate', return_value=None):
+            for spoofed in ('1.1.1.1', '2.2.2.2'):
+                response = self.client.post(reverse('login'), {'username': 'target', 'password': 'guess'},
+                                            format='json', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=spoofed)
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post(reverse('login'), {'username': 'target', 'password': 'guess'},
+                                        format='json', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR='3.3.3.3')
+        self.assertEqual(response.status_code, 429)
+
+
+@override_settings(PASSWORD_HASHING=FAST_HASHING)
+class RegistrationTests(TestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.addCleanup(bucket_store.clear)
+        self.client = APIClient()
+        self.data = {'username': 'newcomer', 'email': 'newcomer@example.com', 'password': 'Secret123!'}
+
+    def test_registering_checks_uniqueness_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('register'), self.data, format='json')
+        self.assertEqual(response.status_code, 201)
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+        self.assertTrue(User.objects.filter(username='newcomer', email='newcomer@example.com').exists())
+
+    def test_taken_username_and_email_are_both_reported(self):
+        User.objects.create_user(username='newcomer', email='other@example.com')
+        User.objects.create_user(username='someone', email='newcomer@example.com')
+        response = self.client.post(reverse('register'), self.data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['username'], ['This username is already taken.'])
+        self.assertEqual(response.data['email'], ['This email is already taken.'])
+
+    def test_losing_a_race_gives_the_same_field_errors(self):
+        for competitor, field in [
+            ({'username': 'newcomer', 'email': 'first@example.com'}, 'username'),
+            ({'username': 'firstone', 'email': 'newcomer@example.com'}, 'email'),
+        ]:
+            serializer = UserRegistrationSerializer(data=self.data)
+            self.assertTrue(serializer.is_valid())
+            # The other client registers between validation and the insert
+            user = User.objects.create_user(**competitor)
+            with self.assertRaises(ValidationError) as raised:
+                serializer.save()
+            self.assertEqual(raised.exception.detail, {field: [f'This {field} is already taken.']})
+            user.delete()
+
+    def test_email_index_migration_stops_on_duplicates(self):
+        migration = import_module('user.migrations.0003_auth_user_email_unique')
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX auth_user_email_unique")
+        first = User.objects.create_user(username='first', email='shared@example.com')
+        later = User.objects.create_user(username='later', email='shared@example.com')
+        User.objects.create_user(username='blank', email='')
+        User.objects.create_user(username='also_blank', email='')
+
+        with self.assertRaisesMessage(RuntimeError, f'shared@example.com: users {first.pk}, {later.pk}'):
+            migration.check_duplicate_emails(apps, None)
+        # Nobody's email was touched
+        self.assertEqual(User.objects.get(pk=later.pk).email, 'shared@example.com')
+
+        later.email = 'later@example.com'
+        later.save()
+        migration.check_duplicate_emails(apps, None)
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE UNIQUE INDEX auth_user_email_unique ON {migration.INDEX_COLUMNS}")
+
+
+@override_settings(PASSWORD_HASHING=FAST_HASHING)
+class LoginTests(TestCase):
+    def setUp(self):
+        bucket_store.clear()
+        self.addCleanup(bucket_store.clear)
+        self.user = User.objects.create_user(username='member', email='member@example.com', password='Secret123!')
+        self.client = APIClient()
+
+    def login(self, name, password='Secret123!'):
+        return self.client.post(reverse(name), {'username': 'member', 'password': password}, format='json')
+
+    def test_async_login_answers_like_login(self):
+        for name in ['login', 'login-async']:
+            response = self.login(name)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(set(data), {'access_token', 'refresh_token', 'username', 'email'})
+            self.assertEqual(AccessToken(data['access_token'])['user_id'], self.user.id)
+            self.assertEqual(data['email'], 'member@example.com')
+
+            response = self.login(name, password='Wrong123!')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'non_field_errors': ['Invalid username or password.']})
+
+            response = self.client.post(reverse(name), {'username': 'ghost', 'password': 'x'}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'non_field_errors': ['Invalid username or password.']})
+
+        response = self.client.post(reverse('login-async'), {'username': 'member'}, format='json')
+        self.assertEqual(response.json(), {'password': ['This field is required.']})
+
+    def test_logging_in_rehashes_with_the_current_hasher_and_cost(self):
+        hashers = ['user.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher']
+        for name in ['login', 'login-async']:
+            with self.settings(PASSWORD_HASHERS=hashers):
+                User.objects.filter(pk=self.user.pk).update(password=make_password('Secret123!', hasher='md5'))
+                self.assertEqual(self.login(name).status_code, 200)
+                self.user.refresh_from_db()
+                self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1000$'))
+
+                with self.settings(PASSWORD_HASHING={'PBKDF2_ITERATIONS': 1200}):
+                    self.assertEqual(self.login(name).status_code, 200)
+                self.user.refresh_from_db()
+                self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1200$'))
@@ -1,5 +1,6 @@
 from django.urls import path
 from .views import *
+from .async_views import AsyncLoginView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -8,7 +9,10 @@ from rest_framework_simplejwt.views import (
 urlpatterns = [
     path('register/', RegisterView.as_view(), name = 'register'),
     path('login/', LoginView.as_view(), name = 'login'),
+    path('login/async/', AsyncLoginView.as_view(), name='login-async'),
     
+    path('<int:user_id>/follow/', FollowView.as_view(), name='user-follow'),
+
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh')
 ]
\ No newline at end of file
@@ -1,7 +1,15 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .serializers import UserRegistrationSerializer, UserLoginSerializer
+from .models import Follow, FollowerCount
+from post import timeline
+from post.authentication import CustomJWTAuthentication
+from main_thought_stream.throttling import IPThrottle, ThrottleFirstMixin, UsernameThrottle
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.authentication import BasicAuthentication, SessionAuthentication
 from datetime import timedelta
@@ -24,23 +32,25 @@ def get_token_for_user(user, remember_me=False):
         'refresh_token': str(refresh),
     }
 
-class RegisterView(APIView):
+class RegisterView(ThrottleFirstMixin, APIView):
     authentication_classes = [BasicAuthentication, SessionAuthentication] 
+    throttle_classes = [IPThrottle]
+    throttle_scope = 'register'
     def post(self, request):
         serializer = UserRegistrationSerializer(data=request.data)
         if serializer.is_valid(raise_exception = True):
-            response = serializer.save()
-            print("User created:", response)
+            serializer.save()
             return Response({"message": "User registered successfully!"}, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class LoginView(APIView):
+class LoginView(ThrottleFirstMixin, APIView):
     authentication_classes = [BasicAuthentication, SessionAuthentication] 
+    throttle_classes = [IPThrottle, UsernameThrottle]
+    throttle_scope = 'login'
     def post(self, request):
         serializer = UserLoginSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.validated_data['user']
-            print("User logged in:", user)
             remember_me = request.data.get('remember_me', False)
             # Generate JWT tokens
             response = get_token_for_user(user, remember_me)
@@ -49,3 +59,43 @@ class LoginView(APIView):
             return Response(response, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+
+class FollowView(APIView):
+    """
+    Follow (POST) or unfollow (DELETE) a user. Their posts then join or leave the
+    authenticated user's home timeline.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CustomJWTAuthentication]
+
+    def get_followee(self, request, user_id):
+        if user_id == request.user.id:
+            return None, Response({'detail': 'You cannot follow yourself.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not get_user_model().objects.filter(pk=user_id).exists():
+            return None, Response({'detail': 'User not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return user_id, None
+
+    def post(self, request, user_id):
+        followee_id, error = self.get_followee(request, user_id)
+        if error:
+            return error
+        with transaction.atomic():
+            _, created = Follow.objects.get_or_create(follower_id=request.user.id, followee_id=followee_id)
+            if created:
+                FollowerCount.objects.get_or_create(user_id=followee_id)
+                FollowerCount.objects.filter(user_id=followee_id).update(count=F('count') + 1)
+        code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        return Response({'detail': f'Following user {followee_id}.'}, status=code)
+
+    def delete(self, request, user_id):
+        followee_id, error = self.get_followee(request, user_id)
+        if error:
+            return error
+        with transaction.atomic():
+            follow = Follow.objects.filter(follower_id=request.user.id, followee_id=followee_id).first()
+            if follow is None:
+                return Response({'detail': 'You are not following this user.'}, status=status.HTTP_404_NOT_FOUND)
+            follow.delete()
+            FollowerCount.objects.filter(user_id=followee_id, count__gt=0).update(count=F('count') - 1)
+            timeline.follower_lost(followee_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)